@@ -1,12 +1,27 @@
+from startup_timing import mark_once, get_marks, within_budget
 import streamlit as st
-import tensorflow as tf
-import numpy as np
-from PIL import Image
-import cv2
 import os
-from model_utils import create_model, preprocess_image, get_class_names
+import time
+import numpy as np
+from model_utils import preprocess_image, get_class_names, augmentation_views, resize_to_input
+from model_registry import get_registry
+from inference_scheduler import get_scheduler, QueueFullError
+from prediction_cache import get_prediction_cache
 from disease_info import get_disease_info
-from utils import validate_image, format_confidence
+from utils import ImageUpload, ImageValidationError, format_confidence, resize_image_for_display
+from postprocessing import UNKNOWN_LABEL, get_calibration, record_from_list, record_to_list
+from tiling import DEFAULT_MAX_SIDE, TILE_SIZE, classify_tiled, heatmap_overlay
+from crops import ANY_CROP, get_crop_table
+from history import get_history
+from similarity import get_similarity_index
+from metrics import get_metrics, record_error, span, start_metrics_server, trace, STAGE_METRIC, ERROR_METRIC
+
+# Nothing above imports TensorFlow or OpenCV; they load with the model in the background
+mark_once('imports')
+
+# Confirmed cases shown with a diagnosis, expanded when the top-1 confidence is below SIMILAR_CASES_BELOW
+SIMILAR_CASES = 10
+SIMILAR_CASES_BELOW = 0.7
 
 # Page configuration
 st.set_page_config(
@@ -17,50 +32,271 @@ st.set_page_config(
 )
 
 # Initialize session state
-if 'model' not in st.session_state:
-    st.session_state.model = None
 if 'class_names' not in st.session_state:
     st.session_state.class_names = get_class_names()
 
+# The model is shared by every session in this process. Start loading and
+# warming it up (including the TensorFlow import) in a background thread as
+# soon as the server runs the script for the first time, so it is ready by
+# the time the user has picked a file, and hot-swap it whenever the .keras
+# file on disk is replaced.
+get_registry().preload()
+get_registry().start_watcher(interval=float(os.environ.get('MODEL_WATCH_INTERVAL', 30)))
+
+# Prometheus endpoint for this process when METRICS_PORT is set
+start_metrics_server()
+
 def load_model():
     """Load the pre-trained model"""
     try:
-        if st.session_state.model is None:
-            with st.spinner("Loading AI model... This may take a moment."):
-                st.session_state.model = create_model()
-        return st.session_state.model
+        registry = get_registry()
+        if registry.is_loaded():
+            return registry.get()
+        with st.spinner("Loading AI model... This may take a moment."):
+            return registry.get()
     except Exception as e:
+        record_error('load_model')
         st.error(f"Error loading model: {str(e)}")
         return None
 
-def classify_image(image, model):
-    """Classify the uploaded image"""
+def get_upload(uploaded_file):
+    """Validate and wrap the uploaded file, reusing the decoded image across reruns"""
+    upload_id = getattr(uploaded_file, 'file_id', None) or (uploaded_file.name, uploaded_file.size)
+    cached = st.session_state.get('upload')
+    if cached is not None and cached[0] == upload_id:
+        return cached[1]
+    
+    with span('upload'):
+        upload = ImageUpload.from_uploaded_file(uploaded_file)
+    upload.validate()
+    st.session_state.upload = (upload_id, upload)
+    return upload
+
+def classify_image(image, model, content_hash=None, tta_views=1, crop=ANY_CROP):
+    """Classify the uploaded image
+    
+    When content_hash (a digest of the original file bytes) is given, results
+    are cached per model version so re-uploads and reruns skip the model.
+    With tta_views > 1, flipped/rotated views are classified in one batch and
+    their probabilities averaged. crop (a crop id) limits the diagnosis to
+    that crop's diseases. When similar cases can be shown, the image's
+    embedding from the same forward pass is kept for image_embedding.
+    Returns a prediction record (see postprocessing.prediction_dtype), or
+    None on error.
+    """
     try:
-        # Preprocess image
-        processed_image = preprocess_image(image)
+        cache = get_prediction_cache()
+        cache_key = None
+        model_version = get_registry().version_of(model)
+        calibration = get_calibration()
+        if content_hash is not None and model_version is not None:
+            cache_key = cache.make_key(content_hash,
+                                       f"{model_version}+tta{tta_views}+crop{crop}+{calibration.version}", top_k=3)
         
-        # Make prediction
-        predictions = model.predict(processed_image, verbose=0)
+        cached = cache.get(cache_key) if cache_key else None
+        if cached is not None:
+            return record_from_list(cached)
         
-        # Get top 3 predictions
-        top_indices = np.argsort(predictions[0])[-3:][::-1]
+        # Preprocess image
+        processed_image = preprocess_image(image)
+        if tta_views > 1:
+            processed_image = augmentation_views(processed_image, tta_views)
         
-        results = []
-        for idx in top_indices:
-            confidence = float(predictions[0][idx])
-            class_name = st.session_state.class_names[idx]
-            results.append({
-                'disease': class_name,
-                'confidence': confidence,
-                'percentage': confidence * 100
-            })
+        # Make prediction; the scheduler batches this with other sessions' requests
+        # and returns a calibrated top-k record. The span covers queueing as well
+        # as the forward pass.
+        embed = get_similarity_index() is not None and getattr(model, 'returns_embeddings', False)
+        with span('inference'):
+            record = get_scheduler().predict(model, processed_image, top_k=3, crop=crop, embed=embed)
+        if embed:
+            record, embedding = record
+            st.session_state.embedding = (content_hash, embedding)
+        if cache_key:
+            cache.put(cache_key, record_to_list(record))
+        mark_once('first_inference')
         
-        return results
+        return record
+    except QueueFullError as e:
+        st.warning(f"⏳ {str(e)}")
+        return None
+    except TimeoutError:
+        st.error("Analysis timed out because the server is busy. Please try again.")
+        return None
     except Exception as e:
+        record_error('classify_image')
         st.error(f"Error during classification: {str(e)}")
         return None
 
+def classify_tiled_image(upload, model, crop=ANY_CROP):
+    """Classify a high-resolution photo tile by tile (see tiling.py)
+
+    Returns a tiling.TiledResult, or None on error. Not cached: the heatmap
+    is only needed for the photo on screen.
+    """
+    try:
+        with span('inference'):
+            result = classify_tiled(model, upload.decode_at(DEFAULT_MAX_SIDE), top_k=3, crop=crop)
+        mark_once('first_inference')
+        return result
+    except Exception as e:
+        record_error('classify_tiled')
+        st.error(f"Error during tiled analysis: {str(e)}")
+        return None
+
+def record_diagnosis(upload, model, record):
+    """Add the diagnosis to the field history (see history.py); a failure never affects the page"""
+    try:
+        history = get_history()
+        if history is not None:
+            latitude, longitude = upload.gps or (None, None)
+            history.record(record, upload.sha256, get_registry().version_of(model),
+                           st.session_state.get('field_id'), latitude, longitude, source='app')
+    except Exception as e:
+        record_error('history')
+        print(f"Failed to record diagnosis: {str(e)}")
+
+def image_embedding(upload, model):
+    """Embedding of the upload, reusing the one from its classification when there was one"""
+    cached = st.session_state.get('embedding')
+    if cached is not None and cached[0] == upload.sha256:
+        return cached[1]
+    # Cached or tiled diagnoses did not run the model on the whole image
+    _, embedding = get_scheduler().predict(model, preprocess_image(upload.image), top_k=1, embed=True)
+    st.session_state.embedding = (upload.sha256, embedding)
+    return embedding
+
+def display_similar_cases(upload, model, record):
+    """Show the most similar confirmed images (see similarity.py), expanded when the diagnosis is uncertain"""
+    index = get_similarity_index()
+    if index is None or index.count == 0 or not getattr(model, 'returns_embeddings', False):
+        return
+    uncertain = not record['accepted'] or record['confidence'][0] < SIMILAR_CASES_BELOW
+    with st.expander("🔎 Similar confirmed cases", expanded=bool(uncertain)):
+        try:
+            start = time.perf_counter()
+            matches = index.search(image_embedding(upload, model), k=SIMILAR_CASES)
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            columns = st.columns(5)
+            for i, match in enumerate(matches):
+                with columns[i % 5]:
+                    caption = f"{st.session_state.class_names[match['class_id']]} ({match['similarity']:.2f})"
+                    thumbnail = index.thumbnail(match['id'])
+                    if thumbnail is not None:
+                        st.image(thumbnail, caption=caption, use_column_width=True)
+                    else:
+                        st.caption(caption)
+            st.caption(f"{len(matches)} closest of {index.count} confirmed images, found in {elapsed_ms:.1f} ms "
+                       "(includes computing the embedding if needed)")
+        except Exception as e:
+            record_error('similar_cases')
+            st.error(f"Error finding similar cases: {str(e)}")
+
+def display_confirmation(upload, model, predicted):
+    """Let an agronomist add the photo, with its confirmed diagnosis, to the similar cases"""
+    index = get_similarity_index()
+    if index is None or not getattr(model, 'returns_embeddings', False):
+        return
+    with st.expander("✅ Confirm diagnosis"):
+        if st.session_state.get('confirmed') == upload.sha256:
+            st.success("This photo is in the confirmed cases.")
+            return
+        class_names = st.session_state.class_names
+        confirmed = st.selectbox("Confirmed disease", options=range(len(class_names)), index=predicted,
+                                 format_func=lambda class_id: class_names[class_id], key='confirmed_class')
+        if st.button("Add to confirmed cases"):
+            try:
+                index.add([image_embedding(upload, model)], [confirmed], [upload.sha256],
+                          images=[resize_to_input(upload.image)])
+                st.session_state.confirmed = upload.sha256
+                st.success("Added. It will be shown for similar photos from now on.")
+            except Exception as e:
+                record_error('confirm_case')
+                st.error(f"Error adding the confirmed case: {str(e)}")
+
+def display_heatmap(upload, result):
+    """Show where in the photo the evidence for the diagnosis came from"""
+    overlay = heatmap_overlay(upload.image, result.heatmap())
+    st.image(overlay, caption=f"Evidence for the diagnosis: {result.tiles_used} of {result.tiles_total} "
+                              f"tiles contained leaves", use_column_width=True)
+
+def display_results(record):
+    """Render the diagnosis, alternatives and disease information tabs"""
+    names = np.asarray(st.session_state.class_names)[record['class_id']]
+    results = [{'disease': name, 'confidence': float(confidence)}
+               for name, confidence in zip(names, record['confidence'])]
+    
+    if not record['accepted']:
+        # Too uncertain to give treatment advice; likely not a leaf or a poor photo
+        st.warning(f"🤔 **{UNKNOWN_LABEL}.** The model is not confident enough to diagnose this photo. "
+                   "Please retake it closer to a single leaf in good light.")
+        st.markdown("**Closest matches:** " + ", ".join(
+            f"{result['disease']} ({format_confidence(result['confidence'])})" for result in results))
+        return
+    
+    st.success("✅ Analysis Complete!")
+    
+    # Display top prediction
+    top_result = results[0]
+    confidence_color = "🟢" if top_result['confidence'] > 0.7 else "🟡" if top_result['confidence'] > 0.5 else "🔴"
+    
+    st.markdown(f"### {confidence_color} Primary Diagnosis")
+    st.markdown(f"**Disease:** {top_result['disease']}")
+    st.markdown(f"**Confidence:** {format_confidence(top_result['confidence'])}")
+    
+    # Confidence bar
+    st.progress(top_result['confidence'])
+    
+    # Alternative predictions
+    if len(results) > 1:
+        st.markdown("### 📊 Alternative Possibilities")
+        for i, result in enumerate(results[1:], 2):
+            with st.expander(f"{i}. {result['disease']} ({format_confidence(result['confidence'])})"):
+                disease_info = get_disease_info(result['disease'])
+                if disease_info:
+                    st.markdown(f"**Description:** {disease_info['description']}")
+    
+    # Detailed information for top prediction
+    st.markdown("---")
+    disease_info = get_disease_info(top_result['disease'])
+    
+    if disease_info:
+        st.markdown("### 📖 Disease Information")
+        
+        # Create tabs for organized information
+        tab1, tab2, tab3 = st.tabs(["📝 Description", "🩺 Treatment", "🛡️ Prevention"])
+        
+        with tab1:
+            st.markdown(disease_info['description'])
+            if disease_info.get('symptoms'):
+                st.markdown("**Common Symptoms:**")
+                for symptom in disease_info['symptoms']:
+                    st.markdown(f"• {symptom}")
+        
+        with tab2:
+            st.markdown("**Recommended Treatment:**")
+            for treatment in disease_info['treatment']:
+                st.markdown(f"• {treatment}")
+            
+            if disease_info.get('severity') == 'high':
+                st.warning("⚠️ This is a serious disease. Consider consulting an agricultural expert.")
+        
+        with tab3:
+            st.markdown("**Prevention Measures:**")
+            for prevention in disease_info['prevention']:
+                st.markdown(f"• {prevention}")
+    
+    # Disclaimer
+    st.markdown("---")
+    st.info("ℹ️ **Disclaimer:** This AI tool provides guidance only. For serious infections or uncertainty, consult with local agricultural experts or extension services.")
+
 def main():
+    # Record the stages of this run; the debug panel shows them on the next one
+    with trace() as spans:
+        render_page()
+    if spans:
+        st.session_state.last_trace = spans
+
+def render_page():
     # Header
     st.title("🌱 Plant Disease Classifier")
     st.markdown("### AI-powered disease detection for healthier crops")
@@ -84,6 +320,36 @@ def main():
         - Max file size: 10MB
         """)
         
+        st.header("⚙️ Analysis Options")
+        crop_table = get_crop_table()
+        st.selectbox(
+            "Crop",
+            options=[ANY_CROP] + list(range(len(crop_table))),
+            format_func=lambda crop_id: "Any crop" if crop_id == ANY_CROP else crop_table.display_name(crop_id),
+            key='crop',
+            help="If you know which crop is in the photo, only its diseases are considered. "
+                 "This avoids mix-ups between similar diseases of different crops."
+        )
+        st.text_input(
+            "Field ID",
+            key='field_id',
+            help="Stored with each diagnosis so the Field History page can track disease rates per field. "
+                 "The GPS position is taken from the photo when it has one."
+        )
+        st.select_slider(
+            "Test-time augmentation views",
+            options=[1, 4, 8],
+            key='tta_views',
+            help="Classify flipped and rotated copies of the photo together and average the results. "
+                 "More views are more robust to odd angles but slightly slower."
+        )
+        st.checkbox(
+            "Tiled analysis for high-resolution photos",
+            key='tiled',
+            help="Analyze large field photos in overlapping tiles at close to full resolution instead of "
+                 "shrinking the whole photo, skipping tiles without leaves, and show where the disease was found."
+        )
+        
         st.header("🔬 Supported Diseases")
         st.markdown("This AI model can identify **38 different** plant diseases across various crops including:")
         st.markdown("- Tomato diseases")
@@ -91,6 +357,66 @@ def main():
         st.markdown("- Corn diseases")
         st.markdown("- Apple diseases")
         st.markdown("- And many more...")
+        
+        if get_registry().is_loaded():
+            with st.expander("⚙️ Model Status"):
+                stats = get_registry().stats()
+                for model_stats in stats['models'].values():
+                    st.markdown(f"**Version:** {model_stats['version']}")
+                    st.markdown(f"**Engine:** {model_stats['engine']}")
+                    st.markdown(f"**Load time:** {model_stats['load_seconds']:.2f}s "
+                                f"(warm-up {model_stats['warmup_seconds']:.2f}s)")
+                    latency = model_stats['warmup_latency'].get(1)
+                    if latency:
+                        st.markdown(f"**Single image:** {latency['first_call_ms']:.0f} ms cold, "
+                                    f"{latency['steady_ms']:.0f} ms warm (cold call paid during warm-up)")
+                    st.markdown(f"**Weights:** {model_stats['weights_mb']:.1f} MB")
+                    if model_stats['engine'] == 'cascade':
+                        cascade_stats = model_stats['engine_stats']
+                        st.markdown(f"**Cascade:** {cascade_stats['escalated']} of {cascade_stats['images']} images "
+                                    f"escalated to the full model ({cascade_stats['escalation_rate'] * 100:.0f}%)")
+                    if model_stats['engine'] == 'specialist':
+                        specialist_stats = model_stats['engine_stats']
+                        st.markdown(f"**Crop heads:** {len(specialist_stats['fitted_crops'])} fitted; feature cache "
+                                    f"{specialist_stats['feature_cache_hits']} hits, "
+                                    f"{specialist_stats['feature_cache_misses']} misses")
+                similar_index = get_similarity_index()
+                if similar_index is not None:
+                    similar_stats = similar_index.stats()
+                    st.markdown(f"**Similar cases:** {similar_stats['vectors']} confirmed images, "
+                                f"{similar_stats['lists'] or 'exhaustive search, no'} lists, "
+                                f"{similar_stats['bytes'] / 1024 / 1024:.1f} MB")
+                st.markdown(f"**Process memory:** {stats['process_rss_mb']:.0f} MB")
+                marks = get_marks()
+                st.markdown("**Startup:** " + ", ".join(
+                    f"{name.replace('_', ' ')} {marks[name]:.2f}s"
+                    for name in ['imports', 'first_paint', 'model_ready', 'first_inference'] if name in marks
+                ) + (" ✅" if within_budget() else f" ⚠️ over the {marks['ttfp_budget']:.1f}s first-paint budget"))
+                cache_stats = get_prediction_cache().stats()
+                st.markdown(f"**Prediction cache:** {cache_stats['hits'] + cache_stats['disk_hits']} hits, "
+                            f"{cache_stats['misses']} misses, {cache_stats['evictions']} evictions "
+                            f"({cache_stats['model_calls_saved']} model calls saved)")
+        
+        if os.environ.get('METRICS_DEBUG_PANEL') == '1':
+            with st.expander("🩺 Debug Metrics"):
+                last_trace = st.session_state.get('last_trace')
+                if last_trace:
+                    st.markdown("**Last run:** " + ", ".join(
+                        f"{stage} {seconds * 1000:.1f} ms" for stage, seconds in last_trace))
+                stage_stats = get_metrics().histogram(STAGE_METRIC).summary()
+                if stage_stats:
+                    st.markdown("**Stage latency (all sessions):**")
+                    st.table([{
+                        'stage': dict(key).get('stage'),
+                        'count': stats['count'],
+                        'p50 ms': round(stats['p50'] * 1000, 2),
+                        'p95 ms': round(stats['p95'] * 1000, 2),
+                    } for key, stats in sorted(stage_stats.items())])
+                errors = get_metrics().counter(ERROR_METRIC).samples()
+                st.markdown("**Errors:** " + (", ".join(
+                    f"{dict(key)['site']} {count}" for _, key, count in errors) or "none"))
+                if get_registry().is_loaded():
+                    st.markdown(f"**Queue depth:** {get_scheduler().queue_depth()}")
     
     # Main content area
     col1, col2 = st.columns([1, 1])
@@ -102,22 +428,27 @@ def main():
             type=['jpg', 'jpeg', 'png'],
             help="Upload a clear image of the plant leaf showing disease symptoms"
         )
+        # The page is usable once the uploader is up; marked before any early return below
+        mark_once('first_paint')
         
         if uploaded_file is not None:
-            # Validate image
-            if not validate_image(uploaded_file):
-                st.error("Invalid image file. Please upload a valid JPG, JPEG, or PNG image.")
+            # Validate image from its header, then decode it once for both display and analysis
+            try:
+                upload = get_upload(uploaded_file)
+            except ImageValidationError as e:
+                st.error(str(e))
                 return
             
             # Display uploaded image
             try:
-                image = Image.open(uploaded_file)
-                st.image(image, caption="Uploaded Image", use_column_width=True)
+                image = upload.image
+                st.image(resize_image_for_display(image), caption="Uploaded Image", use_column_width=True)
                 
                 # Image info
-                st.info(f"📊 Image size: {image.size[0]}x{image.size[1]} pixels")
+                st.info(f"📊 Image size: {upload.size[0]}x{upload.size[1]} pixels")
                 
             except Exception as e:
+                record_error('display_image')
                 st.error(f"Error loading image: {str(e)}")
                 return
     
@@ -132,64 +463,29 @@ def main():
                 # Classify button
                 if st.button("🔬 Analyze Plant Disease", type="primary", use_container_width=True):
                     with st.spinner("Analyzing image... Please wait"):
-                        results = classify_image(image, model)
+                        # Tiling only helps when the photo holds more than one tile's worth of detail
+                        if st.session_state.get('tiled') and min(upload.size) >= 2 * TILE_SIZE:
+                            result = classify_tiled_image(upload, model, crop=st.session_state.get('crop', ANY_CROP))
+                            record = result.record if result is not None else None
+                        else:
+                            result = None
+                            record = classify_image(image, model, content_hash=upload.sha256,
+                                                    tta_views=st.session_state.get('tta_views', 1),
+                                                    crop=st.session_state.get('crop', ANY_CROP))
                         
-                        if results:
-                            st.success("✅ Analysis Complete!")
-                            
-                            # Display top prediction
-                            top_result = results[0]
-                            confidence_color = "🟢" if top_result['confidence'] > 0.7 else "🟡" if top_result['confidence'] > 0.5 else "🔴"
-                            
-                            st.markdown(f"### {confidence_color} Primary Diagnosis")
-                            st.markdown(f"**Disease:** {top_result['disease']}")
-                            st.markdown(f"**Confidence:** {format_confidence(top_result['confidence'])}")
-                            
-                            # Confidence bar
-                            st.progress(top_result['confidence'])
-                            
-                            # Alternative predictions
-                            if len(results) > 1:
-                                st.markdown("### 📊 Alternative Possibilities")
-                                for i, result in enumerate(results[1:], 2):
-                                    with st.expander(f"{i}. {result['disease']} ({format_confidence(result['confidence'])})"):
-                                        disease_info = get_disease_info(result['disease'])
-                                        if disease_info:
-                                            st.markdown(f"**Description:** {disease_info['description']}")
-                            
-                            # Detailed information for top prediction
-                            st.markdown("---")
-                            disease_info = get_disease_info(top_result['disease'])
-                            
-                            if disease_info:
-                                st.markdown("### 📖 Disease Information")
-                                
-                                # Create tabs for organized information
-                                tab1, tab2, tab3 = st.tabs(["📝 Description", "🩺 Treatment", "🛡️ Prevention"])
-                                
-                                with tab1:
-                                    st.markdown(disease_info['description'])
-                                    if disease_info.get('symptoms'):
-                                        st.markdown("**Common Symptoms:**")
-                                        for symptom in disease_info['symptoms']:
-                                            st.markdown(f"• {symptom}")
-                                
-                                with tab2:
-                                    st.markdown("**Recommended Treatment:**")
-                                    for treatment in disease_info['treatment']:
-                                        st.markdown(f"• {treatment}")
-                                    
-                                    if disease_info.get('severity') == 'high':
-                                        st.warning("⚠️ This is a serious disease. Consider consulting an agricultural expert.")
-                                
-                                with tab3:
-                                    st.markdown("**Prevention Measures:**")
-                                    for prevention in disease_info['prevention']:
-                                        st.markdown(f"• {prevention}")
-                            
-                            # Disclaimer
-                            st.markdown("---")
-                            st.info("ℹ️ **Disclaimer:** This AI tool provides guidance only. For serious infections or uncertainty, consult with local agricultural experts or extension services.")
+                        if record is not None:
+                            record_diagnosis(upload, model, record)
+                            st.session_state.last_diagnosis = (upload.sha256, int(record['class_id'][0]))
+                            with span('render'):
+                                if result is not None:
+                                    display_heatmap(upload, result)
+                                display_results(record)
+                                display_similar_cases(upload, model, record)
+                
+                # Outside the button block, so it survives the rerun its own button triggers
+                last_diagnosis = st.session_state.get('last_diagnosis')
+                if last_diagnosis is not None and last_diagnosis[0] == upload.sha256:
+                    display_confirmation(upload, model, last_diagnosis[1])
             
             else:
                 st.error("❌ Model failed to load. Please refresh the page and try again.")
@@ -0,0 +1,240 @@
+import csv
+import io
+import json
+import os
+import time
+import zipfile
+from itertools import islice
+
+import numpy as np
+
+from model_utils import load_image_reduced, preprocess_batch, allocate_batch
+from postprocessing import UNKNOWN_LABEL, get_calibration, postprocess
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+MAX_IMAGE_BYTES = 10 * 1024 * 1024
+RESULT_FIELDS = ['file', 'disease', 'confidence', 'top_k', 'duplicate_of', 'error']
+
+
+def _is_image_name(name):
+    return name.lower().endswith(IMAGE_EXTENSIONS)
+
+
+def _upload_size(uploaded_file):
+    size = getattr(uploaded_file, 'size', None)
+    if size is None:
+        position = uploaded_file.tell()
+        size = uploaded_file.seek(0, io.SEEK_END)
+        uploaded_file.seek(position)
+    return size
+
+
+def iter_uploaded_files(uploaded_files):
+    """Yield (name, opener) pairs for Streamlit uploads, expanding zip archives
+
+    As for zip members, images over MAX_IMAGE_BYTES get no opener and are
+    reported as errors without being decoded.
+    """
+    for uploaded_file in uploaded_files:
+        if uploaded_file.name.lower().endswith('.zip'):
+            yield from iter_zip_archive(uploaded_file)
+        elif _is_image_name(uploaded_file.name):
+            if _upload_size(uploaded_file) > MAX_IMAGE_BYTES:
+                yield uploaded_file.name, None
+                continue
+            yield uploaded_file.name, (lambda f=uploaded_file: f)
+
+
+def iter_zip_archive(file_or_path):
+    """Yield (name, opener) pairs for every image inside a zip archive
+
+    Members are read one at a time when opened, so the archive is never
+    extracted in full.
+    """
+    archive = zipfile.ZipFile(file_or_path)
+    for info in archive.infolist():
+        if info.is_dir() or not _is_image_name(info.filename):
+            continue
+        if info.file_size > MAX_IMAGE_BYTES:
+            yield info.filename, None
+            continue
+        yield info.filename, (lambda i=info: io.BytesIO(archive.read(i)))
+
+
+def iter_directory(directory):
+    """Yield (path, opener) pairs for every image under a directory, in sorted order"""
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in sorted(files):
+            if _is_image_name(name):
+                path = os.path.join(root, name)
+                yield path, (lambda p=path: p)
+
+
+def iter_labeled_directory(directory, class_names, limit_per_class=None):
+    """Yield (path, class_index) for images in per-class subfolders (directory/<class name>/*.jpg)
+
+    Folder names are matched to class names ignoring case and punctuation;
+    folders that match no class are skipped with a warning.
+    """
+    from disease_info import normalize_name
+
+    index = {normalize_name(name): i for i, name in enumerate(class_names)}
+    for folder in sorted(os.listdir(directory)):
+        folder_path = os.path.join(directory, folder)
+        if not os.path.isdir(folder_path):
+            continue
+        label = index.get(normalize_name(folder))
+        if label is None:
+            print(f"Skipping {folder_path}: not a known class")
+            continue
+        for count, (path, _) in enumerate(iter_directory(folder_path)):
+            if limit_per_class is not None and count >= limit_per_class:
+                break
+            yield path, label
+
+
+def count_sources(uploaded_files=None, directory=None):
+    """Count images without decoding them, for progress reporting"""
+    total = 0
+    for uploaded_file in uploaded_files or []:
+        if uploaded_file.name.lower().endswith('.zip'):
+            with zipfile.ZipFile(uploaded_file) as archive:
+                total += sum(1 for i in archive.infolist() if not i.is_dir() and _is_image_name(i.filename))
+            uploaded_file.seek(0)
+        elif _is_image_name(uploaded_file.name):
+            total += 1
+    if directory:
+        total += sum(1 for _ in iter_directory(directory))
+    return total
+
+
+def iter_preprocessed(sources):
+    """Decode images one at a time at model resolution, yielding (name, uint8 array, error)"""
+    for name, opener in sources:
+        if opener is None:
+            yield name, None, "File too large"
+            continue
+        try:
+            yield name, load_image_reduced(opener()), None
+        except Exception as e:
+            yield name, None, str(e)
+
+
+def batched(iterable, batch_size):
+    """Yield lists of up to batch_size items from an iterable"""
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def classify_stream(model, sources, class_names, batch_size=32, top_k=3, deduplicator=None):
+    """Classify images in fixed-size batches, yielding one result dict per image as batches complete
+
+    Only one batch of decoded images is held in memory at a time, so memory
+    stays flat regardless of how many files are processed. Images below the
+    rejection threshold are reported as UNKNOWN_LABEL.
+
+    With a dedup.Deduplicator, near-duplicates of an earlier image skip the
+    model and reuse its representative's result, with duplicate_of set to
+    the representative's name. Only the representatives' results are kept.
+    """
+    class_names = np.asarray(class_names)
+    buffer = allocate_batch(batch_size)
+    representative_results = {}
+    for batch in batched(iter_preprocessed(sources), batch_size):
+        valid = [item for item in batch if item[2] is None]
+
+        duplicates = []
+        if deduplicator is not None:
+            unique = []
+            for item in valid:
+                representative, _ = deduplicator.add(item[0], item[1])
+                if representative is None:
+                    unique.append(item)
+                else:
+                    duplicates.append((item[0], representative))
+            valid = unique
+
+        predictions = []
+        if valid:
+            try:
+                inputs = preprocess_batch([array for _, array, _ in valid], out=buffer)
+                predictions = np.asarray(model.predict_on_batch(inputs))
+            except Exception as e:
+                failed = {name for name, _, _ in valid}
+                error = f"Failed to classify image: {str(e)}"
+                valid, batch = [], [(item[0], None, error) if item[0] in failed else item for item in batch]
+
+        records = postprocess(predictions, top_k, get_calibration()) if valid else []
+        for (name, _, _), record in zip(valid, records):
+            names = class_names[record['class_id']].tolist()
+            confidences = record['confidence'].tolist()
+            result = {
+                'file': name,
+                'disease': names[0] if record['accepted'] else UNKNOWN_LABEL,
+                'confidence': confidences[0],
+                'top_k': list(zip(names, confidences)),
+                'duplicate_of': None,
+                'error': None,
+            }
+            if deduplicator is not None:
+                representative_results[name] = result
+            yield result
+        for name, representative in duplicates:
+            result = representative_results.get(representative)
+            if result is not None:
+                yield dict(result, file=name, duplicate_of=representative)
+            else:
+                yield {'file': name, 'disease': None, 'confidence': None, 'top_k': [], 'duplicate_of': representative,
+                       'error': f"Near-duplicate of {representative}, which could not be classified"}
+        for name, _, error in batch:
+            if error is not None:
+                yield {'file': name, 'disease': None, 'confidence': None, 'top_k': [], 'duplicate_of': None,
+                       'error': error}
+
+
+class ResultWriter:
+    """Accumulate streamed results as CSV and JSONL text"""
+
+    def __init__(self):
+        self._csv = io.StringIO()
+        self._jsonl = io.StringIO()
+        self._csv_writer = csv.DictWriter(self._csv, fieldnames=RESULT_FIELDS)
+        self._csv_writer.writeheader()
+        self.count = 0
+        self.errors = 0
+
+    def write(self, result):
+        row = dict(result)
+        row['top_k'] = ';'.join(f"{name}:{confidence:.4f}" for name, confidence in result['top_k'])
+        self._csv_writer.writerow(row)
+        self._jsonl.write(json.dumps(result) + '\n')
+        self.count += 1
+        if result['error']:
+            self.errors += 1
+
+    def csv(self):
+        return self._csv.getvalue()
+
+    def jsonl(self):
+        return self._jsonl.getvalue()
+
+
+class ThroughputMeter:
+    """Track images processed per second since the meter was created"""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.count = 0
+
+    def update(self, n=1):
+        self.count += n
+
+    @property
+    def rate(self):
+        elapsed = time.perf_counter() - self.start
+        return self.count / elapsed if elapsed > 0 else 0.0
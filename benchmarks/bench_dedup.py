@@ -0,0 +1,89 @@
+"""Measure near-duplicate detection: hashing cost, index lookups against a linear scan, and model calls saved
+
+Usage: python benchmarks/bench_dedup.py [--data-dir DIR] [--max-distance 8] [--sizes 1000,10000,100000]
+
+With DIR, every image under it is hashed and grouped, and the share of
+model calls a bulk run would save is reported. The index comparison uses
+random 64-bit hashes with planted near-duplicates.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dedup import Deduplicator, HashIndex, hamming, hash_image, DEFAULT_MAX_DISTANCE
+from batch_processing import iter_directory
+from model_utils import load_image_reduced
+
+
+def linear_scan(hashes, value, max_distance):
+    return [i for i, other in enumerate(hashes) if hamming(value, other) <= max_distance]
+
+
+def bench_index(size, max_distance, queries=300, seed=0):
+    """Return (index us/query, linear scan us/query, recall) for an index of size random hashes"""
+    rng = random.Random(seed)
+    hashes = [rng.getrandbits(64) for _ in range(size)]
+    index = HashIndex(max_distance)
+    for value in hashes:
+        index.add(value)
+
+    probes = []
+    for value in rng.sample(hashes, min(queries, size)):
+        for bit in rng.sample(range(64), max_distance):
+            value ^= 1 << bit
+        probes.append(value)
+
+    start = time.perf_counter()
+    found = [index.query(value) for value in probes]
+    index_us = (time.perf_counter() - start) / len(probes) * 1e6
+
+    scanned = probes[:max(len(probes) // 10, 1)]
+    start = time.perf_counter()
+    expected = [linear_scan(hashes, value, max_distance) for value in scanned]
+    scan_us = (time.perf_counter() - start) / len(scanned) * 1e6
+
+    recall = np.mean([set(e) <= {i for i, _ in f} for e, f in zip(expected, found)])
+    return index_us, scan_us, recall
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--data-dir', help='Images to group (searched recursively)')
+    parser.add_argument('--max-distance', type=int, default=DEFAULT_MAX_DISTANCE,
+                        help=f'Hamming distance counted as a duplicate (default: {DEFAULT_MAX_DISTANCE})')
+    parser.add_argument('--method', choices=['phash', 'dhash'], default='phash', help='Hash (default: phash)')
+    parser.add_argument('--sizes', default='1000,10000,100000', help='Index sizes to compare')
+    args = parser.parse_args()
+
+    image = np.random.default_rng(0).integers(0, 256, size=(224, 224, 3), dtype=np.uint8)
+    hash_image(image, args.method)  # import OpenCV before timing
+    start = time.perf_counter()
+    for _ in range(200):
+        hash_image(image, args.method)
+    print(f"{args.method}: {(time.perf_counter() - start) / 200 * 1e6:.0f} us per 224x224 image")
+
+    print(f"{'hashes':>8} {'index us':>10} {'scan us':>10} {'speedup':>8} {'recall':>7}")
+    for size in [int(s) for s in args.sizes.split(',')]:
+        index_us, scan_us, recall = bench_index(size, args.max_distance)
+        print(f"{size:>8} {index_us:>10.1f} {scan_us:>10.1f} {scan_us / index_us:>7.1f}x {recall:>7.2f}")
+
+    if args.data_dir:
+        deduplicator = Deduplicator(args.max_distance, args.method)
+        start = time.perf_counter()
+        for path, _ in iter_directory(args.data_dir):
+            deduplicator.add(path, load_image_reduced(path))
+        stats = deduplicator.stats()
+        print(f"{stats['images']} images in {stats['groups']} groups ({stats['duplicate_groups']} with duplicates): "
+              f"{stats['model_calls_saved']} model calls saved ({stats['saved_fraction'] * 100:.1f}%), "
+              f"{time.perf_counter() - start:.2f}s including decoding")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
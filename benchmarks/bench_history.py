@@ -0,0 +1,109 @@
+"""Measure the diagnosis history: batched insert rate, weekly rate queries and streamed export
+
+Usage: python benchmarks/bench_history.py [--rows 1000000] [--fields 200] [--weeks 52] [--path history.db]
+
+Fills a fresh history with synthetic diagnoses spread over the fields and
+weeks, then times weekly_rates (which reads the weekly_counts rollup)
+against the same query as a GROUP BY over the raw diagnoses, and the
+export of one field's archive.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from history import FIRST_MONDAY, WEEK_SECONDS, HistoryStore, iter_report_archive
+from model_utils import get_class_names
+
+
+def synthetic_rows(count, fields, weeks, num_classes, seed=0):
+    """Rows in HistoryStore.record's layout, spread evenly over fields and the last weeks"""
+    rng = np.random.default_rng(seed)
+    end = time.time()
+    created = np.sort(rng.uniform(end - weeks * WEEK_SECONDS, end, count))
+    field_ids = rng.integers(0, fields, count)
+    top1 = rng.integers(0, num_classes, count)
+    confidence = rng.uniform(0.3, 1.0, count)
+    for i in range(count):
+        yield (float(created[i]), f"field-{field_ids[i]:04d}", None, None, int(top1[i]), float(confidence[i]),
+               int(confidence[i] >= 0.5), json.dumps([[int(top1[i])], [round(float(confidence[i]), 6)]]),
+               'bench', None, 'bench')
+
+
+def timed(fn, repeats=5):
+    """Median milliseconds of fn() over repeats calls, and its last result"""
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = fn()
+        times.append((time.perf_counter() - start) * 1000)
+    return float(np.median(times)), result
+
+
+def naive_rates(store, class_ids, field_id=None):
+    """weekly_rates computed from the diagnoses table instead of the rollup"""
+    placeholders = ', '.join('?' * len(class_ids))
+    where = "WHERE field_id = ?" if field_id is not None else ""
+    return store._query(
+        f"SELECT field_id, CAST((created - {FIRST_MONDAY}) / {WEEK_SECONDS} AS INTEGER) AS week, "
+        f"COUNT(*) AS images, SUM(accepted) AS diagnosed, "
+        f"SUM(CASE WHEN accepted AND top1 IN ({placeholders}) THEN 1 ELSE 0 END) AS matches "
+        f"FROM diagnoses {where} GROUP BY field_id, week",
+        list(class_ids) + ([field_id] if field_id is not None else []))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=1_000_000, help='Synthetic diagnoses (default: 1000000)')
+    parser.add_argument('--fields', type=int, default=200, help='Distinct field ids (default: 200)')
+    parser.add_argument('--weeks', type=int, default=52, help='Weeks the diagnoses span (default: 52)')
+    parser.add_argument('--batch-size', type=int, default=500, help='Rows per write transaction (default: 500)')
+    parser.add_argument('--path', help='History file (default: a temporary file)')
+    args = parser.parse_args()
+
+    class_names = get_class_names()
+    directory = tempfile.TemporaryDirectory()
+    path = args.path or os.path.join(directory.name, 'history.db')
+    store = HistoryStore(path, batch_size=args.batch_size)
+
+    start = time.perf_counter()
+    batch = []
+    for row in synthetic_rows(args.rows, args.fields, args.weeks, len(class_names)):
+        batch.append(row)
+        if len(batch) == args.batch_size:
+            store.write_batch(batch)
+            batch = []
+    if batch:
+        store.write_batch(batch)
+    elapsed = time.perf_counter() - start
+    print(f"insert: {args.rows} rows in {elapsed:.1f}s ({args.rows / elapsed:,.0f} rows/s, "
+          f"batches of {args.batch_size}); {os.path.getsize(path) / 1e6:.0f} MB")
+
+    blight = [class_names.index('Tomato___Late_blight'), class_names.index('Potato___Late_blight')]
+    field = 'field-0000'
+    print(f"{'query':<28} {'rollup ms':>10} {'raw ms':>10} {'speedup':>8}")
+    for name, field_id in [('weekly rates, one field', field), ('weekly rates, all fields', None)]:
+        rollup_ms, rates = timed(lambda: store.weekly_rates(blight, field_id))
+        raw_ms, raw = timed(lambda: naive_rates(store, blight, field_id), repeats=1)
+        assert sum(r['matches'] for r in rates) == sum(r['matches'] for r in raw)
+        print(f"{name:<28} {rollup_ms:>10.2f} {raw_ms:>10.1f} {raw_ms / rollup_ms:>7.0f}x")
+
+    since = time.time() - 12 * WEEK_SECONDS
+    start = time.perf_counter()
+    rows = sum(1 for _ in store.iter_diagnoses(field, since))
+    print(f"read one field, 12 weeks: {rows} rows in {(time.perf_counter() - start) * 1000:.0f} ms")
+
+    start = time.perf_counter()
+    size = sum(len(chunk) for chunk in iter_report_archive(store, class_names, field, since))
+    print(f"export one field, 12 weeks: {size / 1e6:.1f} MB zip in {time.perf_counter() - start:.2f}s")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
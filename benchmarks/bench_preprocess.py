@@ -0,0 +1,148 @@
+"""Compare the original preprocess_image path with the batched, reduced-decode path
+
+Usage: python benchmarks/bench_preprocess.py [--count 32] [--resolution 4000x3000]
+"""
+import argparse
+import io
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from model_utils import load_image_reduced, preprocess_batch, allocate_batch
+
+
+def legacy_preprocess(image):
+    """The preprocess_image implementation this benchmark replaces"""
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    image = image.resize((224, 224))
+    img_array = np.array(image)
+    img_array = img_array.astype(np.float32) / 255.0
+    return np.expand_dims(img_array, axis=0)
+
+
+def write_jpegs(directory, count, width, height):
+    """Encode synthetic photos with smooth gradients and noise, like a real leaf photo"""
+    rng = np.random.default_rng(0)
+    y, x = np.mgrid[0:height, 0:width]
+    base = np.stack([x * 200 // width, y * 200 // height, (x + y) * 200 // (width + height)], axis=-1)
+    for i in range(count):
+        pixels = (base + rng.integers(0, 48, size=(height, width, 3))).astype(np.uint8)
+        Image.fromarray(pixels).save(os.path.join(directory, f'{i:04d}.jpg'), format='JPEG', quality=90)
+
+
+def run_legacy(payloads, batch_size):
+    for start in range(0, len(payloads), batch_size):
+        arrays = [legacy_preprocess(Image.open(io.BytesIO(p))) for p in payloads[start:start + batch_size]]
+        np.concatenate(arrays)
+
+
+def run_batched(payloads, batch_size):
+    buffer = allocate_batch(batch_size)
+    for start in range(0, len(payloads), batch_size):
+        images = [load_image_reduced(io.BytesIO(p)) for p in payloads[start:start + batch_size]]
+        preprocess_batch(images, out=buffer)
+
+
+def current_rss_mb():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+
+
+class RSSSampler:
+    """Sample resident memory in the background and keep the peak above the starting point
+
+    ru_maxrss cannot be used here because importing TensorFlow alone sets a
+    peak far above anything preprocessing allocates.
+    """
+
+    def __init__(self, interval=0.001):
+        self.interval = interval
+        self.baseline = current_rss_mb()
+        self.peak = self.baseline
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, current_rss_mb())
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+    @property
+    def growth(self):
+        return self.peak - self.baseline
+
+
+VARIANTS = {
+    'legacy': ('legacy preprocess_image', run_legacy),
+    'batched': ('draft decode + batch buffer', run_batched),
+}
+
+
+def measure(variant, payloads, batch_size):
+    """Time one variant and report its peak numpy/Python allocations and RSS growth"""
+    label, func = VARIANTS[variant]
+    func(payloads[:batch_size], batch_size)  # warm caches and lazy imports
+
+    start = time.perf_counter()
+    func(payloads, batch_size)
+    elapsed = time.perf_counter() - start
+
+    # RSS also counts the full-resolution decode buffers allocated inside PIL,
+    # which tracemalloc cannot see
+    tracemalloc.start()
+    with RSSSampler() as rss:
+        func(payloads, batch_size)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(f"{label:<28} {elapsed / len(payloads) * 1000:9.2f} ms/image "
+          f"{peak / (1024 * 1024):8.1f} MB peak traced {rss.growth:8.1f} MB peak RSS growth")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--count', type=int, default=32, help='Number of synthetic images (default: 32)')
+    parser.add_argument('--batch-size', type=int, default=16, help='Images per batch (default: 16)')
+    parser.add_argument('--resolution', default='4000x3000', help='WIDTHxHEIGHT of the synthetic JPEGs')
+    parser.add_argument('--only', choices=sorted(VARIANTS), help=argparse.SUPPRESS)
+    parser.add_argument('--image-dir', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.only is not None:
+        payloads = []
+        for name in sorted(os.listdir(args.image_dir)):
+            with open(os.path.join(args.image_dir, name), 'rb') as f:
+                payloads.append(f.read())
+        measure(args.only, payloads, args.batch_size)
+        return
+
+    width, height = (int(v) for v in args.resolution.split('x'))
+    with tempfile.TemporaryDirectory() as image_dir:
+        write_jpegs(image_dir, args.count, width, height)
+        print(f"{args.count} synthetic {width}x{height} JPEGs, batch size {args.batch_size}")
+
+        # Each variant runs in its own process so peak RSS is not shared between them
+        for variant in VARIANTS:
+            subprocess.run([sys.executable, os.path.abspath(__file__), '--only', variant,
+                            '--image-dir', image_dir, '--batch-size', str(args.batch_size)], check=True)
+
+
+if __name__ == '__main__':
+    main()
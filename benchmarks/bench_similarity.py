@@ -0,0 +1,92 @@
+"""Measure the similarity index: bulk and incremental inserts, training, and search latency and recall
+
+Usage: python benchmarks/bench_similarity.py [--vectors 1000000] [--dim 256] [--nprobe 4,8,16,32] [--path DIR]
+
+Synthetic embeddings are drawn around random cluster centres, like
+features of photos of the same few dozen diseases. Recall@10 is measured
+against an exact search over the same float16 vectors.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from similarity import SimilarityIndex, normalize
+
+
+def synthetic_embeddings(count, dim, clusters=400, seed=0):
+    """Yield (embeddings, class ids) batches of clustered vectors"""
+    rng = np.random.default_rng(seed)
+    centres = rng.normal(size=(clusters, dim)).astype(np.float32)
+    for start in range(0, count, 10000):
+        labels = rng.integers(0, clusters, min(10000, count - start))
+        yield centres[labels] + 0.6 * rng.normal(size=(len(labels), dim)).astype(np.float32), labels % 38
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--vectors', type=int, default=1_000_000, help='Vectors to index (default: 1000000)')
+    parser.add_argument('--dim', type=int, default=256, help='Embedding size (default: 256)')
+    parser.add_argument('--nprobe', default='4,8,16,32', help='Lists searched per query to compare')
+    parser.add_argument('--queries', type=int, default=200, help='Search queries per setting (default: 200)')
+    parser.add_argument('--path', help='Index directory (default: a temporary directory)')
+    args = parser.parse_args()
+
+    directory = tempfile.TemporaryDirectory()
+    index = SimilarityIndex(args.path or os.path.join(directory.name, 'index'), train_size=None)
+    sha = '00' * 32
+
+    start = time.perf_counter()
+    batches = synthetic_embeddings(args.vectors, args.dim)
+    first, labels = next(batches)
+    index.add(first, labels, [sha] * len(first))
+    index.train()
+    train_seconds = time.perf_counter() - start
+    for embeddings, labels in batches:
+        index.add(embeddings, labels, [sha] * len(embeddings))
+    elapsed = time.perf_counter() - start
+    stats = index.stats()
+    print(f"bulk insert: {stats['vectors']} x {stats['dim']} in {elapsed:.1f}s "
+          f"({stats['vectors'] / elapsed:,.0f} vectors/s, training on the first batch {train_seconds:.1f}s); "
+          f"{stats['lists']} lists, {stats['bytes'] / 1e6:.0f} MB on disk")
+
+    start = time.perf_counter()
+    index.train()
+    print(f"retrain on all vectors: {time.perf_counter() - start:.1f}s")
+
+    rng = np.random.default_rng(1)
+    timings = []
+    for _ in range(200):
+        vector = rng.normal(size=(1, args.dim))
+        start = time.perf_counter()
+        index.add(vector, [0], [sha])
+        timings.append((time.perf_counter() - start) * 1000)
+    print(f"incremental insert: p50 {np.percentile(timings, 50):.2f} ms, p99 {np.percentile(timings, 99):.2f} ms")
+
+    queries = normalize(next(synthetic_embeddings(args.queries, args.dim, seed=2))[0])
+    exact = []
+    for query in queries[:50]:
+        scores = np.concatenate([np.asarray(index._vectors[i:i + 65536], dtype=np.float32) @ query
+                                 for i in range(0, index.count, 65536)])
+        exact.append(set(np.argpartition(-scores, 9)[:10]))
+
+    print(f"{'nprobe':>6} {'p50 ms':>8} {'p99 ms':>8} {'recall@10':>10}")
+    for nprobe in [int(n) for n in args.nprobe.split(',')]:
+        timings, found = [], []
+        for query in queries:
+            start = time.perf_counter()
+            results = index.search(query, 10, nprobe)
+            timings.append((time.perf_counter() - start) * 1000)
+            found.append({result['id'] for result in results})
+        recall = np.mean([len(truth & got) / 10 for truth, got in zip(exact, found)])
+        print(f"{nprobe:>6} {np.percentile(timings, 50):>8.2f} {np.percentile(timings, 99):>8.2f} {recall:>10.3f}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,89 @@
+"""Compare accuracy gain against latency cost of test-time augmentation for K = 1, 4 and 8
+
+Usage: python benchmarks/bench_tta.py [--model plant_disease_model.keras] [--data-dir DIR]
+
+DIR holds one sub-folder per class, named exactly as in get_class_names().
+Without it only latency is measured, on synthetic images.
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from model_utils import (
+    create_model, get_class_names, load_image_reduced, preprocess_batch, augmentation_views
+)
+from batch_processing import iter_directory
+
+VIEW_COUNTS = [1, 4, 8]
+
+
+def load_labelled(data_dir, limit):
+    """Return (uint8 images, labels) for up to limit images from class sub-folders"""
+    index = {name: i for i, name in enumerate(get_class_names())}
+    images, labels = [], []
+    for path, _ in iter_directory(data_dir):
+        label = index.get(os.path.basename(os.path.dirname(path)))
+        if label is None:
+            continue
+        images.append(load_image_reduced(path))
+        labels.append(label)
+        if len(images) >= limit:
+            break
+    return images, np.array(labels)
+
+
+def classify_tta(model, image, num_views):
+    """One predict call on num_views views, averaged; returns the class probabilities"""
+    views = augmentation_views(preprocess_batch([image]), num_views)
+    return np.asarray(model.predict_on_batch(views)).mean(axis=0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--model', default='plant_disease_model.keras', help='Path to the .keras model')
+    parser.add_argument('--data-dir', help='Labelled images, one sub-folder per class')
+    parser.add_argument('--limit', type=int, default=500, help='Maximum labelled images (default: 500)')
+    parser.add_argument('--runs', type=int, default=50, help='Latency samples per K (default: 50)')
+    args = parser.parse_args()
+
+    model = create_model(args.model)
+
+    if args.data_dir:
+        images, labels = load_labelled(args.data_dir, args.limit)
+        if not images:
+            print(f"No labelled images found under {args.data_dir}")
+            return 1
+    else:
+        rng = np.random.default_rng(0)
+        images = [rng.integers(0, 256, size=(224, 224, 3), dtype=np.uint8) for _ in range(8)]
+        labels = None
+
+    print(f"{'K':>3} {'p50 ms':>9} {'p95 ms':>9} {'vs K=1':>8} {'accuracy':>9}")
+    baseline_ms = None
+    for num_views in VIEW_COUNTS:
+        classify_tta(model, images[0], num_views)  # trace this batch shape before timing
+
+        latencies = []
+        for i in range(args.runs):
+            start = time.perf_counter()
+            classify_tta(model, images[i % len(images)], num_views)
+            latencies.append((time.perf_counter() - start) * 1000)
+        p50, p95 = np.percentile(latencies, [50, 95])
+        baseline_ms = baseline_ms or p50
+
+        accuracy = ''
+        if labels is not None:
+            predicted = [int(np.argmax(classify_tta(model, image, num_views))) for image in images]
+            accuracy = f"{np.mean(np.array(predicted) == labels) * 100:8.1f}%"
+
+        print(f"{num_views:>3} {p50:9.2f} {p95:9.2f} {p50 / baseline_ms:7.2f}x {accuracy:>9}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,116 @@
+"""Show the cold-request penalty with and without warm-up, and retracing under varying batch sizes
+
+Usage: python benchmarks/bench_warmup.py [--model plant_disease_model.keras] [--engines keras,function]
+                                         [--xla off,on,auto]
+
+Each scenario runs in a fresh Python process, so nothing traced by an
+earlier scenario is reused. For every engine it reports the latency of the
+first request after loading (without warm-up, then after warm_up), the
+steady-state latency, and p50/p99 over requests with random batch sizes
+(1-64), where a retrace shows up as a latency spike. A small stand-in
+model is generated when the .keras file is missing.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+os.environ.setdefault('CUDA_VISIBLE_DEVICES', '')
+os.environ.setdefault('TF_CPP_MIN_LOG_LEVEL', '2')
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def run_scenario(model_path, engine, warm, xla):
+    """Measure one scenario in this process and return its timings"""
+    os.environ['INFERENCE_XLA'] = xla
+    from inference_engines import create_engine
+
+    start = time.perf_counter()
+    model = create_engine(model_path, engine)
+    load_seconds = time.perf_counter() - start
+
+    warmup_seconds = 0.0
+    if warm:
+        start = time.perf_counter()
+        model.warm_up()
+        warmup_seconds = time.perf_counter() - start
+
+    image = np.random.default_rng(0).random((1, 224, 224, 3), dtype=np.float32)
+    start = time.perf_counter()
+    model.predict_on_batch(image)
+    first_ms = (time.perf_counter() - start) * 1000
+
+    steady = []
+    for _ in range(20):
+        start = time.perf_counter()
+        model.predict_on_batch(image)
+        steady.append((time.perf_counter() - start) * 1000)
+
+    rng = np.random.default_rng(1)
+    varying = []
+    for size in rng.integers(1, 65, 40):
+        batch = rng.random((size, 224, 224, 3), dtype=np.float32)
+        start = time.perf_counter()
+        model.predict_on_batch(batch)
+        varying.append((time.perf_counter() - start) * 1000 / size)
+
+    return {
+        'load_s': load_seconds,
+        'warmup_s': warmup_seconds,
+        'first_ms': first_ms,
+        'steady_ms': float(np.median(steady)),
+        'varying_p50_ms': float(np.percentile(varying, 50)),
+        'varying_p99_ms': float(np.percentile(varying, 99)),
+        'xla': bool(getattr(model, 'jit_compile', False)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--model', default='plant_disease_model.keras', help='Path to the .keras model')
+    parser.add_argument('--engines', default='keras,function', help='Engines to compare (default: keras,function)')
+    parser.add_argument('--xla', default='off,auto', help='INFERENCE_XLA modes for the function engine')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        engine, warm, xla = args.child.split(':')
+        print(json.dumps(run_scenario(args.model, engine, warm == 'warm', xla)))
+        return 0
+
+    model_path = args.model
+    if not os.path.exists(model_path):
+        from run_benchmarks import make_standin_model
+        model_path = make_standin_model(os.path.join(tempfile.mkdtemp(), 'standin.keras'))
+        print(f"{args.model} not found; using a stand-in model")
+
+    scenarios = []
+    for engine in args.engines.split(','):
+        for xla in (args.xla.split(',') if engine == 'function' else ['off']):
+            scenarios += [(engine, 'cold', xla), (engine, 'warm', xla)]
+
+    print(f"{'engine':>9} {'xla':>5} {'warm-up':>8} {'first ms':>9} {'steady ms':>10} "
+          f"{'vary p50':>9} {'vary p99':>9}  (vary: ms per image, random batch sizes)")
+    for engine, warm, xla in scenarios:
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--model', model_path, '--child', f"{engine}:{warm}:{xla}"],
+            capture_output=True, text=True, check=True,
+        ).stdout.strip().splitlines()[-1]
+        result = json.loads(output)
+        label = xla if engine == 'function' else '-'
+        if xla == 'auto':
+            label = f"auto:{'on' if result['xla'] else 'off'}"
+        warm_label = f"{result['warmup_s']:.2f}s" if warm == 'warm' else 'none'
+        print(f"{engine:>9} {label:>5} {warm_label:>8} {result['first_ms']:>9.1f} {result['steady_ms']:>10.2f} "
+              f"{result['varying_p50_ms']:>9.2f} {result['varying_p99_ms']:>9.2f}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
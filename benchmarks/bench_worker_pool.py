@@ -0,0 +1,158 @@
+"""Measure how worker-pool throughput scales with the number of worker processes
+
+Usage:
+    python benchmarks/bench_worker_pool.py --workers 1,2,4,8,16,32 --images 2048
+    python benchmarks/bench_worker_pool.py --workers 4,8 --cores-per-worker 4 --out scaling.json
+
+For each worker count, starts a WorkerPool (workers pinned to disjoint
+core subsets), submits every synthetic image at once so the queue never
+runs dry, and reports images/sec, speedup and parallel efficiency
+against the smallest worker count, and per-worker memory split into private (RssAnon)
+and shared file-backed (RssFile, which includes the memory-mapped
+weights) pages, plus PSS, which charges each worker its share of the
+shared pages. The pool runs the builtin kernels by default; --xnnpack
+shows what XNNPACK's private copy of the weights costs per worker.
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+os.environ.setdefault('CUDA_VISIBLE_DEVICES', '')
+os.environ.setdefault('TF_CPP_MIN_LOG_LEVEL', '2')
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from worker_pool import WorkerPool, shared_model_path
+
+
+def process_memory_mb(pid):
+    """Return (private, file-backed) resident memory of a process in MB"""
+    memory = {}
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith(('RssAnon:', 'RssFile:', 'RssShmem:')):
+                    key, value = line.split(':')
+                    memory[key] = int(value.split()[0]) / 1024
+    except OSError:
+        pass
+    return memory.get('RssAnon', 0.0), memory.get('RssFile', 0.0) + memory.get('RssShmem', 0.0)
+
+
+def process_pss_mb(pid):
+    """Return a process's proportional set size in MB (shared pages split between their users)"""
+    try:
+        with open(f'/proc/{pid}/smaps_rollup') as f:
+            for line in f:
+                if line.startswith('Pss:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return 0.0
+
+
+def run_scaling(model_path, num_workers, images, cores_per_worker, batch_size, use_xnnpack, rounds):
+    with WorkerPool(model_path, num_workers=num_workers, cores_per_worker=cores_per_worker,
+                    max_batch_size=batch_size, num_slots=len(images), use_xnnpack=use_xnnpack) as pool:
+        # One warm-up round so every worker has allocated its batch tensors
+        for future in [pool.submit(image) for image in images[:num_workers * batch_size]]:
+            future.result()
+
+        rates = []
+        for _ in range(rounds):
+            start = time.perf_counter()
+            futures = [pool.submit(image) for image in images]
+            for future in futures:
+                future.result()
+            rates.append(len(images) / (time.perf_counter() - start))
+
+        pids = [pid for pid in pool.stats()['pids'] if pid]
+        memory = [process_memory_mb(pid) for pid in pids]
+        pss = [process_pss_mb(pid) for pid in pids]
+        return {
+            'workers': num_workers,
+            'core_sets': pool.core_sets,
+            'images_per_s': float(np.median(rates)),
+            'avg_batch_size': pool.stats()['avg_batch_size'],
+            'private_mb_per_worker': float(np.mean([m[0] for m in memory])) if memory else 0.0,
+            'shared_mb_per_worker': float(np.mean([m[1] for m in memory])) if memory else 0.0,
+            'pss_mb_per_worker': float(np.mean(pss)) if pss else 0.0,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--model', default='plant_disease_model.keras',
+                        help='Keras or TFLite model; a stand-in is generated when it does not exist')
+    parser.add_argument('--workers', default='1,2,4,8,16,32', help='Comma-separated worker counts to try')
+    parser.add_argument('--cores-per-worker', type=int, help='Cores per worker (default: split evenly)')
+    parser.add_argument('--batch-size', type=int, default=16, help='Maximum batch per worker (default: 16)')
+    parser.add_argument('--images', type=int, default=1024, help='Images per timed round (default: 1024)')
+    parser.add_argument('--rounds', type=int, default=3, help='Timed rounds per worker count (default: 3)')
+    parser.add_argument('--xnnpack', action='store_true',
+                        help='Use the XNNPACK delegate, which repacks the weights privately in every worker')
+    parser.add_argument('--out', help='Where to write the JSON results')
+    args = parser.parse_args()
+
+    cores = len(os.sched_getaffinity(0))
+    counts = [int(n) for n in args.workers.split(',') if int(n) <= cores]
+    skipped = [int(n) for n in args.workers.split(',') if int(n) > cores]
+    if skipped:
+        print(f"Skipping {skipped}: only {cores} cores available")
+    if not counts:
+        counts = [1]
+
+    rng = np.random.default_rng(0)
+    images = list(rng.integers(0, 256, size=(args.images, 224, 224, 3), dtype=np.uint8))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        model_path = args.model
+        standin = not os.path.exists(model_path)
+        if standin:
+            from run_benchmarks import make_standin_model
+            model_path = make_standin_model(os.path.join(tmp, 'standin_model.keras'))
+            print(f"{args.model} not found, using a generated stand-in model")
+        model_path = shared_model_path(model_path)
+
+        results = []
+        for num_workers in counts:
+            result = run_scaling(model_path, num_workers, images, args.cores_per_worker, args.batch_size,
+                                 args.xnnpack, args.rounds)
+            # Relative to the smallest worker count tried
+            first = results[0] if results else result
+            result['speedup'] = result['images_per_s'] / first['images_per_s']
+            result['efficiency'] = result['speedup'] / (num_workers / first['workers'])
+            results.append(result)
+            print(f"{num_workers:>3} workers  {result['images_per_s']:9.1f} img/s  "
+                  f"speedup {result['speedup']:5.2f}x  efficiency {result['efficiency']:6.1%}  "
+                  f"private {result['private_mb_per_worker']:7.1f} MB  "
+                  f"shared {result['shared_mb_per_worker']:7.1f} MB  "
+                  f"PSS {result['pss_mb_per_worker']:7.1f} MB per worker")
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump({
+                'meta': {
+                    'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                    'machine': platform.machine(),
+                    'processor': platform.processor(),
+                    'cpu_count': cores,
+                    'model': args.model,
+                    'standin_model': standin,
+                    'xnnpack': args.xnnpack,
+                    'batch_size': args.batch_size,
+                },
+                'results': results,
+            }, f, indent=2)
+        print(f"Wrote {args.out}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
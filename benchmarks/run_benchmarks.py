@@ -0,0 +1,307 @@
+"""Reproducible CPU benchmark suite for the inference pipeline with regression gates
+
+Usage:
+    python benchmarks/run_benchmarks.py --out bench.json
+    python benchmarks/run_benchmarks.py --out new.json --baseline bench.json --max-regression 0.15
+
+Covers preprocess_image, the model forward pass, calibrated top-k postprocessing,
+get_disease_info, an end-to-end classification and tiled analysis of a
+field photo with varying leaf cover, over synthetic images
+at several resolutions and batch sizes. Reports p50/p95/p99 latency,
+throughput and each case's RSS growth. With --baseline, exits non-zero when any case is
+slower (or has lower throughput) than the baseline by more than the
+allowed fraction. Runs offline on CPU; when the real model file is
+missing a small stand-in model with the same input and output shapes is
+generated.
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import resource
+import sys
+import tempfile
+import threading
+import time
+
+# Benchmarks must be comparable across machines with and without GPUs
+os.environ.setdefault('CUDA_VISIBLE_DEVICES', '')
+os.environ.setdefault('TF_CPP_MIN_LOG_LEVEL', '2')
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from model_utils import preprocess_image, preprocess_batch, get_class_names
+from disease_info import get_disease_info
+from inference_engines import create_engine
+from inference_scheduler import InferenceScheduler
+from postprocessing import Calibration, postprocess
+from utils import ImageUpload
+from tiling import DEFAULT_MAX_SIDE, classify_tiled
+
+RESOLUTIONS = [(640, 480), (1920, 1080), (4000, 3000)]
+# Share of a 4000x3000 field photo covered by leaves in the tiled cases
+LEAF_FRACTIONS = [0.1, 0.5, 1.0]
+BATCH_SIZES = [1, 8, 32]
+# Metrics where a higher value is a regression
+LATENCY_METRICS = ['p50_ms', 'p95_ms', 'p99_ms']
+
+
+def current_rss_mb():
+    """Resident memory now; where /proc is missing, the process peak (ru_maxrss) is the best available"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+    except OSError:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / (1024 * 1024) if platform.system() == 'Darwin' else peak / 1024
+
+
+class RSSSampler:
+    """Track the highest resident memory seen while a case runs
+
+    ru_maxrss is the peak over the whole process, so after the first large
+    case (or the TensorFlow import) every later case would report the same
+    number.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.baseline = current_rss_mb()
+        self.peak = self.baseline
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, current_rss_mb())
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        # Cases shorter than the interval still get one sample
+        self.peak = max(self.peak, current_rss_mb())
+
+    @property
+    def growth(self):
+        return self.peak - self.baseline
+
+
+def make_standin_model(path, seed=0):
+    """Save a small CNN with the real model's input and output shapes"""
+    import tensorflow as tf
+
+    tf.keras.utils.set_random_seed(seed)
+    model = tf.keras.Sequential([
+        tf.keras.Input((224, 224, 3)),
+        tf.keras.layers.Conv2D(16, 3, strides=2, activation='relu'),
+        tf.keras.layers.Conv2D(32, 3, strides=2, activation='relu'),
+        tf.keras.layers.Conv2D(64, 3, strides=2, activation='relu'),
+        tf.keras.layers.GlobalAveragePooling2D(),
+        tf.keras.layers.Dense(len(get_class_names()), activation='softmax'),
+    ])
+    model.save(path)
+    return path
+
+
+def synthetic_image(width, height, seed=0):
+    """A smooth gradient with noise, which compresses and decodes like a real photo"""
+    rng = np.random.default_rng(seed)
+    y = np.linspace(0, 160, height, dtype=np.float32)[:, None, None]
+    x = np.linspace(0, 160, width, dtype=np.float32)[None, :, None]
+    pixels = (x + y + rng.integers(0, 64, size=(height, width, 3))).clip(0, 255).astype(np.uint8)
+    return Image.fromarray(pixels)
+
+
+def field_image(width, height, leaf_fraction, seed=0):
+    """Soil-coloured noise with a green block covering leaf_fraction of the frame"""
+    rng = np.random.default_rng(seed)
+    pixels = (np.array([120, 95, 70]) + rng.integers(-20, 20, size=(height, width, 3))).astype(np.uint8)
+    side = np.sqrt(leaf_fraction)
+    pixels[:round(height * side), :round(width * side)] = (50, 150, 45)
+    return Image.fromarray(pixels)
+
+
+def jpeg_bytes(image):
+    buffer = io.BytesIO()
+    image.save(buffer, format='JPEG', quality=90)
+    return buffer.getvalue()
+
+
+def run_case(func, items_per_call=1, iterations=50, warmup=3, min_seconds=0.0):
+    """Time func repeatedly and summarize its latency distribution and RSS growth
+
+    The growth includes the warm-up calls, so memory a case allocates once
+    (buffers, traced graphs) is counted.
+    """
+    with RSSSampler() as rss:
+        for _ in range(warmup):
+            func()
+
+        latencies = []
+        start = time.perf_counter()
+        while len(latencies) < iterations or time.perf_counter() - start < min_seconds:
+            call_start = time.perf_counter()
+            func()
+            latencies.append(time.perf_counter() - call_start)
+        total = time.perf_counter() - start
+
+    latencies_ms = np.array(latencies) * 1000
+    p50, p95, p99 = np.percentile(latencies_ms, [50, 95, 99])
+    return {
+        'iterations': len(latencies),
+        'p50_ms': float(p50),
+        'p95_ms': float(p95),
+        'p99_ms': float(p99),
+        'throughput_per_s': len(latencies) * items_per_call / total,
+        'rss_growth_mb': rss.growth,
+    }
+
+
+def benchmark_suite(model, iterations):
+    """Yield (case name, result) for every benchmark case"""
+    class_names = get_class_names()
+    images = {f"{w}x{h}": synthetic_image(w, h) for w, h in RESOLUTIONS}
+
+    for label, image in images.items():
+        yield f"preprocess_image[{label}]", run_case(lambda: preprocess_image(image), iterations=iterations)
+
+    rng = np.random.default_rng(0)
+    class_names_array = np.asarray(class_names)
+    calibration = Calibration(temperature=1.5, threshold=0.5)
+    for batch_size in BATCH_SIZES:
+        batch = rng.random((batch_size, 224, 224, 3), dtype=np.float32)
+        yield f"forward[batch={batch_size}]", run_case(
+            lambda: model.predict_on_batch(batch), items_per_call=batch_size, iterations=iterations)
+
+    for batch_size in BATCH_SIZES:
+        predictions = rng.random((batch_size, len(class_names)), dtype=np.float32)
+
+        def top_k():
+            records = postprocess(predictions, 3, calibration)
+            class_names_array[records['class_id']]
+
+        yield f"top_k[batch={batch_size}]", run_case(top_k, items_per_call=batch_size, iterations=iterations * 10)
+
+    for name in ['Tomato___Late_blight', 'Grape___healthy', 'Peach___Bacterial_spot']:
+        yield f"get_disease_info[{name}]", run_case(lambda: get_disease_info(name), iterations=iterations * 10)
+
+    # End to end: header validation, single decode, preprocessing, scheduled
+    # inference and disease information for the top-3 results
+    scheduler = InferenceScheduler(max_batch_size=16, max_latency_ms=1)
+    for label, image in images.items():
+        payload = jpeg_bytes(image)
+
+        def classify():
+            upload = ImageUpload(payload).validate()
+            record = scheduler.predict(model, preprocess_batch([upload.image]), top_k=3)
+            return [(class_names[idx], confidence, get_disease_info(class_names[idx]))
+                    for idx, confidence in zip(record['class_id'], record['confidence'])]
+
+        yield f"classify_image[{label}]", run_case(classify, iterations=iterations)
+
+    # Tiled analysis of a JPEG field photo as in the app; tiles without
+    # vegetation are skipped, so the cost should follow leaf cover
+    for fraction in LEAF_FRACTIONS:
+        payload = jpeg_bytes(field_image(4000, 3000, fraction))
+
+        def classify_tiles():
+            upload = ImageUpload(payload).validate()
+            return classify_tiled(model, upload.decode_at(DEFAULT_MAX_SIDE), calibration=calibration)
+
+        yield f"classify_tiled[leaf={fraction:.0%}]", run_case(classify_tiles, iterations=max(iterations // 5, 3))
+
+
+def compare(results, baseline, max_regression, min_delta_ms=0.05):
+    """Return human-readable regressions of results against a baseline run
+
+    Latency changes smaller than min_delta_ms are ignored, so microsecond
+    cases such as dictionary lookups do not fail on timer noise.
+    """
+    regressions = []
+    for case, current in results.items():
+        previous = baseline.get('results', {}).get(case)
+        if previous is None:
+            continue
+        for metric in LATENCY_METRICS:
+            slower = current[metric] - previous[metric]
+            if slower > min_delta_ms and current[metric] > previous[metric] * (1 + max_regression):
+                regressions.append(f"{case}: {metric} {previous[metric]:.3f} -> {current[metric]:.3f}")
+        if (current['p50_ms'] - previous['p50_ms'] > min_delta_ms
+                and current['throughput_per_s'] < previous['throughput_per_s'] * (1 - max_regression)):
+            regressions.append(f"{case}: throughput_per_s {previous['throughput_per_s']:.1f} "
+                               f"-> {current['throughput_per_s']:.1f}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--model', default='plant_disease_model.keras',
+                        help='Model to benchmark; a stand-in is generated when it does not exist')
+    parser.add_argument('--engine', help='Inference engine (default: inferred from the model path)')
+    parser.add_argument('--iterations', type=int, default=50, help='Timed calls per case (default: 50)')
+    parser.add_argument('--out', default='benchmark_results.json', help='Where to write the JSON results')
+    parser.add_argument('--baseline', help='Previous results JSON to compare against')
+    parser.add_argument('--max-regression', type=float, default=0.15,
+                        help='Allowed fractional slowdown before failing (default: 0.15)')
+    parser.add_argument('--min-delta-ms', type=float, default=0.05,
+                        help='Ignore latency changes smaller than this (default: 0.05)')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        model_path = args.model
+        standin = not os.path.exists(model_path)
+        if standin:
+            model_path = make_standin_model(os.path.join(tmp, 'standin_model.keras'))
+            print(f"{args.model} not found, using a generated stand-in model")
+        model = create_engine(model_path, args.engine)
+
+        results = {}
+        for case, result in benchmark_suite(model, args.iterations):
+            results[case] = result
+            print(f"{case:<40} p50 {result['p50_ms']:9.3f} ms  p95 {result['p95_ms']:9.3f} ms  "
+                  f"p99 {result['p99_ms']:9.3f} ms  {result['throughput_per_s']:10.1f}/s  "
+                  f"RSS +{result['rss_growth_mb']:6.1f} MB")
+
+    report = {
+        'meta': {
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'processor': platform.processor(),
+            'cpu_count': os.cpu_count(),
+            'model': args.model,
+            'standin_model': standin,
+            'engine': getattr(model, 'kind', None),
+            'iterations': args.iterations,
+        },
+        'results': results,
+    }
+    with open(args.out, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {args.out}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('meta', {}).get('standin_model') != standin:
+            print("Warning: baseline and current run used different models", file=sys.stderr)
+        regressions = compare(results, baseline, args.max_regression, args.min_delta_ms)
+        if regressions:
+            print(f"{len(regressions)} regression(s) beyond {args.max_regression:.0%}:")
+            for regression in regressions:
+                print(f"  {regression}")
+            return 1
+        print(f"No regressions beyond {args.max_regression:.0%} against {args.baseline}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,282 @@
+"""Confidence-gated model cascade: a small student answers, the full model only when it is unsure
+
+Most uploads are clear-cut, so a distilled MobileNet-sized student handles
+them. Images whose calibrated student top-1 confidence falls below a
+threshold escalate to the full (teacher) model. The cascade is described
+by a JSON file:
+
+    {"student": "plant_disease_student.keras", "teacher": "plant_disease_model.keras",
+     "temperature": 1.3, "threshold": 0.82, "report": {...}}
+
+Load it with INFERENCE_ENGINE=cascade MODEL_PATH=cascade.json; it then
+behaves like any other engine for the registry, scheduler and batch
+pipelines. `python -m plant_classifier distill` trains the student from the
+current model and writes both files.
+
+The cascade returns raw student probabilities for the images it does not
+escalate, and the scheduler calibrates every output with the one
+calibration file (postprocessing.py). That file must therefore be fitted on
+the cascade's own output, not the full model's:
+
+    python -m plant_classifier calibrate val/ --model cascade.json --engine cascade
+"""
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+from inference_engines import InferenceEngine, create_engine
+from metrics import get_metrics
+from postprocessing import Calibration, apply_temperature
+
+DEFAULT_CASCADE_PATH = 'cascade.json'
+DEFAULT_STUDENT_PATH = 'plant_disease_student.keras'
+
+
+class CascadeEngine(InferenceEngine):
+    """Run the student on every image and the teacher only on the uncertain ones
+
+    The student temperature only decides escalation; outputs are returned
+    uncalibrated (see the module docstring on calibrating the cascade).
+    """
+
+    kind = 'cascade'
+
+    def __init__(self, student, teacher, temperature=1.0, threshold=0.9):
+        self.student = student
+        self.teacher = teacher
+        self.temperature = float(temperature)
+        self.threshold = float(threshold)
+        self.images = 0
+        self.escalated = 0
+        self._lock = threading.Lock()
+
+    def predict_on_batch(self, batch):
+        batch = np.asarray(batch, dtype=np.float32)
+        probabilities = np.asarray(self.student.predict_on_batch(batch), dtype=np.float32)
+        confidence = apply_temperature(probabilities, self.temperature).max(axis=1)
+        escalate = np.nonzero(confidence < self.threshold)[0]
+        if len(escalate):
+            probabilities = probabilities.copy()
+            probabilities[escalate] = self.teacher.predict_on_batch(batch[escalate])
+
+        with self._lock:
+            self.images += len(batch)
+            self.escalated += len(escalate)
+        metrics = get_metrics()
+        metrics.counter('plant_cascade_images_total', 'Images answered by each cascade stage').inc(
+            len(batch) - len(escalate), stage='student')
+        metrics.counter('plant_cascade_images_total').inc(len(escalate), stage='teacher')
+        return probabilities
+
+    @property
+    def size_bytes(self):
+        return self.student.size_bytes + self.teacher.size_bytes
+
+    def warm_up(self, steady_runs=3):
+        """Warm up both models; the reported latency is the student's, which most requests see"""
+        self.teacher.warm_up(steady_runs)
+        self.warmup_latency = self.student.warm_up(steady_runs)
+        return self.warmup_latency
+
+    def stats(self):
+        return {
+            'images': self.images,
+            'escalated': self.escalated,
+            'escalation_rate': self.escalated / self.images if self.images else 0.0,
+            'threshold': self.threshold,
+        }
+
+
+def stage_engine(path, kind=None):
+    """Engine kind for a cascade stage: the given one, else inferred from the file name
+
+    Never taken from INFERENCE_ENGINE, which is 'cascade' when the cascade
+    itself is being loaded.
+    """
+    return kind or ('tflite' if path.endswith('.tflite') else 'function' if os.path.isdir(path) else 'keras')
+
+
+def load_cascade(path=DEFAULT_CASCADE_PATH):
+    """Build a CascadeEngine from a cascade JSON file; model paths are relative to the file"""
+    try:
+        with open(path) as f:
+            config = json.load(f)
+        base = os.path.dirname(os.path.abspath(path))
+        student_path = os.path.join(base, config['student'])
+        teacher_path = os.path.join(base, config['teacher'])
+        student = create_engine(student_path, stage_engine(student_path, config.get('student_engine')))
+        teacher = create_engine(teacher_path, stage_engine(teacher_path, config.get('teacher_engine')))
+    except Exception as e:
+        raise Exception(f"Failed to load cascade from {path}: {str(e)}")
+    engine = CascadeEngine(student, teacher, config.get('temperature', 1.0), config.get('threshold', 0.9))
+    engine.source_paths = (student_path, teacher_path) + tuple(student.source_paths) + tuple(teacher.source_paths)
+    return engine
+
+
+def build_student(num_classes, width=0.35, pretrained=True):
+    """MobileNetV2 student taking the app's [0, 1] inputs and returning logits
+
+    width is the MobileNetV2 width multiplier (0.35 is about 0.4M backbone
+    parameters). ImageNet weights are used when they can be downloaded.
+    """
+    import tensorflow as tf
+
+    inputs = tf.keras.Input((224, 224, 3))
+    # MobileNetV2 expects [-1, 1]
+    x = tf.keras.layers.Rescaling(2.0, offset=-1.0)(inputs)
+    weights = 'imagenet' if pretrained else None
+    try:
+        backbone = tf.keras.applications.MobileNetV2((224, 224, 3), alpha=width, include_top=False, weights=weights)
+    except Exception as e:
+        print(f"Could not load ImageNet weights ({str(e)}); training the student from scratch")
+        backbone = tf.keras.applications.MobileNetV2((224, 224, 3), alpha=width, include_top=False, weights=None)
+    x = backbone(x)
+    x = tf.keras.layers.GlobalAveragePooling2D()(x)
+    x = tf.keras.layers.Dropout(0.2)(x)
+    logits = tf.keras.layers.Dense(num_classes)(x)
+    return tf.keras.Model(inputs, logits, name='student')
+
+
+def split_indices(count, holdout=0.2, seed=0):
+    """Shuffle 0..count-1 into (train, calibration, test) with holdout split evenly between the last two"""
+    order = np.random.default_rng(seed).permutation(count)
+    held_out = int(round(count * holdout))
+    train, held = order[held_out:], order[:held_out]
+    return np.sort(train), np.sort(held[:len(held) // 2]), np.sort(held[len(held) // 2:])
+
+
+def fit_threshold(student_probabilities, teacher_probabilities, target_agreement=0.99):
+    """Fit the student temperature and the lowest confidence at which it agrees with the teacher often enough
+
+    The student is calibrated against the teacher's predictions (no labels
+    needed). Images at or above the threshold keep the student's answer,
+    and those answers agree with the teacher at least target_agreement of
+    the time.
+    """
+    teacher_top1 = teacher_probabilities.argmax(axis=1)
+    try:
+        calibration = Calibration.fit(student_probabilities, teacher_top1, target_accuracy=target_agreement)
+    except ValueError as e:
+        raise ValueError(f"The student never agrees with the teacher often enough; "
+                         f"lower the target agreement ({str(e)})")
+    return calibration.temperature, calibration.threshold
+
+
+def _throughput(model, images, batch_size):
+    """Images per second for model over images (a uint8 array), after one warm-up batch"""
+    from model_utils import allocate_batch, preprocess_batch
+
+    buffer = allocate_batch(batch_size)
+    model.predict_on_batch(preprocess_batch(images[:batch_size], out=buffer))
+    outputs = []
+    start = time.perf_counter()
+    for i in range(0, len(images), batch_size):
+        outputs.append(np.asarray(model.predict_on_batch(preprocess_batch(images[i:i + batch_size], out=buffer))))
+    elapsed = time.perf_counter() - start
+    return np.concatenate(outputs), len(images) / elapsed if elapsed > 0 else 0.0
+
+
+def distill(teacher_path, store, student_path=DEFAULT_STUDENT_PATH, cascade_path=DEFAULT_CASCADE_PATH,
+            teacher_engine=None, epochs=5, batch_size=64, width=0.35, temperature=4.0, learning_rate=1e-3,
+            holdout=0.2, target_agreement=0.99, pretrained=True, progress=None):
+    """Train a student on the teacher's soft targets, calibrate the cascade and report on held-out images
+
+    store is a tensor_store.TensorStore. Its labels are only used for the
+    accuracy report, so it may hold unlabeled field photos filed under any
+    class. The held-out images are split in two: one half fits the student
+    temperature and the escalation threshold, the other is used for the
+    report. Writes the student model and the cascade file and returns the
+    report.
+    """
+    import tensorflow as tf
+    from model_utils import allocate_batch, preprocess_batch
+
+    teacher_engine = stage_engine(teacher_path, teacher_engine)
+    teacher = create_engine(teacher_path, teacher_engine)
+    train, calibration_set, test = split_indices(len(store), holdout)
+    if len(train) == 0 or len(calibration_set) == 0 or len(test) == 0:
+        raise ValueError(f"{store.path} holds too few images ({len(store)}) to train, calibrate and test")
+
+    # Soft targets are computed once; the images themselves stay in the memory-mapped store
+    buffer = allocate_batch(batch_size)
+    teacher_probabilities = np.concatenate([
+        np.asarray(teacher.predict_on_batch(preprocess_batch(store.images[i:i + batch_size], out=buffer)),
+                   dtype=np.float32)
+        for i in range(0, len(store), batch_size)
+    ])
+    soft_targets = apply_temperature(teacher_probabilities, temperature)
+
+    def batches():
+        rng = np.random.default_rng(0)
+        while True:
+            # Contiguous runs keep reads from the memory map sequential
+            starts = rng.permutation(np.arange(0, len(train), batch_size))
+            for start in starts:
+                rows = train[start:start + batch_size]
+                yield store.images[rows].astype(np.float32) / 255.0, soft_targets[rows]
+
+    def distillation_loss(targets, logits):
+        # Hinton et al.: cross-entropy against temperature-softened targets, scaled by T^2
+        return tf.keras.losses.categorical_crossentropy(targets, logits / temperature, from_logits=True) \
+            * temperature ** 2
+
+    logits_model = build_student(teacher_probabilities.shape[1], width, pretrained)
+    logits_model.compile(optimizer=tf.keras.optimizers.Adam(learning_rate), loss=distillation_loss)
+    callbacks = []
+    if progress is not None:
+        callbacks.append(tf.keras.callbacks.LambdaCallback(
+            on_epoch_end=lambda epoch, logs: progress(epoch + 1, epochs, logs.get('loss'))))
+    logits_model.fit(batches(), epochs=epochs, steps_per_epoch=-(-len(train) // batch_size),
+                     callbacks=callbacks, shuffle=False, verbose=0)
+
+    student_model = tf.keras.Model(logits_model.input, tf.keras.layers.Softmax()(logits_model.output))
+    student_model.save(student_path)
+    student = create_engine(student_path, 'keras')
+
+    student_calibration, _ = _throughput(student, store.images[calibration_set], batch_size)
+    student_temperature, threshold = fit_threshold(student_calibration, teacher_probabilities[calibration_set],
+                                                   target_agreement)
+
+    cascade = CascadeEngine(student, teacher, student_temperature, threshold)
+    test_images, test_labels = store.images[test], np.asarray(store.labels[test])
+    _, teacher_rate = _throughput(teacher, test_images, batch_size)
+    student_test, student_rate = _throughput(student, test_images, batch_size)
+    cascade_test, cascade_rate = _throughput(cascade, test_images, batch_size)
+    escalation_rate = float((apply_temperature(student_test, student_temperature).max(axis=1) < threshold).mean())
+
+    teacher_test = teacher_probabilities[test]
+    report = {
+        'train_images': int(len(train)),
+        'calibration_images': int(len(calibration_set)),
+        'test_images': int(len(test)),
+        'target_agreement': target_agreement,
+        'student_temperature': student_temperature,
+        'threshold': threshold,
+        'escalation_rate': escalation_rate,
+        'teacher_accuracy': float((teacher_test.argmax(axis=1) == test_labels).mean()),
+        'student_accuracy': float((student_test.argmax(axis=1) == test_labels).mean()),
+        'cascade_accuracy': float((cascade_test.argmax(axis=1) == test_labels).mean()),
+        'cascade_teacher_agreement': float((cascade_test.argmax(axis=1) == teacher_test.argmax(axis=1)).mean()),
+        'teacher_images_per_second': teacher_rate,
+        'student_images_per_second': student_rate,
+        'cascade_images_per_second': cascade_rate,
+        'speedup': cascade_rate / teacher_rate if teacher_rate else 0.0,
+    }
+    report['accuracy_delta'] = report['cascade_accuracy'] - report['teacher_accuracy']
+
+    base = os.path.dirname(os.path.abspath(cascade_path))
+    config = {
+        'student': os.path.relpath(os.path.abspath(student_path), base),
+        'teacher': os.path.relpath(os.path.abspath(teacher_path), base),
+        'student_engine': 'keras',
+        'teacher_engine': teacher_engine,
+        'temperature': student_temperature,
+        'threshold': threshold,
+        'report': report,
+    }
+    with open(cascade_path, 'w') as f:
+        json.dump(config, f, indent=2)
+    return report
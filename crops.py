@@ -0,0 +1,361 @@
+"""Crop hints: restrict a diagnosis to the classes of the crop that was photographed
+
+Class names follow `Crop___Disease`, and growers almost always know which
+crop is in the photo. With a crop hint, probabilities outside that crop are
+zeroed and the rest renormalized (the same as a softmax over that crop's
+logits), which removes cross-crop confusions such as a tomato disease on a
+potato leaf. The rejection threshold still applies to the probability the
+model put on the best class of the crop before renormalizing; otherwise a
+crop with one class would always be diagnosed. The lookup tables between
+crops and class indices are built once per class list.
+
+SpecialistEngine (INFERENCE_ENGINE=specialist) goes further: it runs the
+model's backbone once per image, caches the penultimate features, and
+answers with a small per-crop softmax head. Heads are fitted on those
+features with `python -m plant_classifier fit-heads`; crops without a
+fitted head use their slice of the full model's classifier.
+"""
+import hashlib
+import os
+import re
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from inference_engines import InferenceEngine, KerasEngine
+from metrics import get_metrics
+from model_utils import create_model, get_class_names, split_classifier
+
+CROP_SEPARATOR = '___'
+# Crop id meaning "no hint": every class stays eligible
+ANY_CROP = -1
+DEFAULT_HEADS_PATH = 'crop_heads.npz'
+
+
+def crop_of(class_name):
+    """'Tomato___Late_blight' -> 'Tomato'"""
+    return class_name.split(CROP_SEPARATOR, 1)[0]
+
+
+def _normalize(text):
+    return ' '.join(re.findall(r'[a-z0-9]+', text.lower()))
+
+
+class CropTable:
+    """Precomputed lookups between crops and class indices"""
+
+    def __init__(self, class_names):
+        self.class_names = list(class_names)
+        self.crops = list(dict.fromkeys(crop_of(name) for name in self.class_names))
+        self.class_to_crop = np.array([self.crops.index(crop_of(name)) for name in self.class_names], dtype=np.int16)
+        self.crop_classes = [np.flatnonzero(self.class_to_crop == crop_id) for crop_id in range(len(self.crops))]
+        # Row i masks the classes of crop i; the extra last row, indexed by ANY_CROP, keeps every class
+        self.masks = np.zeros((len(self.crops) + 1, len(self.class_names)), dtype=np.float32)
+        self.masks[self.class_to_crop, np.arange(len(self.class_names))] = 1.0
+        self.masks[ANY_CROP] = 1.0
+
+        # Accept 'Corn_(maize)', 'corn (maize)', 'corn', 'maize', 'bell pepper', ...
+        self._aliases = {}
+        for crop_id, crop in enumerate(self.crops):
+            words = _normalize(crop).split()
+            inner = re.findall(r'\(([^)]*)\)', crop)
+            for alias in [' '.join(words), ' '.join(sorted(words)), words[0]] + [_normalize(text) for text in inner]:
+                self._aliases.setdefault(alias, crop_id)
+
+    def __len__(self):
+        return len(self.crops)
+
+    def display_name(self, crop_id):
+        return self.crops[crop_id].replace('_', ' ')
+
+    def resolve(self, crop):
+        """Return the crop id for a crop name, alias or id; None, '' and 'any' mean no hint"""
+        if crop is None or isinstance(crop, (int, np.integer)):
+            crop_id = ANY_CROP if crop is None else int(crop)
+            if not ANY_CROP <= crop_id < len(self.crops):
+                raise ValueError(f"Unknown crop id {crop_id}")
+            return crop_id
+        key = _normalize(crop)
+        if key in ('', 'any', 'all'):
+            return ANY_CROP
+        crop_id = self._aliases.get(key, self._aliases.get(' '.join(sorted(key.split()))))
+        if crop_id is None:
+            raise ValueError(f"Unknown crop '{crop}'. Choose one of: "
+                             f"{', '.join(self.display_name(i) for i in range(len(self.crops)))}")
+        return crop_id
+
+    def crop_masks(self, crop_ids):
+        """(N, num_classes) class masks for postprocessing.postprocess, or None when no row has a hint"""
+        crop_ids = np.atleast_1d(np.asarray(crop_ids, dtype=np.int64))
+        if (crop_ids == ANY_CROP).all():
+            return None
+        return self.masks[crop_ids]
+
+
+_tables = {}
+_tables_lock = threading.Lock()
+
+
+def get_crop_table(class_names=None):
+    """Return the CropTable for class_names (default: get_class_names()), built once per class list"""
+    key = tuple(class_names if class_names is not None else get_class_names())
+    table = _tables.get(key)
+    if table is None:
+        with _tables_lock:
+            table = _tables.setdefault(key, CropTable(key))
+    return table
+
+
+def resolve_crop(crop):
+    """Crop id for a crop name from the UI or API; raises ValueError for unknown crops"""
+    return get_crop_table().resolve(crop)
+
+
+def crop_masks(crop_ids):
+    return get_crop_table().crop_masks(crop_ids)
+
+
+def predict_with_crop(model, batch, crop_ids):
+    """Class probabilities over every class for batch, with crop-aware engines told each row's crop
+
+    Engines with per-crop heads (crop_aware) get the crop ids directly; any
+    other engine runs as usual. The restriction itself happens in
+    postprocessing with crop_masks, after calibration and rejection.
+    """
+    if getattr(model, 'crop_aware', False):
+        crop_ids = np.broadcast_to(np.asarray(crop_ids, dtype=np.int64), (len(batch),))
+        return model.predict_on_batch(batch, crops=crop_ids)
+    return model.predict_on_batch(batch)
+
+
+def predict_with_crop_embeddings(model, batch, crop_ids):
+    """predict_with_crop that also returns the penultimate features from the same forward pass"""
+    if getattr(model, 'crop_aware', False):
+        crop_ids = np.broadcast_to(np.asarray(crop_ids, dtype=np.int64), (len(batch),))
+        return model.predict_with_embeddings(batch, crops=crop_ids)
+    return model.predict_with_embeddings(batch)
+
+
+def softmax(logits):
+    logits = logits - logits.max(axis=1, keepdims=True)
+    scaled = np.exp(logits)
+    return scaled / scaled.sum(axis=1, keepdims=True)
+
+
+class FeatureCache:
+    """LRU of backbone features keyed by a digest of the preprocessed image
+
+    A rerun with a different crop hint, or the same photo uploaded again,
+    only pays for the head.
+    """
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(image):
+        return hashlib.blake2b(np.ascontiguousarray(image).data, digest_size=16).digest()
+
+    def get(self, key):
+        with self._lock:
+            features = self._entries.get(key)
+            if features is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+            return features
+
+    def put(self, key, features):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = features
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+class SpecialistEngine(InferenceEngine):
+    """Shared backbone with cached features and a small softmax head per crop
+
+    Without a crop hint the full model's own classifier is used, so results
+    match the keras engine exactly. With one, the crop's head decides how
+    the full model's probability for that crop is split between its classes,
+    so the rows still cover every class and rejection sees the crop's mass.
+    """
+
+    kind = 'specialist'
+    crop_aware = True
+    returns_embeddings = True
+
+    def __init__(self, model_path, heads_path=None, cache_entries=None):
+        self.backbone, self.kernel, self.bias = split_classifier(create_model(model_path))
+        self.table = get_crop_table()
+        if self.kernel.shape[1] != len(self.table.class_names):
+            raise ValueError(f"Model has {self.kernel.shape[1]} outputs for {len(self.table.class_names)} classes")
+        self.features = FeatureCache(int(cache_entries if cache_entries is not None
+                                         else os.environ.get('FEATURE_CACHE_ENTRIES', 256)))
+
+        # Default heads are each crop's slice of the full classifier
+        self.heads = [(classes, self.kernel[:, classes], self.bias[classes]) for classes in self.table.crop_classes]
+        self.fitted_crops = []
+        heads_path = heads_path or os.environ.get('CROP_HEADS_PATH', DEFAULT_HEADS_PATH)
+        # Watched even before it exists, so fitting heads later swaps them in
+        self.source_paths = (heads_path,)
+        if os.path.exists(heads_path):
+            self._load_heads(heads_path)
+
+    def _load_heads(self, path):
+        try:
+            with np.load(path) as heads:
+                if list(heads['class_names']) != self.table.class_names:
+                    raise ValueError("heads were fitted for a different class list")
+                for crop in heads['crops']:
+                    crop_id = self.table.crops.index(str(crop))
+                    kernel, bias = heads[f'{crop}/kernel'], heads[f'{crop}/bias']
+                    if kernel.shape[0] != self.kernel.shape[0]:
+                        raise ValueError(f"head for {crop} expects {kernel.shape[0]} features, "
+                                         f"the backbone produces {self.kernel.shape[0]}")
+                    self.heads[crop_id] = (self.table.crop_classes[crop_id], kernel, bias)
+                    self.fitted_crops.append(str(crop))
+        except Exception as e:
+            raise Exception(f"Failed to load crop heads from {path}: {str(e)}")
+        print(f"Loaded specialist heads for {len(self.fitted_crops)} crops from {path}")
+
+    def extract_features(self, batch):
+        """Penultimate features for a float32 batch, running the backbone only on images not cached"""
+        batch = np.asarray(batch, dtype=np.float32)
+        keys = [FeatureCache.key(image) for image in batch]
+        features = [self.features.get(key) for key in keys]
+        missing = [i for i, value in enumerate(features) if value is None]
+        if missing:
+            computed = np.asarray(self.backbone.predict_on_batch(batch[missing]), dtype=np.float32)
+            for i, value in zip(missing, computed):
+                features[i] = value
+                self.features.put(keys[i], value)
+
+        metrics = get_metrics()
+        metrics.counter('plant_feature_cache_total', 'Backbone feature lookups by result').inc(
+            len(batch) - len(missing), result='hit')
+        metrics.counter('plant_feature_cache_total').inc(len(missing), result='miss')
+        return np.stack(features)
+
+    def predict_on_batch(self, batch, crops=None):
+        return self._classify(self.extract_features(batch), crops)
+
+    def predict_with_embeddings(self, batch, crops=None):
+        features = self.extract_features(batch)
+        return self._classify(features, crops), features
+
+    def _classify(self, features, crops=None):
+        if crops is None:
+            return softmax(features @ self.kernel + self.bias)
+
+        crops = np.asarray(crops, dtype=np.int64)
+        probabilities = softmax(features @ self.kernel + self.bias).astype(np.float32)
+        for crop_id in np.unique(crops):
+            if crop_id == ANY_CROP:
+                continue
+            rows = np.flatnonzero(crops == crop_id)
+            classes, kernel, bias = self.heads[crop_id]
+            mass = probabilities[np.ix_(rows, classes)].sum(axis=1, keepdims=True)
+            probabilities[np.ix_(rows, classes)] = softmax(features[rows] @ kernel + bias) * mass
+        return probabilities
+
+    @property
+    def size_bytes(self):
+        return KerasEngine(self.backbone).size_bytes + sum(kernel.nbytes + bias.nbytes for _, kernel, bias in self.heads)
+
+    def stats(self):
+        lookups = self.features.hits + self.features.misses
+        return {
+            'feature_cache_hits': self.features.hits,
+            'feature_cache_misses': self.features.misses,
+            'feature_cache_hit_rate': self.features.hits / lookups if lookups else 0.0,
+            'fitted_crops': list(self.fitted_crops),
+        }
+
+
+def fit_head(features, labels, kernel, bias, epochs=300, learning_rate=0.01, l2=1e-4):
+    """Fit a softmax head with full-batch Adam, starting from kernel and bias
+
+    labels index the head's columns. Starting from the full model's slice
+    keeps classes with few examples close to the general classifier.
+    """
+    kernel, bias = kernel.astype(np.float32).copy(), bias.astype(np.float32).copy()
+    targets = np.eye(kernel.shape[1], dtype=np.float32)[labels]
+    params = [kernel, bias]
+    moments = [np.zeros_like(p) for p in params]
+    velocities = [np.zeros_like(p) for p in params]
+    beta1, beta2 = 0.9, 0.999
+    for step in range(1, epochs + 1):
+        error = (softmax(features @ kernel + bias) - targets) / len(features)
+        grads = [features.T @ error + l2 * kernel, error.sum(axis=0)]
+        for param, grad, moment, velocity in zip(params, grads, moments, velocities):
+            moment *= beta1
+            moment += (1 - beta1) * grad
+            velocity *= beta2
+            velocity += (1 - beta2) * grad ** 2
+            corrected = moment / (1 - beta1 ** step)
+            param -= learning_rate * corrected / (np.sqrt(velocity / (1 - beta2 ** step)) + 1e-8)
+    return kernel, bias
+
+
+def fit_heads(model_path, store, out_path=DEFAULT_HEADS_PATH, epochs=300, learning_rate=0.01, holdout=0.2,
+              batch_size=64, seed=0):
+    """Fit one head per crop on backbone features of a labeled tensor store and save them
+
+    Features are extracted once for the whole store and shared by every
+    crop. Each crop's images are split into training and held-out parts;
+    a fitted head is kept only when it is at least as accurate on the
+    held-out part as the full model restricted to that crop. Returns a
+    report with per-crop held-out accuracy.
+    """
+    from model_utils import allocate_batch, preprocess_batch
+
+    table = get_crop_table(store.class_names)
+    backbone, full_kernel, full_bias = split_classifier(create_model(model_path))
+    buffer = allocate_batch(batch_size)
+    features = np.concatenate([
+        np.asarray(backbone.predict_on_batch(preprocess_batch(images, out=buffer)), dtype=np.float32)
+        for images, _ in store.iter_chunks(batch_size)
+    ])
+    labels = np.asarray(store.labels)
+    label_crops = table.class_to_crop[labels]
+
+    rng = np.random.default_rng(seed)
+    saved = {'class_names': np.array(table.class_names), 'crops': []}
+    report = {'images': int(len(labels)), 'crops': []}
+    for crop_id, crop in enumerate(table.crops):
+        rows = rng.permutation(np.flatnonzero(label_crops == crop_id))
+        held_out = int(round(len(rows) * holdout))
+        train, test = rows[held_out:], rows[:held_out]
+        classes = table.crop_classes[crop_id]
+        # Position of each class within its crop's head
+        local = np.searchsorted(classes, labels)
+        kernel, bias = full_kernel[:, classes], full_bias[classes]
+        if len(classes) < 2 or len(train) == 0 or len(test) == 0:
+            report['crops'].append({'crop': crop, 'images': int(len(rows)), 'fitted': False})
+            continue
+
+        head_kernel, head_bias = fit_head(features[train], local[train], kernel, bias, epochs, learning_rate)
+        general = float(np.mean((features[test] @ kernel + bias).argmax(axis=1) == local[test]))
+        specialist = float(np.mean((features[test] @ head_kernel + head_bias).argmax(axis=1) == local[test]))
+        fitted = specialist >= general
+        if fitted:
+            saved['crops'].append(crop)
+            saved[f'{crop}/kernel'] = head_kernel
+            saved[f'{crop}/bias'] = head_bias
+        report['crops'].append({'crop': crop, 'images': int(len(rows)), 'fitted': fitted,
+                                'general_accuracy': general, 'specialist_accuracy': specialist})
+
+    saved['crops'] = np.array(saved['crops'])
+    with open(out_path, 'wb') as f:
+        np.savez(f, **saved)
+    return report
@@ -0,0 +1,212 @@
+"""Perceptual-hash near-duplicate detection for bulk uploads
+
+Scouting runs often contain bursts of almost identical shots of the same
+leaf. Each image is reduced to a 64-bit perceptual hash (pHash or dHash)
+computed from the small array already decoded for the model, and looked up
+in a multi-index hash table: the 64 bits are split into five 13-bit
+chunks, and by the pigeonhole principle any hash within max_distance bits
+is within max_distance // 5 bits of it in at least one chunk. Only images
+found near a chunk are compared, so a lookup does not scan every earlier
+image. Matches are merged
+with union-find; one representative per group goes through the model and
+its result is copied to the rest.
+"""
+import numpy as np
+
+from metrics import get_metrics, span
+
+HASH_BITS = 64
+HASH_METHODS = ['phash', 'dhash']
+# Hamming distance (of 64 bits) at which two shots count as the same leaf
+DEFAULT_MAX_DISTANCE = 8
+
+
+def _thumbnail(image, size):
+    """Grayscale float32 thumbnail; shrinking before the colour conversion keeps hashing cheap"""
+    import cv2
+    small = cv2.resize(np.asarray(image), size, interpolation=cv2.INTER_AREA).astype(np.float32)
+    if small.ndim == 3:
+        small = small @ np.array([0.299, 0.587, 0.114], dtype=np.float32)
+    return small
+
+
+def _pack(bits):
+    return int.from_bytes(np.packbits(bits.ravel()).tobytes(), 'big')
+
+
+def dhash(image):
+    """Difference hash: whether brightness increases left to right on a 9x8 thumbnail"""
+    small = _thumbnail(image, (9, 8))
+    return _pack(small[:, 1:] > small[:, :-1])
+
+
+def phash(image):
+    """DCT hash: the lowest 8x8 frequencies of a 32x32 thumbnail compared with their median"""
+    import cv2
+    low = cv2.dct(_thumbnail(image, (32, 32)))[:8, :8]
+    # The DC term only reflects overall brightness, so leave it out of the median
+    return _pack(low > np.median(low.ravel()[1:]))
+
+
+def hash_image(image, method='phash'):
+    """64-bit perceptual hash of a PIL image or RGB array"""
+    with span('hash'):
+        if method == 'phash':
+            return phash(image)
+        if method == 'dhash':
+            return dhash(image)
+    raise ValueError(f"Unknown hash method: {method}")
+
+
+def hamming(a, b):
+    return (a ^ b).bit_count()
+
+
+class HashIndex:
+    """Multi-index hash table answering "which hashes are within max_distance bits?"
+
+    Each hash is stored under each of its chunk_bits-wide chunks. If two
+    hashes differ in at most max_distance bits, some chunk differs in at
+    most max_distance // chunks bits, so a query probes every chunk value
+    within that radius and only verifies the entries found there. 13-bit
+    chunks were fastest from a few thousand to 100k images.
+    """
+
+    def __init__(self, max_distance=DEFAULT_MAX_DISTANCE, chunk_bits=13):
+        from itertools import combinations
+
+        self.max_distance = max_distance
+        self._shifts = list(range(0, HASH_BITS, chunk_bits))
+        self._mask = (1 << chunk_bits) - 1
+        radius = max_distance // len(self._shifts)
+        self._probes = [sum(1 << bit for bit in bits)
+                        for r in range(radius + 1) for bits in combinations(range(chunk_bits), r)]
+        self._tables = [{} for _ in self._shifts]
+        self._hashes = []
+
+    def __len__(self):
+        return len(self._hashes)
+
+    def add(self, value):
+        """Store a hash and return its id"""
+        item_id = len(self._hashes)
+        self._hashes.append(value)
+        for table, shift in zip(self._tables, self._shifts):
+            table.setdefault((value >> shift) & self._mask, []).append(item_id)
+        return item_id
+
+    def query(self, value):
+        """Return [(id, distance)] of stored hashes within max_distance, closest first"""
+        candidates = set()
+        for table, shift in zip(self._tables, self._shifts):
+            chunk = (value >> shift) & self._mask
+            for probe in self._probes:
+                bucket = table.get(chunk ^ probe)
+                if bucket:
+                    candidates.update(bucket)
+
+        matches = []
+        for item_id in candidates:
+            distance = hamming(value, self._hashes[item_id])
+            if distance <= self.max_distance:
+                matches.append((item_id, distance))
+        matches.sort(key=lambda match: (match[1], match[0]))
+        return matches
+
+
+class UnionFind:
+    """Disjoint sets over 0..n-1 with path halving and union by size"""
+
+    def __init__(self):
+        self._parent = []
+        self._size = []
+
+    def add(self):
+        self._parent.append(len(self._parent))
+        self._size.append(1)
+        return len(self._parent) - 1
+
+    def find(self, item):
+        parent = self._parent
+        while parent[item] != item:
+            parent[item] = parent[parent[item]]
+            item = parent[item]
+        return item
+
+    def union(self, a, b):
+        """Merge the sets of a and b, returning the surviving root"""
+        a, b = self.find(a), self.find(b)
+        if a == b:
+            return a
+        if self._size[a] < self._size[b]:
+            a, b = b, a
+        self._parent[b] = a
+        self._size[a] += self._size[b]
+        return a
+
+
+class Deduplicator:
+    """Group near-identical images as they stream in, choosing one representative per group
+
+    The first image of a group is its representative; later images within
+    max_distance bits of any group member are duplicates of it. When an
+    image bridges two groups they are merged, keeping the older
+    representative.
+    """
+
+    def __init__(self, max_distance=DEFAULT_MAX_DISTANCE, method='phash'):
+        if method not in HASH_METHODS:
+            raise ValueError(f"Unknown hash method: {method}")
+        self.method = method
+        self.index = HashIndex(max_distance)
+        self._sets = UnionFind()
+        self._names = []
+        self._representative = {}
+        self.images = 0
+        self.duplicates = 0
+
+    def add(self, name, image):
+        """Register an image; return (representative name, distance), or (None, None) if it starts a new group"""
+        value = hash_image(image, self.method)
+        matches = self.index.query(value)
+        item_id = self.index.add(value)
+        self._sets.add()
+        self._names.append(name)
+        self.images += 1
+
+        if not matches:
+            self._representative[item_id] = item_id
+            return None, None
+
+        closest, distance = matches[0]
+        representative = oldest = self._representative[self._sets.find(closest)]
+        for match, _ in matches:
+            # Ids follow arrival order, so the oldest representative survives a merge
+            oldest = min(oldest, self._representative[self._sets.find(match)])
+            root = self._sets.union(match, item_id)
+            self._representative[root] = oldest
+        self.duplicates += 1
+        get_metrics().counter('plant_dedup_model_calls_saved_total',
+                              'Images answered from a near-duplicate instead of the model').inc()
+        return self._names[representative], distance
+
+    def _members(self):
+        members = {}
+        for item_id, name in enumerate(self._names):
+            members.setdefault(self._representative[self._sets.find(item_id)], []).append(name)
+        return members
+
+    def groups(self):
+        """Return {representative name: [member names]} for groups with more than one image"""
+        return {self._names[rep]: names for rep, names in self._members().items() if len(names) > 1}
+
+    def stats(self):
+        """Return image, group and saved-model-call counts as a plain dictionary"""
+        sizes = [len(names) for names in self._members().values()]
+        return {
+            'images': self.images,
+            'groups': len(sizes),
+            'duplicate_groups': sum(1 for size in sizes if size > 1),
+            'model_calls_saved': self.duplicates,
+            'saved_fraction': self.duplicates / self.images if self.images else 0.0,
+        }
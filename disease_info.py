@@ -1,179 +1,179 @@
-def get_disease_info(disease_name):
+import difflib
+import json
+import os
+import re
+import threading
+import time
+from types import MappingProxyType
+
+from metrics import record_error
+
+DEFAULT_DATA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'disease_info.json')
+# How often (in seconds) the data file is checked for edits by agronomists
+RELOAD_CHECK_INTERVAL = 30.0
+TEXT_FIELDS = ('description', 'symptoms', 'treatment', 'prevention')
+
+
+def normalize_name(name):
+    """Normalize a class name or alias for lookup: 'Tomato___Late_blight' -> 'tomatolateblight'"""
+    return re.sub(r'[^a-z0-9]', '', name.lower())
+
+
+def format_class_name(class_name):
+    """'Corn_(maize)___Northern_Leaf_Blight' -> 'Corn (maize) - Northern Leaf Blight'"""
+    return ' - '.join(part.replace('_', ' ').strip() for part in class_name.split('___'))
+
+
+def _freeze(value):
+    """Recursively convert dicts to read-only mappings and lists to tuples"""
+    if isinstance(value, dict):
+        return MappingProxyType({key: _freeze(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return tuple(_freeze(item) for item in value)
+    return value
+
+
+def _localize(entry, translations, name=None):
+    """Build one immutable entry per language, translated fields falling back to English"""
+    variants = {}
+    for lang, overrides in (('en', {}),) + tuple(translations.items()):
+        localized = {key: value for key, value in entry.items() if key not in ('aliases', 'translations')}
+        localized.update({key: value for key, value in overrides.items() if key in TEXT_FIELDS})
+        if name is not None:
+            localized['description'] = localized['description'].format(name=name)
+        variants[lang] = _freeze(localized)
+    return MappingProxyType(variants)
+
+
+class DiseaseKnowledgeBase:
+    """Immutable disease information indexed by class id, normalized name and alias
+
+    Every entry, including the healthy and generic fallbacks for classes
+    without curated content, is built once when the data file is loaded,
+    so lookups are plain dictionary reads.
+    """
+
+    def __init__(self, data, class_names):
+        diseases = data.get('diseases', {})
+        fallbacks = data.get('fallbacks', {})
+        healthy = fallbacks['healthy']
+        generic = fallbacks['generic']
+
+        by_name = {}
+        for class_name in class_names:
+            if class_name in diseases:
+                entry = diseases[class_name]
+                by_name[class_name] = _localize(entry, entry.get('translations', {}))
+            elif 'healthy' in class_name.lower():
+                by_name[class_name] = _localize(healthy, healthy.get('translations', {}))
+            else:
+                by_name[class_name] = _localize(generic, generic.get('translations', {}),
+                                                name=format_class_name(class_name))
+        # Curated content for names outside the model's classes is still reachable by name
+        for name, entry in diseases.items():
+            by_name.setdefault(name, _localize(entry, entry.get('translations', {})))
+
+        index = {normalize_name(name): name for name in by_name}
+        for name, entry in diseases.items():
+            for alias in entry.get('aliases', []):
+                index.setdefault(normalize_name(alias), name)
+
+        self.version = data.get('version')
+        self.class_names = tuple(class_names)
+        self._by_name = MappingProxyType(by_name)
+        self._by_id = tuple(by_name[name] for name in class_names)
+        self._index = MappingProxyType(index)
+        self._healthy = _localize(healthy, healthy.get('translations', {}))
+        self._generic_template = generic
+        self._fuzzy_cache = {}
+
+    def resolve(self, disease_name):
+        """Return the canonical name for a class name, alias or close misspelling, or None"""
+        if disease_name in self._by_name:
+            return disease_name
+        key = normalize_name(disease_name)
+        if key in self._index:
+            return self._index[key]
+        if key not in self._fuzzy_cache:
+            if len(self._fuzzy_cache) > 10000:
+                self._fuzzy_cache.clear()
+            matches = difflib.get_close_matches(key, self._index.keys(), n=1, cutoff=0.85)
+            self._fuzzy_cache[key] = self._index[matches[0]] if matches else None
+        return self._fuzzy_cache[key]
+
+    def get(self, disease_name, lang='en'):
+        """Return the entry for a disease name in the requested language"""
+        name = self.resolve(disease_name.strip())
+        if name is not None:
+            variants = self._by_name[name]
+        elif 'healthy' in disease_name.lower():
+            variants = self._healthy
+        else:
+            variants = _localize(self._generic_template, self._generic_template.get('translations', {}),
+                                 name=format_class_name(disease_name.strip()))
+        return variants.get(lang) or variants['en']
+
+    def get_by_id(self, class_id, lang='en'):
+        """Return the entry for a model output index"""
+        variants = self._by_id[class_id]
+        return variants.get(lang) or variants['en']
+
+    def languages(self):
+        """Return every language with at least one translated entry"""
+        return sorted({lang for variants in self._by_name.values() for lang in variants})
+
+
+_knowledge_base = None
+_loaded_mtime = None
+_checked_at = 0.0
+_lock = threading.Lock()
+
+
+def load_knowledge_base(path=None):
+    """Load and index the disease data file (JSON, or msgpack when the path ends in .msgpack)"""
+    from model_utils import get_class_names
+
+    path = path or os.environ.get('DISEASE_INFO_PATH', DEFAULT_DATA_PATH)
+    if path.endswith('.msgpack'):
+        import msgpack
+        with open(path, 'rb') as f:
+            data = msgpack.unpackb(f.read(), raw=False)
+    else:
+        with open(path, encoding='utf-8') as f:
+            data = json.load(f)
+    return DiseaseKnowledgeBase(data, get_class_names())
+
+
+def get_knowledge_base():
+    """Return the shared knowledge base, reloading it when the data file has changed"""
+    global _knowledge_base, _loaded_mtime, _checked_at
+
+    now = time.monotonic()
+    if _knowledge_base is not None and now - _checked_at < RELOAD_CHECK_INTERVAL:
+        return _knowledge_base
+
+    with _lock:
+        path = os.environ.get('DISEASE_INFO_PATH', DEFAULT_DATA_PATH)
+        try:
+            mtime = os.path.getmtime(path)
+            if _knowledge_base is None or mtime != _loaded_mtime:
+                _knowledge_base = load_knowledge_base(path)
+                _loaded_mtime = mtime
+        except Exception as e:
+            record_error('disease_info_reload')
+            if _knowledge_base is None:
+                raise
+            # Keep serving the previous content if the file was removed or an edit left it invalid
+            print(f"Failed to reload disease information from {path}: {str(e)}")
+        _checked_at = now
+    return _knowledge_base
+
+
+def get_disease_info(disease_name, lang='en'):
     """Return detailed information about the plant disease"""
-    
-    # Disease information database
-    disease_db = {
-        'Apple___Apple_scab': {
-            'description': 'Apple scab is a fungal disease that affects apple trees, causing dark, scaly lesions on leaves and fruit.',
-            'symptoms': [
-                'Dark, olive-green to black spots on leaves',
-                'Scaly lesions on fruit surface',
-                'Premature leaf drop',
-                'Reduced fruit quality'
-            ],
-            'treatment': [
-                'Apply fungicide sprays during growing season',
-                'Remove fallen leaves and debris',
-                'Prune for better air circulation',
-                'Use disease-resistant apple varieties'
-            ],
-            'prevention': [
-                'Plant resistant varieties',
-                'Ensure good air circulation',
-                'Avoid overhead watering',
-                'Regular sanitation practices'
-            ],
-            'severity': 'medium'
-        },
-        
-        'Apple___Black_rot': {
-            'description': 'Black rot is a serious fungal disease that affects apple trees, causing fruit rot and leaf spots.',
-            'symptoms': [
-                'Brown leaf spots with purple margins',
-                'Black, mummified fruit',
-                'Cankers on branches',
-                'Premature fruit drop'
-            ],
-            'treatment': [
-                'Remove infected fruit and branches immediately',
-                'Apply copper-based fungicides',
-                'Improve orchard sanitation',
-                'Prune infected wood during dormant season'
-            ],
-            'prevention': [
-                'Plant disease-resistant varieties',
-                'Maintain proper tree spacing',
-                'Regular pruning for air circulation',
-                'Remove mummified fruit from trees'
-            ],
-            'severity': 'high'
-        },
-        
-        'Tomato___Early_blight': {
-            'description': 'Early blight is a common fungal disease affecting tomatoes, characterized by dark spots with concentric rings.',
-            'symptoms': [
-                'Dark spots with concentric rings on leaves',
-                'Yellowing and browning of lower leaves',
-                'Stem lesions near soil line',
-                'Fruit spots with dark, sunken areas'
-            ],
-            'treatment': [
-                'Apply fungicide containing chlorothalonil or copper',
-                'Remove affected plant debris',
-                'Improve air circulation around plants',
-                'Water at soil level, not on foliage'
-            ],
-            'prevention': [
-                'Rotate crops yearly',
-                'Use drip irrigation instead of overhead watering',
-                'Mulch around plants to prevent soil splash',
-                'Space plants for good air circulation'
-            ],
-            'severity': 'medium'
-        },
-        
-        'Tomato___Late_blight': {
-            'description': 'Late blight is a devastating disease that can quickly destroy tomato crops, especially in cool, wet conditions.',
-            'symptoms': [
-                'Water-soaked spots on leaves that turn brown',
-                'White fuzzy growth on leaf undersides',
-                'Brown, firm lesions on fruit',
-                'Rapid plant death in severe cases'
-            ],
-            'treatment': [
-                'Apply preventive fungicides immediately',
-                'Remove and destroy infected plants',
-                'Avoid overhead watering',
-                'Improve drainage and air circulation'
-            ],
-            'prevention': [
-                'Use certified disease-free seeds and plants',
-                'Avoid working with wet plants',
-                'Provide adequate spacing between plants',
-                'Apply preventive fungicide treatments'
-            ],
-            'severity': 'high'
-        },
-        
-        'Potato___Late_blight': {
-            'description': 'Late blight is a serious disease of potatoes that can cause complete crop loss if not managed properly.',
-            'symptoms': [
-                'Dark, water-soaked lesions on leaves',
-                'White mold growth on leaf undersides',
-                'Brown rot in potato tubers',
-                'Foul odor from infected tubers'
-            ],
-            'treatment': [
-                'Apply fungicides containing metalaxyl or chlorothalonil',
-                'Remove infected plant material immediately',
-                'Avoid harvesting wet tubers',
-                'Cure harvested potatoes properly'
-            ],
-            'prevention': [
-                'Plant certified seed potatoes',
-                'Avoid overhead irrigation',
-                'Hill potatoes properly to prevent exposure',
-                'Monitor weather conditions for disease-favorable periods'
-            ],
-            'severity': 'high'
-        },
-        
-        'Corn_(maize)___Northern_Leaf_Blight': {
-            'description': 'Northern leaf blight is a fungal disease that causes long, elliptical lesions on corn leaves.',
-            'symptoms': [
-                'Long, grayish-green to tan lesions on leaves',
-                'Lesions may have dark borders',
-                'Premature leaf death',
-                'Reduced grain yield'
-            ],
-            'treatment': [
-                'Apply foliar fungicides if economically justified',
-                'Use resistant corn hybrids',
-                'Manage crop residue properly',
-                'Rotate with non-host crops'
-            ],
-            'prevention': [
-                'Plant resistant varieties',
-                'Practice crop rotation',
-                'Manage corn residue through tillage',
-                'Monitor fields regularly during growing season'
-            ],
-            'severity': 'medium'
-        }
-    }
-    
-    # Handle variations in disease names
-    clean_name = disease_name.strip()
-    
-    # Direct match
-    if clean_name in disease_db:
-        return disease_db[clean_name]
-    
-    # For diseases not in the database, provide generic information
-    if 'healthy' in clean_name.lower():
-        return {
-            'description': 'The plant appears to be healthy with no visible signs of disease.',
-            'symptoms': ['No disease symptoms detected'],
-            'treatment': ['Continue regular care and monitoring', 'Maintain good growing conditions'],
-            'prevention': ['Regular inspection', 'Proper nutrition', 'Adequate watering', 'Good air circulation'],
-            'severity': 'none'
-        }
-    
-    # Generic disease information
-    return {
-        'description': f'This appears to be {clean_name.replace("_", " ").replace("___", " - ")}. Please consult local agricultural experts for specific treatment advice.',
-        'symptoms': ['Visible symptoms detected by AI analysis'],
-        'treatment': [
-            'Consult with local agricultural extension service',
-            'Consider appropriate fungicide or treatment based on specific disease',
-            'Remove affected plant material if severe',
-            'Improve growing conditions'
-        ],
-        'prevention': [
-            'Use disease-resistant varieties when available',
-            'Maintain proper plant spacing for air circulation',
-            'Practice crop rotation',
-            'Keep plants healthy with proper nutrition and watering'
-        ],
-        'severity': 'medium'
-    }
+    return get_knowledge_base().get(disease_name, lang)
+
+
+def get_disease_info_by_id(class_id, lang='en'):
+    """Return detailed information for a model output index"""
+    return get_knowledge_base().get_by_id(class_id, lang)
@@ -0,0 +1,380 @@
+"""Append-only history of diagnoses for field analytics
+
+Every diagnosis shown in the app or returned by the API is recorded with
+its image hash, top-k, model version and, when known, the field id and GPS
+position. Recording only puts a row on a queue; a background thread
+commits queued rows in batches, so requests never wait for the disk.
+Storage is one SQLite file in WAL mode:
+
+    diagnoses      one row per diagnosis, indexed by (field_id, created),
+                   (created) and (image_hash)
+    weekly_counts  images per (field, week, top-1 class), updated in the
+                   same transaction as the rows it counts, so weekly
+                   disease rates read a few rows per field and week however
+                   long the history grows
+
+HISTORY_PATH selects the file (default diagnosis_history.db); set it to an
+empty string to turn recording off.
+"""
+import csv
+import io
+import json
+import os
+import queue
+import re
+import sqlite3
+import threading
+import time
+import zipfile
+from collections import Counter
+from datetime import datetime, timezone
+
+from metrics import get_metrics, record_error
+from postprocessing import UNKNOWN_LABEL, record_to_list
+
+DEFAULT_HISTORY_PATH = 'diagnosis_history.db'
+WEEK_SECONDS = 7 * 24 * 3600
+# 1970-01-05, the first Monday after the Unix epoch; weeks run Monday to Sunday (UTC)
+FIRST_MONDAY = 4 * 24 * 3600
+# weekly_counts class id for rejected images ("Unknown / not a leaf")
+UNKNOWN_CLASS = -1
+EXPORT_FIELDS = ['id', 'created', 'field_id', 'latitude', 'longitude', 'diagnosis', 'confidence', 'accepted',
+                 'top_k', 'model_version', 'image_hash', 'source']
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS diagnoses (
+    id INTEGER PRIMARY KEY,
+    created REAL NOT NULL,
+    field_id TEXT,
+    latitude REAL,
+    longitude REAL,
+    top1 INTEGER NOT NULL,
+    confidence REAL NOT NULL,
+    accepted INTEGER NOT NULL,
+    top_k TEXT NOT NULL,
+    model_version TEXT,
+    image_hash TEXT,
+    source TEXT
+);
+CREATE INDEX IF NOT EXISTS diagnoses_field_created ON diagnoses (field_id, created);
+CREATE INDEX IF NOT EXISTS diagnoses_created ON diagnoses (created);
+CREATE INDEX IF NOT EXISTS diagnoses_image_hash ON diagnoses (image_hash);
+CREATE TABLE IF NOT EXISTS weekly_counts (
+    field_id TEXT NOT NULL,
+    week INTEGER NOT NULL,
+    class_id INTEGER NOT NULL,
+    images INTEGER NOT NULL,
+    PRIMARY KEY (field_id, week, class_id)
+) WITHOUT ROWID;
+"""
+
+
+def week_of(timestamp):
+    """Index of the Monday-to-Sunday (UTC) week containing a Unix timestamp"""
+    return int((timestamp - FIRST_MONDAY) // WEEK_SECONDS)
+
+
+def week_start(week):
+    """ISO date of the Monday starting a week index"""
+    return datetime.fromtimestamp(FIRST_MONDAY + week * WEEK_SECONDS, timezone.utc).date().isoformat()
+
+
+def _connect(path):
+    db = sqlite3.connect(path, check_same_thread=False)
+    db.execute("PRAGMA journal_mode=WAL")
+    # WAL keeps committed batches safe across crashes with NORMAL; FULL would fsync every batch
+    db.execute("PRAGMA synchronous=NORMAL")
+    db.row_factory = sqlite3.Row
+    return db
+
+
+class HistoryStore:
+    """Diagnosis history in SQLite with a background batched writer
+
+    Rows are written in one transaction per batch of up to batch_size rows,
+    or whatever has arrived within flush_interval seconds of the first.
+    When more than max_queue rows are waiting, new rows are dropped and
+    counted rather than slowing requests down.
+    """
+
+    def __init__(self, path, batch_size=500, flush_interval=1.0, max_queue=10000):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        try:
+            self._db = _connect(path)
+            self._db.executescript(SCHEMA)
+            self._db.commit()
+        except Exception as e:
+            raise Exception(f"Failed to open diagnosis history {path}: {str(e)}")
+        self._read_lock = threading.Lock()
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._worker = None
+        self._worker_lock = threading.Lock()
+        self.written = 0
+        self.dropped = 0
+        self.batches = 0
+
+    def _ensure_writer(self):
+        if self._worker is not None and self._worker.is_alive():
+            return
+        with self._worker_lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name='history-writer', daemon=True)
+                self._worker.start()
+
+    def record(self, prediction, image_hash=None, model_version=None, field_id=None, latitude=None,
+               longitude=None, source='app', created=None):
+        """Queue one diagnosis without waiting for it to be written; returns False if it was dropped
+
+        prediction is a postprocessing record or its record_to_list form.
+        """
+        class_ids, confidences, accepted = (prediction if isinstance(prediction, (list, tuple))
+                                            else record_to_list(prediction))
+        row = (
+            created if created is not None else time.time(),
+            field_id or None,
+            latitude,
+            longitude,
+            int(class_ids[0]),
+            float(confidences[0]),
+            int(bool(accepted)),
+            json.dumps([list(map(int, class_ids)), [round(float(c), 6) for c in confidences]]),
+            model_version,
+            image_hash,
+            source,
+        )
+        try:
+            self._queue.put_nowait(row)
+        except queue.Full:
+            self.dropped += 1
+            return False
+        self._ensure_writer()
+        return True
+
+    def _run(self):
+        db = _connect(self.path)
+        while True:
+            rows = [self._queue.get()]
+            flush_at = time.monotonic() + self.flush_interval
+            while len(rows) < self.batch_size:
+                remaining = flush_at - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    rows.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            try:
+                self.write_batch(rows, db)
+            except Exception as e:
+                record_error('history')
+                self.dropped += len(rows)
+                print(f"Failed to write {len(rows)} diagnoses to history: {str(e)}")
+            finally:
+                for _ in rows:
+                    self._queue.task_done()
+
+    def write_batch(self, rows, db=None):
+        """Insert rows (as built by record) and update the weekly counts in one transaction"""
+        db = db or self._db
+        counts = Counter((row[1] or '', week_of(row[0]), row[4] if row[6] else UNKNOWN_CLASS) for row in rows)
+        with db:
+            db.executemany(
+                "INSERT INTO diagnoses (created, field_id, latitude, longitude, top1, confidence, accepted, top_k, "
+                "model_version, image_hash, source) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            db.executemany(
+                "INSERT INTO weekly_counts (field_id, week, class_id, images) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (field_id, week, class_id) DO UPDATE SET images = images + excluded.images",
+                [key + (count,) for key, count in counts.items()])
+        self.written += len(rows)
+        self.batches += 1
+
+    def flush(self, timeout=10.0):
+        """Wait until every queued row is written; returns False on timeout"""
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks:
+            if time.monotonic() > deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def _query(self, sql, params=()):
+        with self._read_lock:
+            return self._db.execute(sql, params).fetchall()
+
+    def weekly_rates(self, class_ids, field_id=None, since=None, until=None):
+        """Share of diagnoses that were any of class_ids, per field and week
+
+        Rejected images count towards 'images' but not 'diagnosed', which
+        is the rate's denominator. since and until are Unix timestamps.
+        """
+        class_ids = [int(class_id) for class_id in class_ids]
+        if not class_ids:
+            raise ValueError("No disease classes given")
+        where, params = [], []
+        if field_id is not None:
+            where.append("field_id = ?")
+            params.append(field_id)
+        if since is not None:
+            where.append("week >= ?")
+            params.append(week_of(since))
+        if until is not None:
+            where.append("week <= ?")
+            params.append(week_of(until))
+        placeholders = ', '.join('?' * len(class_ids))
+        rows = self._query(
+            f"SELECT field_id, week, SUM(images) AS images, "
+            f"SUM(CASE WHEN class_id != {UNKNOWN_CLASS} THEN images ELSE 0 END) AS diagnosed, "
+            f"SUM(CASE WHEN class_id IN ({placeholders}) THEN images ELSE 0 END) AS matches "
+            f"FROM weekly_counts {'WHERE ' + ' AND '.join(where) if where else ''} "
+            f"GROUP BY field_id, week ORDER BY field_id, week",
+            class_ids + params)
+        return [{
+            'field_id': row['field_id'] or None,
+            'week_start': week_start(row['week']),
+            'images': row['images'],
+            'diagnosed': row['diagnosed'],
+            'matches': row['matches'],
+            'rate': row['matches'] / row['diagnosed'] if row['diagnosed'] else 0.0,
+        } for row in rows]
+
+    def fields(self):
+        """Fields with recorded diagnoses, their image counts and the dates of their first and last weeks"""
+        rows = self._query("SELECT field_id, SUM(images) AS images, MIN(week) AS first, MAX(week) AS last "
+                           "FROM weekly_counts GROUP BY field_id ORDER BY field_id")
+        return [{'field_id': row['field_id'] or None, 'images': row['images'],
+                 'first_week': week_start(row['first']), 'last_week': week_start(row['last'])} for row in rows]
+
+    def iter_diagnoses(self, field_id=None, since=None, until=None, fetch_size=1000):
+        """Yield diagnoses oldest first as dictionaries, reading fetch_size rows at a time
+
+        Uses its own connection, so a long export neither holds the read
+        lock nor blocks the writer (WAL readers see a consistent snapshot).
+        """
+        where, params = [], []
+        if field_id is not None:
+            where.append("field_id = ?")
+            params.append(field_id)
+        if since is not None:
+            where.append("created >= ?")
+            params.append(since)
+        if until is not None:
+            where.append("created < ?")
+            params.append(until)
+        db = _connect(self.path)
+        try:
+            cursor = db.execute(f"SELECT * FROM diagnoses {'WHERE ' + ' AND '.join(where) if where else ''} "
+                                f"ORDER BY created", params)
+            while True:
+                rows = cursor.fetchmany(fetch_size)
+                if not rows:
+                    return
+                for row in rows:
+                    yield dict(row)
+        finally:
+            db.close()
+
+    def stats(self):
+        return {
+            'queued': self._queue.qsize(),
+            'written': self.written,
+            'dropped': self.dropped,
+            'batches': self.batches,
+        }
+
+
+class _ChunkSink:
+    """Write-only file object collecting zip output until it is taken"""
+
+    def __init__(self):
+        self._parts = []
+        self.size = 0
+
+    def write(self, data):
+        self._parts.append(bytes(data))
+        self.size += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self._parts)
+        self._parts, self.size = [], 0
+        return data
+
+
+def iter_report_archive(store, class_names, field_id=None, since=None, until=None, chunk_bytes=256 * 1024):
+    """Stream a zip of diagnoses.csv and one text report per diagnosis as chunks of bytes
+
+    The archive is produced as the rows are read, so memory stays flat
+    however many diagnoses are exported; the zip format's data descriptors
+    make this possible without seeking back.
+    """
+    from disease_info import get_disease_info
+    from reports import create_download_report
+
+    def label(row):
+        return class_names[row['top1']] if row['accepted'] else UNKNOWN_LABEL
+
+    sink = _ChunkSink()
+    with zipfile.ZipFile(sink, 'w', zipfile.ZIP_DEFLATED) as archive:
+        with archive.open('diagnoses.csv', 'w', force_zip64=True) as entry:
+            text = io.TextIOWrapper(entry, encoding='utf-8', newline='')
+            writer = csv.DictWriter(text, fieldnames=EXPORT_FIELDS, extrasaction='ignore')
+            writer.writeheader()
+            for row in store.iter_diagnoses(field_id, since, until):
+                class_ids, confidences = json.loads(row['top_k'])
+                writer.writerow(dict(
+                    row, diagnosis=label(row),
+                    created=datetime.fromtimestamp(row['created'], timezone.utc).isoformat(timespec='seconds'),
+                    top_k=';'.join(f"{class_names[c]}:{p:.4f}" for c, p in zip(class_ids, confidences))))
+                if sink.size >= chunk_bytes:
+                    text.flush()
+                    yield sink.take()
+            text.flush()
+            text.detach()
+        yield sink.take()
+
+        for row in store.iter_diagnoses(field_id, since, until):
+            disease = class_names[row['top1']]
+            date = datetime.fromtimestamp(row['created'], timezone.utc).strftime('%Y-%m-%d %H:%M UTC')
+            if row['accepted']:
+                report = create_download_report(disease, row['confidence'], get_disease_info(disease) or {}, date)
+            else:
+                report = create_download_report(disease, row['confidence'], {}, date, accepted=False)
+            # Field ids are free text from the UI and API; keep entry names to plain file name characters
+            slug = re.sub(r'[^A-Za-z0-9_-]', '_', row['field_id'] or 'no-field')
+            archive.writestr(f"reports/{row['id']:08d}_{slug}.txt", report)
+            if sink.size >= chunk_bytes:
+                yield sink.take()
+    yield sink.take()
+
+
+_history = None
+_history_lock = threading.Lock()
+
+
+def history_enabled():
+    return bool(os.environ.get('HISTORY_PATH', DEFAULT_HISTORY_PATH))
+
+
+def get_history():
+    """Return the process-wide diagnosis history, configured from the environment, or None when disabled"""
+    global _history
+    if _history is None and history_enabled():
+        with _history_lock:
+            if _history is None:
+                _history = HistoryStore(
+                    os.environ.get('HISTORY_PATH', DEFAULT_HISTORY_PATH),
+                    batch_size=int(os.environ.get('HISTORY_BATCH_SIZE', 500)),
+                    flush_interval=float(os.environ.get('HISTORY_FLUSH_INTERVAL', 1.0)),
+                    max_queue=int(os.environ.get('HISTORY_MAX_QUEUE', 10000)),
+                )
+                metrics = get_metrics()
+                metrics.counter('plant_history_written_total', 'Diagnoses written to the history',
+                                fn=lambda: _history.written)
+                metrics.counter('plant_history_dropped_total', 'Diagnoses dropped because the history queue was full',
+                                fn=lambda: _history.dropped)
+    return _history
@@ -0,0 +1,117 @@
+"""Upload validation and decoding, shared by the Streamlit app and the HTTP server
+
+Kept free of Streamlit so the ASGI process does not import it.
+"""
+from PIL import Image
+import hashlib
+import io
+
+from metrics import span
+
+MAX_FILE_SIZE = 10 * 1024 * 1024
+MIN_IMAGE_SIZE = 50
+SUPPORTED_FORMATS = ['JPEG', 'PNG', 'JPG']
+# Decode large photos at the smallest JPEG scale that still covers both display and inference
+DECODE_SIZE = (672, 672)
+
+class ImageValidationError(Exception):
+    """Raised when an uploaded file is not an acceptable plant image"""
+
+class ImageUpload:
+    """An uploaded image that is validated from its header and decoded exactly once
+
+    The decoded image is shared by the on-screen preview and by inference,
+    so a large phone photo is never parsed or decompressed twice.
+    """
+    
+    def __init__(self, data, name=None):
+        self.data = data
+        self.name = name
+        self.format = None
+        self.size = None
+        self._image = None
+        self._sha256 = None
+    
+    @classmethod
+    def from_uploaded_file(cls, uploaded_file):
+        """Read a Streamlit UploadedFile (or any file object) once into memory"""
+        if hasattr(uploaded_file, 'getvalue'):
+            data = uploaded_file.getvalue()
+        else:
+            data = uploaded_file.read()
+        return cls(data, getattr(uploaded_file, 'name', None))
+    
+    def validate(self):
+        """Check file size, format and dimensions without decoding pixel data"""
+        with span('validate'):
+            return self._validate()
+    
+    def _validate(self):
+        if len(self.data) > MAX_FILE_SIZE:
+            raise ImageValidationError("File size too large. Please upload an image smaller than 10MB.")
+        
+        try:
+            # Image.open only parses the header; pixels are decoded on first access
+            with Image.open(io.BytesIO(self.data)) as header:
+                self.format = header.format
+                self.size = header.size
+        except Exception as e:
+            raise ImageValidationError(f"Error validating image: {str(e)}")
+        
+        if self.format not in SUPPORTED_FORMATS:
+            raise ImageValidationError("Unsupported image format. Please upload JPG, JPEG, or PNG images.")
+        
+        if self.size[0] < MIN_IMAGE_SIZE or self.size[1] < MIN_IMAGE_SIZE:
+            raise ImageValidationError("Image too small. Please upload an image at least 50x50 pixels.")
+        
+        return self
+    
+    @property
+    def image(self):
+        """The decoded RGB image, decoded on first access at reduced scale when possible"""
+        if self._image is None:
+            with span('decode'):
+                image = Image.open(io.BytesIO(self.data))
+                image.draft('RGB', DECODE_SIZE)
+                if image.mode != 'RGB':
+                    image = image.convert('RGB')
+                image.load()
+            self._image = image
+        return self._image
+
+    def decode_at(self, max_side):
+        """Decode a fresh RGB copy close to max_side pixels on the longest side (for tiled analysis)
+
+        Not cached: a near full-resolution photo is large and only needed once.
+        """
+        with span('decode'):
+            image = Image.open(io.BytesIO(self.data))
+            image.draft('RGB', (max_side, max_side))
+            if image.mode != 'RGB':
+                image = image.convert('RGB')
+            image.load()
+        return image
+
+    @property
+    def sha256(self):
+        """Hex digest of the raw file bytes"""
+        if self._sha256 is None:
+            self._sha256 = hashlib.sha256(self.data).hexdigest()
+        return self._sha256
+
+    @property
+    def gps(self):
+        """(latitude, longitude) from the photo's EXIF GPS tags, or None; read from the header only"""
+        try:
+            with Image.open(io.BytesIO(self.data)) as header:
+                tags = header.getexif().get_ifd(0x8825)
+            if 2 not in tags or 4 not in tags:
+                return None
+
+            def degrees(value, ref):
+                result = float(value[0]) + float(value[1]) / 60 + float(value[2]) / 3600
+                return -result if ref in ('S', 'W') else result
+
+            return degrees(tags[2], tags.get(1, 'N')), degrees(tags[4], tags.get(3, 'E'))
+        except Exception:
+            return None
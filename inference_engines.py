@@ -0,0 +1,336 @@
+import os
+import threading
+import time
+
+import numpy as np
+
+from model_utils import create_model, with_embedding
+
+ENGINE_KINDS = ['keras', 'function', 'tflite', 'cascade', 'specialist']
+# Batch sizes the function and TFLite engines run at; other sizes are padded up to the next one
+BATCH_BUCKETS = (1, 2, 4, 8, 16, 32, 64)
+XLA_MODES = ['off', 'on', 'auto']
+
+
+def batch_buckets():
+    """Bucketed batch sizes from INFERENCE_BATCH_BUCKETS (comma-separated), or the defaults"""
+    value = os.environ.get('INFERENCE_BATCH_BUCKETS')
+    if not value:
+        return BATCH_BUCKETS
+    return tuple(sorted({int(size) for size in value.split(',') if size.strip()}))
+
+
+def _pad_batch(batch, size):
+    """Zero-pad a batch to size rows"""
+    if len(batch) == size:
+        return batch
+    padded = np.empty((size,) + batch.shape[1:], dtype=batch.dtype)
+    padded[:len(batch)] = batch
+    padded[len(batch):] = 0
+    return padded
+
+
+class InferenceEngine:
+    """Common interface for the ways a model can be run
+
+    Engines expose the subset of the Keras model API the rest of the app
+    uses (predict_on_batch, predict and input_shape), so the registry, the
+    scheduler and the batch pipelines work with any backend unchanged.
+    """
+
+    kind = None
+    # Batch sizes run by warm_up; engines with fixed-shape graphs warm up each one
+    warmup_batch_sizes = (1,)
+    # Whether predict_with_embeddings is available (see similarity.py)
+    returns_embeddings = False
+    # Files besides the model path that the engine was built from; the registry hot-swaps when they change
+    source_paths = ()
+
+    def predict_on_batch(self, batch):
+        """Return class probabilities for a float32 (N, 224, 224, 3) batch"""
+        raise NotImplementedError
+
+    def predict_with_embeddings(self, batch):
+        """Return (probabilities, penultimate-layer features) for a batch from one forward pass"""
+        raise NotImplementedError(f"The {self.kind} engine does not return embeddings; "
+                                  "use INFERENCE_ENGINE=keras or specialist")
+
+    def predict(self, batch, verbose=0, batch_size=64):
+        batch = np.asarray(batch, dtype=np.float32)
+        if len(batch) <= batch_size:
+            return self.predict_on_batch(batch)
+        return np.concatenate([self.predict_on_batch(batch[i:i + batch_size])
+                               for i in range(0, len(batch), batch_size)])
+
+    @property
+    def input_shape(self):
+        return (None, 224, 224, 3)
+
+    @property
+    def size_bytes(self):
+        """Approximate memory held by the model parameters"""
+        return 0
+
+    def warm_up(self, steady_runs=3):
+        """Run each warm-up batch size once cold and then steady_runs times
+
+        Returns {batch size: {'first_call_ms', 'steady_ms'}}, also kept as
+        self.warmup_latency, so the cold-call penalty paid here (tracing,
+        allocation) can be compared with the steady-state latency requests see.
+        """
+        self.warmup_latency = {}
+        for batch_size in self.warmup_batch_sizes:
+            dummy = np.zeros((batch_size, 224, 224, 3), dtype=np.float32)
+            timings = []
+            for _ in range(steady_runs + 1):
+                start = time.perf_counter()
+                self.predict_on_batch(dummy)
+                timings.append((time.perf_counter() - start) * 1000)
+            self.warmup_latency[batch_size] = {
+                'first_call_ms': timings[0],
+                'steady_ms': float(np.median(timings[1:])) if steady_runs else timings[0],
+            }
+        return self.warmup_latency
+
+
+class KerasEngine(InferenceEngine):
+    """Run a Keras model through predict_on_batch"""
+
+    kind = 'keras'
+    def __init__(self, model):
+        self.model = model
+        self._with_embedding = None
+
+    def predict_on_batch(self, batch):
+        return np.asarray(self.model.predict_on_batch(batch))
+
+    @property
+    def returns_embeddings(self):
+        """True when the model ends in a Dense classifier, whose input is the embedding"""
+        if self._with_embedding is None:
+            # Shares the model's layers and weights; only the graph gains a second output
+            try:
+                self._with_embedding = with_embedding(self.model)
+            except ValueError as e:
+                print(f"Embeddings are not available for this model: {str(e)}")
+                self._with_embedding = False
+        return self._with_embedding is not False
+
+    def predict_with_embeddings(self, batch):
+        if not self.returns_embeddings:
+            return super().predict_with_embeddings(batch)
+        probabilities, embeddings = self._with_embedding.predict_on_batch(batch)
+        return np.asarray(probabilities), np.asarray(embeddings, dtype=np.float32)
+
+    @property
+    def input_shape(self):
+        return self.model.input_shape
+
+    @property
+    def size_bytes(self):
+        return int(sum(np.prod(w.shape) * np.dtype(getattr(w.dtype, 'as_numpy_dtype', w.dtype)).itemsize
+                       for w in self.model.weights))
+
+
+class FunctionEngine(InferenceEngine):
+    """Call a Keras model or SavedModel through a tf.function traced once per bucketed batch size
+
+    Every bucket in BATCH_BUCKETS (or INFERENCE_BATCH_BUCKETS) gets its own
+    fixed-shape concrete function, and batches are zero-padded up to the
+    nearest bucket, so varying request sizes never trigger retracing and
+    warm_up can trace every shape before the first request. XLA JIT
+    compilation (INFERENCE_XLA=on) fuses ops on CPU; 'auto' measures the
+    steady-state latency both ways during warm-up and keeps the faster.
+    """
+
+    kind = 'function'
+
+    def __init__(self, path, buckets=None, xla=None):
+        import tensorflow as tf
+
+        self._tf = tf
+        self._size_bytes = 0
+        self.buckets = tuple(sorted(buckets or batch_buckets()))
+        self.warmup_batch_sizes = self.buckets
+        self.xla = (xla or os.environ.get('INFERENCE_XLA', 'off')).lower()
+        if self.xla not in XLA_MODES:
+            raise ValueError(f"Unknown INFERENCE_XLA mode '{self.xla}'. Choose one of: {', '.join(XLA_MODES)}")
+
+        if os.path.isdir(path):
+            # SavedModel directory exported by `python -m plant_classifier convert`
+            loaded = tf.saved_model.load(path)
+            signature = loaded.signatures['serving_default']
+            output_name = next(iter(signature.structured_outputs))
+            self._keep_alive = loaded
+            self._call = lambda x: signature(x)[output_name]
+            self._size_bytes = int(sum(v.numpy().nbytes for v in loaded.variables))
+        else:
+            model = create_model(path)
+            self._keep_alive = model
+            self._call = lambda x: model(x, training=False)
+            self._size_bytes = KerasEngine(model).size_bytes
+
+        self._trace_lock = threading.Lock()
+        self._use_xla(self.xla == 'on')
+
+    def _use_xla(self, jit_compile):
+        with self._trace_lock:
+            self.jit_compile = jit_compile
+            self._fn = self._tf.function(self._call, jit_compile=jit_compile)
+            self._concrete = {}
+
+    def _concrete_function(self, bucket):
+        fn = self._concrete.get(bucket)
+        if fn is None:
+            with self._trace_lock:
+                fn = self._concrete.get(bucket)
+                if fn is None:
+                    fn = self._fn.get_concrete_function(self._tf.TensorSpec([bucket, 224, 224, 3], self._tf.float32))
+                    self._concrete[bucket] = fn
+        return fn
+
+    @property
+    def tracing_count(self):
+        """Graphs traced so far; stays at len(buckets) however batch sizes vary"""
+        return self._fn.experimental_get_tracing_count()
+
+    def bucket_for(self, batch_size):
+        return next((bucket for bucket in self.buckets if bucket >= batch_size), self.buckets[-1])
+
+    def predict_on_batch(self, batch):
+        batch = np.asarray(batch, dtype=np.float32)
+        largest = self.buckets[-1]
+        if len(batch) > largest:
+            return np.concatenate([self.predict_on_batch(batch[i:i + largest])
+                                   for i in range(0, len(batch), largest)])
+
+        count = len(batch)
+        bucket = self.bucket_for(count)
+        return self._concrete_function(bucket)(self._tf.constant(_pad_batch(batch, bucket))).numpy()[:count]
+
+    def warm_up(self, steady_runs=3):
+        """Trace and run every bucket; with INFERENCE_XLA=auto, first decide whether XLA pays off"""
+        if self.xla == 'auto':
+            probe = np.zeros((self.bucket_for(16), 224, 224, 3), dtype=np.float32)
+            latency = {}
+            for jit_compile in (False, True):
+                self._use_xla(jit_compile)
+                self.predict_on_batch(probe)
+                timings = []
+                for _ in range(max(steady_runs, 3)):
+                    start = time.perf_counter()
+                    self.predict_on_batch(probe)
+                    timings.append(time.perf_counter() - start)
+                latency[jit_compile] = float(np.median(timings))
+            self._use_xla(latency[True] < latency[False])
+            print(f"XLA {'enabled' if self.jit_compile else 'disabled'}: batch of {len(probe)} in "
+                  f"{latency[True] * 1000:.1f} ms with XLA vs {latency[False] * 1000:.1f} ms without")
+        return super().warm_up(steady_runs)
+
+    @property
+    def size_bytes(self):
+        return self._size_bytes
+
+
+def _tflite_interpreter(path, num_threads, use_xnnpack=True):
+    """Create a TFLite interpreter, preferring the standalone LiteRT runtime when installed"""
+    try:
+        from ai_edge_litert.interpreter import Interpreter, OpResolverType
+    except ImportError:
+        import tensorflow as tf
+        Interpreter = tf.lite.Interpreter
+        OpResolverType = tf.lite.experimental.OpResolverType
+    # The XNNPACK delegate is applied by default on CPU for float and int8 models.
+    # It repacks the weights into private memory; without it the builtin kernels
+    # read them straight from the memory-mapped model file.
+    resolver = OpResolverType.AUTO if use_xnnpack else OpResolverType.BUILTIN_WITHOUT_DEFAULT_DELEGATES
+    return Interpreter(model_path=path, num_threads=num_threads, experimental_op_resolver_type=resolver)
+
+
+class TFLiteEngine(InferenceEngine):
+    """Run a float16 or int8 TFLite model on CPU with XNNPACK
+
+    Resizing the input reallocates every tensor, so batches are zero-padded
+    up to the bucketed sizes of batch_buckets() and the interpreter is only
+    resized when the bucket changes, not for every new batch size.
+    """
+
+    kind = 'tflite'
+
+    def __init__(self, path, num_threads=None, use_xnnpack=True, buckets=None):
+        self.path = path
+        self.buckets = tuple(sorted(buckets or batch_buckets()))
+        self._interpreter = _tflite_interpreter(path, num_threads or os.cpu_count(), use_xnnpack)
+        self._input = self._interpreter.get_input_details()[0]
+        self._output = self._interpreter.get_output_details()[0]
+        self._batch_size = None
+        # Interpreters are not thread-safe; the bulk page and the scheduler may share one
+        self._lock = threading.Lock()
+
+    def _resize(self, batch_size):
+        if batch_size != self._batch_size:
+            self._interpreter.resize_tensor_input(self._input['index'], [batch_size, 224, 224, 3])
+            self._interpreter.allocate_tensors()
+            self._input = self._interpreter.get_input_details()[0]
+            self._output = self._interpreter.get_output_details()[0]
+            self._batch_size = batch_size
+
+    def bucket_for(self, batch_size):
+        return next((bucket for bucket in self.buckets if bucket >= batch_size), self.buckets[-1])
+
+    def predict_on_batch(self, batch):
+        batch = np.asarray(batch, dtype=np.float32)
+        largest = self.buckets[-1]
+        if len(batch) > largest:
+            return np.concatenate([self.predict_on_batch(batch[i:i + largest])
+                                   for i in range(0, len(batch), largest)])
+        with self._lock:
+            return self._invoke(_pad_batch(batch, self.bucket_for(len(batch))))[:len(batch)]
+
+    def _invoke(self, batch):
+        self._resize(len(batch))
+
+        # Fully quantized models take integer input: x_q = x / scale + zero_point
+        input_dtype = self._input['dtype']
+        if input_dtype != np.float32:
+            scale, zero_point = self._input['quantization']
+            info = np.iinfo(input_dtype)
+            batch = np.clip(np.round(batch / scale + zero_point), info.min, info.max).astype(input_dtype)
+
+        self._interpreter.set_tensor(self._input['index'], batch)
+        self._interpreter.invoke()
+        output = self._interpreter.get_tensor(self._output['index'])
+
+        if output.dtype != np.float32:
+            scale, zero_point = self._output['quantization']
+            output = (output.astype(np.float32) - zero_point) * scale
+        return output
+
+    @property
+    def size_bytes(self):
+        return os.path.getsize(self.path)
+
+
+def create_engine(path, kind=None):
+    """Load the model at path with the given engine kind (default: INFERENCE_ENGINE or inferred from path)"""
+    if not kind:
+        kind = os.environ.get('INFERENCE_ENGINE') or (
+            'tflite' if path.endswith('.tflite') else 'cascade' if path.endswith('.json') else 'keras')
+    if kind not in ENGINE_KINDS:
+        raise ValueError(f"Unknown inference engine '{kind}'. Choose one of: {', '.join(ENGINE_KINDS)}")
+
+    if kind == 'tflite':
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"TFLite model not found at {path}. Create it with `python -m plant_classifier convert`.")
+        return TFLiteEngine(path)
+    if kind == 'function':
+        return FunctionEngine(path)
+    if kind == 'cascade':
+        # Student and teacher are listed in the cascade file (see cascade.py)
+        from cascade import load_cascade
+        return load_cascade(path)
+    if kind == 'specialist':
+        # Per-crop heads on the model's backbone (see crops.py)
+        from crops import SpecialistEngine
+        return SpecialistEngine(path)
+    return KerasEngine(create_model(path))
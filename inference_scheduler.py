@@ -0,0 +1,238 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, InvalidStateError
+
+import numpy as np
+
+from metrics import get_metrics, record_error, span
+from postprocessing import get_calibration, postprocess_rows
+from crops import ANY_CROP, crop_masks, predict_with_crop, predict_with_crop_embeddings
+
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+
+
+class QueueFullError(Exception):
+    """Raised when the inference queue is full and the request is rejected"""
+
+
+def _resolve(future, result=None, error=None):
+    """Set a future's outcome unless the caller already cancelled it or it is already resolved
+
+    Raising here would kill the scheduler thread and strand every other request.
+    """
+    try:
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+    except InvalidStateError:
+        pass
+
+
+class _Request:
+    __slots__ = ('model', 'images', 'top_k', 'crop', 'embed', 'deadline', 'future')
+
+    def __init__(self, model, images, top_k, crop, embed, deadline):
+        self.model = model
+        self.images = images
+        self.top_k = top_k
+        self.crop = crop
+        self.embed = embed
+        self.deadline = deadline
+        self.future = Future()
+
+
+class InferenceScheduler:
+    """Queue single-image requests from all sessions and run them as micro-batches
+
+    A batch is flushed as soon as it holds ``max_batch_size`` images or the
+    oldest request has waited ``max_latency_ms``, whichever comes first.
+    Requests are only batched together when they target the same model, so a
+    hot-swapped model never mixes with the previous one inside a batch. A
+    request may carry several views of the same image (test-time
+    augmentation); their probabilities are averaged before top-k. Requests
+    with different crop hints share a batch; each is restricted to its own
+    crop's classes. A request may also ask for the image's embedding, which
+    comes from the same forward pass.
+    """
+
+    def __init__(self, max_batch_size=16, max_latency_ms=10.0, max_queue_size=256):
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency_ms / 1000.0
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._pending = None
+        self._lock = threading.Lock()
+        self._worker = None
+        self.batches_run = 0
+        self.images_run = 0
+        self.timeouts = 0
+        self.rejected = 0
+        self._batch_sizes = get_metrics().histogram(
+            'plant_inference_batch_size', 'Images per scheduled model call', buckets=BATCH_SIZE_BUCKETS)
+
+    def _ensure_worker(self):
+        if self._worker is not None and self._worker.is_alive():
+            return
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name='inference-scheduler', daemon=True)
+                self._worker.start()
+
+    def submit(self, model, image, top_k=3, timeout=30.0, crop=ANY_CROP, embed=False):
+        """Queue one preprocessed image and return a Future of its top-k predictions
+
+        ``image`` is a ``(224, 224, 3)`` array or a ``(K, 224, 224, 3)`` batch
+        of views of the same image. The future resolves to a prediction
+        record (see postprocessing.prediction_dtype) with the top_k class ids
+        and calibrated confidences, best first, and the rejection flag.
+        ``crop`` is a crop id from crops.resolve_crop limiting the classes
+        considered. With ``embed``, the future resolves to ``(record,
+        embedding)`` instead, the embedding being the penultimate-layer
+        features averaged over the views (see similarity.py).
+        """
+        if embed and not getattr(model, 'returns_embeddings', False):
+            raise ValueError(f"The {getattr(model, 'kind', None)} engine does not return embeddings; "
+                             "use INFERENCE_ENGINE=keras or specialist")
+        images = np.asarray(image, dtype=np.float32)
+        if images.ndim == 3:
+            images = images[np.newaxis]
+
+        request = _Request(model, images, top_k, crop, embed, time.monotonic() + timeout)
+        try:
+            self._queue.put_nowait(request)
+        except queue.Full:
+            self.rejected += 1
+            raise QueueFullError("Inference queue is full. Please try again in a moment.")
+        self._ensure_worker()
+        return request.future
+
+    def predict(self, model, image, top_k=3, timeout=30.0, crop=ANY_CROP, embed=False):
+        """Submit an image and block until its top-k predictions are ready"""
+        future = self.submit(model, image, top_k, timeout, crop, embed)
+        try:
+            return future.result(timeout=timeout)
+        except TimeoutError:
+            future.cancel()
+            raise
+
+    def queue_depth(self):
+        """Return the number of requests waiting to be batched"""
+        return self._queue.qsize() + (1 if self._pending is not None else 0)
+
+    def stats(self):
+        """Return batching counters as a plain dictionary"""
+        return {
+            'batches_run': self.batches_run,
+            'images_run': self.images_run,
+            'avg_batch_size': self.images_run / self.batches_run if self.batches_run else 0.0,
+            'queue_depth': self.queue_depth(),
+            'timeouts': self.timeouts,
+            'rejected': self.rejected,
+        }
+
+    def _next_request(self, timeout=None):
+        if self._pending is not None:
+            request, self._pending = self._pending, None
+            return request
+        return self._queue.get(timeout=timeout)
+
+    def _collect_batch(self):
+        """Block for the first request, then gather more until the batch is full or the deadline passes"""
+        first = self._next_request()
+        batch = [first]
+        batch_images = len(first.images)
+        flush_at = time.monotonic() + self.max_latency
+
+        while batch_images < self.max_batch_size:
+            remaining = flush_at - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                request = self._next_request(timeout=remaining)
+            except queue.Empty:
+                break
+            if request.model is not first.model:
+                # Leave requests for a different model to the next batch
+                self._pending = request
+                break
+            batch.append(request)
+            batch_images += len(request.images)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect_batch()
+
+            # Drop requests whose caller has given up or whose deadline has passed
+            now = time.monotonic()
+            live = []
+            for request in batch:
+                if request.deadline < now:
+                    self.timeouts += 1
+                    # A caller that gave up has usually cancelled the future already
+                    if request.future.set_running_or_notify_cancel():
+                        _resolve(request.future, error=TimeoutError("Inference request timed out in queue"))
+                elif request.future.set_running_or_notify_cancel():
+                    live.append(request)
+            if not live:
+                continue
+
+            try:
+                images = np.concatenate([request.images for request in live])
+                views = [len(request.images) for request in live]
+                crops = np.repeat([request.crop for request in live], views)
+                embed = any(request.embed for request in live)
+                with span('predict'):
+                    if embed:
+                        predictions, embeddings = predict_with_crop_embeddings(live[0].model, images, crops)
+                    else:
+                        predictions = predict_with_crop(live[0].model, images, crops)
+
+                # Average each request's views, then calibrate and take top-k for all requests at once
+                offsets = np.cumsum([0] + views)
+                if offsets[-1] == len(live):
+                    probabilities = predictions
+                else:
+                    probabilities = np.add.reduceat(predictions, offsets[:-1], axis=0) / np.diff(offsets)[:, None]
+                records = postprocess_rows(probabilities, [request.top_k for request in live], get_calibration(),
+                                           crop_masks([request.crop for request in live]))
+                if embed:
+                    embeddings = np.add.reduceat(embeddings, offsets[:-1], axis=0) / np.diff(offsets)[:, None]
+            except Exception as e:
+                # Fail every request in the batch rather than the scheduler thread
+                record_error('inference_batch')
+                for request in live:
+                    _resolve(request.future, error=e)
+                continue
+
+            self.batches_run += 1
+            self.images_run += len(images)
+            self._batch_sizes.observe(len(images))
+            for i, (request, record) in enumerate(zip(live, records)):
+                _resolve(request.future, (record, embeddings[i]) if request.embed else record)
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    """Return the process-wide inference scheduler, configured from the environment"""
+    global _scheduler
+    if _scheduler is None:
+        with _scheduler_lock:
+            if _scheduler is None:
+                _scheduler = InferenceScheduler(
+                    max_batch_size=int(os.environ.get('INFERENCE_MAX_BATCH_SIZE', 16)),
+                    max_latency_ms=float(os.environ.get('INFERENCE_MAX_LATENCY_MS', 10)),
+                    max_queue_size=int(os.environ.get('INFERENCE_MAX_QUEUE_SIZE', 256)),
+                )
+                metrics = get_metrics()
+                metrics.gauge('plant_inference_queue_depth', 'Requests waiting to be batched',
+                              fn=_scheduler.queue_depth)
+                metrics.counter('plant_inference_rejected_total', 'Requests rejected because the queue was full',
+                                fn=lambda: _scheduler.rejected)
+                metrics.counter('plant_inference_timeouts_total', 'Requests that expired in the queue',
+                                fn=lambda: _scheduler.timeouts)
+    return _scheduler
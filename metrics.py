@@ -0,0 +1,294 @@
+"""Lightweight in-process metrics: counters, gauges, histograms and tracing spans
+
+Metrics are exported in the Prometheus text format by ``render_prometheus``
+(served at ``/metrics`` by server.py, or by ``start_metrics_server`` for the
+Streamlit process) and summarized for the in-app debug panel by
+``snapshot``. Everything is thread-safe and cheap enough to leave on.
+"""
+import bisect
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Latency buckets in seconds, from sub-millisecond lookups to slow model loads
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+STAGE_METRIC = 'plant_stage_seconds'
+ERROR_METRIC = 'plant_errors_total'
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+class Counter:
+    """A monotonically increasing count, optionally per label set
+
+    With fn, the value is read from fn() at export time instead, for
+    counts that another component already keeps.
+    """
+
+    kind = 'counter'
+
+    def __init__(self, name, help='', fn=None):
+        self.name = name
+        self.help = help
+        self.fn = fn
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        if self.fn is not None:
+            return self.fn()
+        return self._values.get(_label_key(labels), 0)
+
+    def samples(self):
+        if self.fn is not None:
+            return [(self.name, (), self.fn())]
+        with self._lock:
+            return [(self.name, key, value) for key, value in self._values.items()]
+
+
+class Gauge(Counter):
+    """A value that can go up and down, set directly or read from fn() at export time"""
+
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[_label_key(labels)] = value
+
+
+class Histogram:
+    """Cumulative bucket counts, sum and count per label set"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help='', buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, (counts, total, count) in self._series.items():
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                    cumulative += bucket_count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    samples.append((f'{self.name}_bucket', key + (('le', le),), cumulative))
+                samples.append((f'{self.name}_sum', key, total))
+                samples.append((f'{self.name}_count', key, count))
+        return samples
+
+    def quantile(self, q, **labels):
+        """Estimate a quantile by linear interpolation within the matching bucket"""
+        with self._lock:
+            series = self._series.get(_label_key(labels))
+            if series is None or series[2] == 0:
+                return None
+            counts = list(series[0])
+            count = series[2]
+        target = q * count
+        cumulative = 0
+        for i, bucket_count in enumerate(counts):
+            if cumulative + bucket_count >= target and bucket_count:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (target - cumulative) / bucket_count
+            cumulative += bucket_count
+        return self.buckets[-1]
+
+    def summary(self):
+        """Return count, mean and estimated p50/p95/p99 for every label set"""
+        with self._lock:
+            keys = list(self._series)
+        result = {}
+        for key in keys:
+            labels = dict(key)
+            _, total, count = self._series[key]
+            result[key] = {
+                'count': count,
+                'mean': total / count if count else 0.0,
+                'p50': self.quantile(0.5, **labels),
+                'p95': self.quantile(0.95, **labels),
+                'p99': self.quantile(0.99, **labels),
+            }
+        return result
+
+
+class MetricsRegistry:
+    """Named metrics shared by the whole process; metrics are created on first use"""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, cls, name, **kwargs):
+        metric = self._metrics.get(name)
+        if metric is None:
+            with self._lock:
+                metric = self._metrics.get(name)
+                if metric is None:
+                    metric = self._metrics[name] = cls(name, **kwargs)
+        return metric
+
+    def counter(self, name, help='', fn=None):
+        return self._get_or_create(Counter, name, help=help, fn=fn)
+
+    def gauge(self, name, help='', fn=None):
+        return self._get_or_create(Gauge, name, help=help, fn=fn)
+
+    def histogram(self, name, help='', buckets=DEFAULT_BUCKETS):
+        return self._get_or_create(Histogram, name, help=help, buckets=buckets)
+
+    def render_prometheus(self):
+        """Return every metric in the Prometheus text exposition format"""
+        lines = []
+        for name, metric in sorted(self._metrics.items()):
+            try:
+                samples = metric.samples()
+            except Exception as e:
+                # A failing callback must not break the whole scrape
+                print(f"Failed to collect metric {name}: {str(e)}")
+                continue
+            if metric.help:
+                lines.append(f'# HELP {name} {metric.help}')
+            lines.append(f'# TYPE {name} {metric.kind}')
+            for sample_name, key, value in samples:
+                lines.append(f'{sample_name}{_format_labels(key)} {float(value):g}')
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        """Return a plain summary of every metric for the debug panel"""
+        result = {}
+        for name, metric in sorted(self._metrics.items()):
+            try:
+                if isinstance(metric, Histogram):
+                    result[name] = {_format_labels(key) or name: stats for key, stats in metric.summary().items()}
+                else:
+                    result[name] = {_format_labels(key) or name: value for _, key, value in metric.samples()}
+            except Exception:
+                continue
+        return result
+
+
+_registry = MetricsRegistry()
+_local = threading.local()
+
+
+def get_metrics():
+    """Return the process-wide metrics registry"""
+    return _registry
+
+
+@contextmanager
+def span(stage, **labels):
+    """Time a pipeline stage into the plant_stage_seconds histogram
+
+    Spans also land in the innermost active trace() on this thread, and an
+    exception escaping the span is counted as an error for the stage.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        record_error(stage)
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        _registry.histogram(STAGE_METRIC, 'Time spent in each pipeline stage').observe(elapsed, stage=stage, **labels)
+        spans = getattr(_local, 'trace', None)
+        if spans is not None:
+            spans.append((stage, elapsed))
+
+
+@contextmanager
+def trace():
+    """Collect the (stage, seconds) spans recorded on this thread while active"""
+    previous = getattr(_local, 'trace', None)
+    spans = []
+    _local.trace = spans
+    try:
+        yield spans
+    finally:
+        _local.trace = previous
+        if previous is not None:
+            previous.extend(spans)
+
+
+def record_error(site):
+    """Count an exception swallowed or re-raised by a broad except block"""
+    _registry.counter(ERROR_METRIC, 'Exceptions caught, by code site').inc(site=site)
+
+
+def render_prometheus():
+    return _registry.render_prometheus()
+
+
+_server = None
+
+
+def start_metrics_server(port=None, host='0.0.0.0'):
+    """Serve /metrics from a background thread (idempotent); port defaults to METRICS_PORT
+
+    Returns the server, or None when no port is configured.
+    """
+    global _server
+    port = port or os.environ.get('METRICS_PORT')
+    if not port or _server is not None:
+        return _server
+
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = render_prometheus().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    try:
+        _server = ThreadingHTTPServer((host, int(port)), MetricsHandler)
+    except OSError as e:
+        # Another Streamlit process on this host already serves the port
+        print(f"Metrics server not started on port {port}: {str(e)}")
+        return None
+    threading.Thread(target=_server.serve_forever, name='metrics-server', daemon=True).start()
+    print(f"Serving metrics on http://{host}:{port}/metrics")
+    return _server
@@ -0,0 +1,169 @@
+import os
+
+import numpy as np
+
+from model_utils import create_model, get_class_names, load_image_reduced, preprocess_batch
+from batch_processing import iter_directory, batched
+
+QUANTIZATION_MODES = ['float16', 'int8', 'dynamic', 'none']
+TFJS_QUANTIZATION_MODES = ['uint8', 'float16', 'none']
+# Served by the Vite web client as /model/
+DEFAULT_TFJS_DIR = os.path.join('public', 'model')
+
+
+def load_sample_images(data_dir=None, limit=200, seed=0):
+    """Return up to limit uint8 images from data_dir, or random images when no directory is given"""
+    if data_dir:
+        images = []
+        for path, _ in iter_directory(data_dir):
+            try:
+                images.append(load_image_reduced(path))
+            except Exception:
+                continue
+            if len(images) >= limit:
+                break
+        if images:
+            return images
+        raise Exception(f"No readable images found under {data_dir}")
+
+    rng = np.random.default_rng(seed)
+    return [rng.integers(0, 256, size=(224, 224, 3), dtype=np.uint8) for _ in range(min(limit, 32))]
+
+
+def export_saved_model(model_path, out_dir):
+    """Export the Keras model as a SavedModel for FunctionEngine"""
+    model = create_model(model_path)
+    if hasattr(model, 'export'):
+        model.export(out_dir)
+    else:
+        import tensorflow as tf
+        tf.saved_model.save(model, out_dir)
+    return out_dir
+
+
+def convert_to_tflite(model_path, out_path, quantization='float16', calibration_images=None):
+    """Convert the Keras model to TFLite
+
+    float16 halves the file size with near-identical accuracy; int8 is fully
+    integer (including input and output) and needs representative
+    calibration_images, ideally a few hundred real field photos.
+    """
+    import tensorflow as tf
+
+    if quantization not in QUANTIZATION_MODES:
+        raise ValueError(f"Unknown quantization '{quantization}'. Choose one of: {', '.join(QUANTIZATION_MODES)}")
+
+    model = create_model(model_path)
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+
+    if quantization == 'float16':
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.target_spec.supported_types = [tf.float16]
+    elif quantization == 'dynamic':
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    elif quantization == 'int8':
+        if not calibration_images:
+            raise ValueError("int8 quantization needs calibration images")
+
+        def representative_dataset():
+            for image in calibration_images:
+                yield [preprocess_batch([image])]
+
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = representative_dataset
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+        converter.inference_input_type = tf.int8
+        converter.inference_output_type = tf.int8
+
+    tflite_model = converter.convert()
+    with open(out_path, 'wb') as f:
+        f.write(tflite_model)
+    return out_path
+
+
+def check_parity(reference, candidate, images, batch_size=32):
+    """Compare a candidate engine's predictions with the float reference model on the same images"""
+    agree = top3_overlap = 0
+    max_abs_diff = 0.0
+    abs_diff_sum = 0.0
+    buffer = np.empty((batch_size, 224, 224, 3), dtype=np.float32)
+
+    for batch in batched(images, batch_size):
+        inputs = preprocess_batch(batch, out=buffer)
+        expected = np.asarray(reference.predict_on_batch(inputs))
+        actual = np.asarray(candidate.predict_on_batch(inputs))
+
+        agree += int(np.sum(expected.argmax(axis=1) == actual.argmax(axis=1)))
+        expected_top3 = np.argsort(expected, axis=1)[:, -3:]
+        actual_top3 = np.argsort(actual, axis=1)[:, -3:]
+        top3_overlap += sum(len(set(e) & set(a)) for e, a in zip(expected_top3, actual_top3))
+        diff = np.abs(expected - actual)
+        max_abs_diff = max(max_abs_diff, float(diff.max()))
+        abs_diff_sum += float(diff.sum())
+
+    count = len(images)
+    return {
+        'images': count,
+        'top1_agreement': agree / count,
+        'top3_overlap': top3_overlap / (3 * count),
+        'max_abs_diff': max_abs_diff,
+        'mean_abs_diff': abs_diff_sum / (count * expected.shape[1]),
+    }
+
+
+def default_artifact_path(model_path, quantization):
+    """plant_disease_model.keras -> plant_disease_model_int8.tflite"""
+    stem = os.path.splitext(model_path)[0]
+    return f"{stem}_{quantization}.tflite" if quantization != 'none' else f"{stem}.tflite"
+
+
+def export_tfjs(model_path, out_dir=DEFAULT_TFJS_DIR, quantization='uint8'):
+    """Convert the Keras model to a quantized TF.js graph model for in-browser inference
+
+    Writes model.json, the weight shards and metadata.json (class names and
+    a content version the web client uses as its IndexedDB cache key) to
+    out_dir. uint8 quantization makes the download about 4x smaller than
+    float32; float16 about 2x, with smaller accuracy loss. Needs the
+    tensorflowjs package.
+    """
+    import hashlib
+    import json
+    import shutil
+    import tempfile
+
+    if quantization not in TFJS_QUANTIZATION_MODES:
+        raise ValueError(f"Unknown quantization '{quantization}'. Choose one of: {', '.join(TFJS_QUANTIZATION_MODES)}")
+    try:
+        from tensorflowjs.converters import convert_tf_saved_model
+    except ImportError:
+        raise Exception("TF.js export needs the tensorflowjs package: pip install tensorflowjs")
+
+    saved_model_dir = tempfile.mkdtemp(prefix='tfjs_export_')
+    try:
+        export_saved_model(model_path, saved_model_dir)
+        if os.path.isdir(out_dir):
+            shutil.rmtree(out_dir)
+        # Graph models skip the Keras layer machinery in the browser and load faster than layers models
+        convert_tf_saved_model(
+            saved_model_dir, out_dir,
+            quantization_dtype_map={quantization: True} if quantization != 'none' else None,
+        )
+    except Exception as e:
+        raise Exception(f"Failed to export TF.js model: {str(e)}")
+    finally:
+        shutil.rmtree(saved_model_dir, ignore_errors=True)
+
+    digest = hashlib.sha256()
+    for name in sorted(os.listdir(out_dir)):
+        with open(os.path.join(out_dir, name), 'rb') as f:
+            digest.update(f.read())
+    metadata = {
+        'version': digest.hexdigest()[:12],
+        'quantization': quantization,
+        'input_size': [224, 224],
+        'class_names': get_class_names(),
+        'bytes': sum(os.path.getsize(os.path.join(out_dir, name)) for name in os.listdir(out_dir)),
+    }
+    with open(os.path.join(out_dir, 'metadata.json'), 'w') as f:
+        json.dump(metadata, f, indent=2)
+    return metadata
@@ -0,0 +1,267 @@
+import hashlib
+import os
+import threading
+import time
+import resource
+
+import numpy as np
+
+from inference_engines import create_engine
+from metrics import get_metrics, record_error
+from model_utils import file_signature
+from postprocessing import get_calibration
+from startup_timing import mark_once
+
+DEFAULT_MODEL_PATH = os.environ.get('MODEL_PATH', 'plant_disease_model.keras')
+
+
+def _current_rss_bytes():
+    """Return the resident set size of this process in bytes"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        # ru_maxrss is the peak RSS (kilobytes on Linux, bytes on macOS)
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if os.uname().sysname == 'Darwin' else peak * 1024
+
+
+def _weights_bytes(model):
+    """Return the total size of the model weights in bytes"""
+    try:
+        return int(model.size_bytes)
+    except Exception:
+        return 0
+
+
+class ModelEntry:
+    """A loaded model together with its load statistics"""
+
+    def __init__(self, name, path, model, load_seconds, warmup_seconds, rss_delta_bytes, warmup_latency=None):
+        self.name = name
+        self.path = path
+        self.model = model
+        self.engine = getattr(model, 'kind', None)
+        self.load_seconds = load_seconds
+        self.warmup_seconds = warmup_seconds
+        self.rss_delta_bytes = rss_delta_bytes
+        self.warmup_latency = warmup_latency or {}
+        self.weights_bytes = _weights_bytes(model)
+        # The model file plus what the engine also read: cascade stages, specialist heads
+        self.paths = [path] + list(getattr(model, 'source_paths', ()))
+        self.signature = self.current_signature()
+        self.loaded_at = time.time()
+
+    def current_signature(self):
+        return tuple(file_signature(path) for path in self.paths)
+
+    @property
+    def version(self):
+        """Identify the loaded weights by file name, the (mtime_ns, size) of every file loaded, and engine"""
+        digest = hashlib.blake2b(repr(self.signature).encode(), digest_size=6).hexdigest()
+        return f"{os.path.basename(self.path)}@{digest}/{self.engine}"
+
+    def stats(self):
+        """Return load time and memory use as a plain dictionary"""
+        return {
+            'name': self.name,
+            'path': self.path,
+            'version': self.version,
+            'engine': self.engine,
+            'watched_paths': self.paths,
+            'load_seconds': self.load_seconds,
+            'warmup_seconds': self.warmup_seconds,
+            'weights_mb': self.weights_bytes / (1024 * 1024),
+            'rss_delta_mb': self.rss_delta_bytes / (1024 * 1024),
+            'warmup_latency': self.warmup_latency,
+            # Engines that route between models (cascade) report how they did
+            'engine_stats': self.model.stats() if hasattr(self.model, 'stats') else None,
+            'loaded_at': self.loaded_at,
+        }
+
+
+class ModelRegistry:
+    """Process-wide registry that loads each model once and shares it across sessions"""
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._load_locks = {}
+        self._preloads = {}
+        self._watcher = None
+        self._stop_watching = threading.Event()
+
+    def _load_lock(self, name):
+        with self._lock:
+            return self._load_locks.setdefault(name, threading.Lock())
+
+    def _load(self, name, path, engine=None):
+        """Load and warm up a model without touching the registry"""
+        rss_before = _current_rss_bytes()
+        start = time.perf_counter()
+        model = create_engine(path, engine)
+        load_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        warmup_latency = warm_up(model)
+        warmup_seconds = time.perf_counter() - start
+
+        entry = ModelEntry(name, path, model, load_seconds, warmup_seconds,
+                           max(_current_rss_bytes() - rss_before, 0), warmup_latency)
+        metrics = get_metrics()
+        for batch_size, latency in warmup_latency.items():
+            metrics.gauge('plant_model_first_call_seconds', 'Latency of the first (cold) call during warm-up').set(
+                latency['first_call_ms'] / 1000, model=name, engine=entry.engine, batch=batch_size)
+            metrics.gauge('plant_model_steady_call_seconds', 'Steady-state latency measured during warm-up').set(
+                latency['steady_ms'] / 1000, model=name, engine=entry.engine, batch=batch_size)
+        metrics.histogram('plant_model_load_seconds', 'Time to load a model').observe(
+            load_seconds, model=name, engine=entry.engine)
+        metrics.histogram('plant_model_warmup_seconds', 'Time for the warm-up forward pass').observe(
+            warmup_seconds, model=name, engine=entry.engine)
+        print(f"Model '{name}' loaded from {path} in {load_seconds:.2f}s "
+              f"(warm-up {warmup_seconds:.2f}s, weights {entry.stats()['weights_mb']:.1f} MB)")
+        mark_once('model_ready')
+        return entry
+
+    def get_entry(self, name='default', path=DEFAULT_MODEL_PATH, engine=None):
+        """Return the entry for a model, loading it on first use
+
+        engine selects the inference backend (see inference_engines.ENGINE_KINDS).
+        """
+        entry = self._entries.get(name)
+        if entry is not None:
+            return entry
+
+        # Only one thread loads a given model; the others wait for it
+        with self._load_lock(name):
+            entry = self._entries.get(name)
+            if entry is None:
+                entry = self._load(name, path, engine)
+                with self._lock:
+                    self._entries[name] = entry
+            return entry
+
+    def get(self, name='default', path=DEFAULT_MODEL_PATH, engine=None):
+        """Return the shared model instance, loading it on first use"""
+        return self.get_entry(name, path, engine).model
+
+    def preload(self, name='default', path=DEFAULT_MODEL_PATH, engine=None):
+        """Start loading and warming up a model in a background thread (idempotent)"""
+        with self._lock:
+            if name in self._entries or name in self._preloads:
+                return self._preloads.get(name)
+
+            def load():
+                try:
+                    self.get_entry(name, path, engine)
+                except Exception as e:
+                    record_error('model_preload')
+                    # The next foreground get() retries and surfaces the error
+                    print(f"Background load of model '{name}' failed: {str(e)}")
+
+            thread = threading.Thread(target=load, name=f'model-preload-{name}', daemon=True)
+            self._preloads[name] = thread
+        thread.start()
+        return thread
+
+    def swap(self, path, name='default', engine=None):
+        """Load a new model file and atomically replace the current one
+
+        Requests already holding the old model finish on it; new requests
+        get the new model as soon as it is warmed up. The engine defaults to
+        the one the current model uses.
+        """
+        with self._load_lock(name):
+            current = self._entries.get(name)
+            entry = self._load(name, path, engine or (current.engine if current else None))
+            with self._lock:
+                self._entries[name] = entry
+        return entry
+
+    def reload_if_changed(self, name='default'):
+        """Hot-swap a model when any file it was loaded from changed on disk; return True if swapped"""
+        entry = self._entries.get(name)
+        if entry is None or not os.path.exists(entry.path):
+            return False
+        if entry.current_signature() == entry.signature:
+            return False
+        try:
+            self.swap(entry.path, name)
+            return True
+        except Exception as e:
+            record_error('model_hot_swap')
+            # Keep serving the previous model if the new file is broken
+            print(f"Failed to hot-swap model '{name}': {str(e)}")
+            return False
+
+    def start_watcher(self, interval=30.0):
+        """Poll loaded model files in the background and hot-swap them when they change
+
+        The calibration file is checked too. It is applied after inference,
+        so a new one is just reloaded; its version is part of every cache key.
+        """
+        with self._lock:
+            if self._watcher is not None and self._watcher.is_alive():
+                return
+
+            def watch():
+                while not self._stop_watching.wait(interval):
+                    for name in list(self._entries):
+                        self.reload_if_changed(name)
+                    try:
+                        get_calibration()
+                    except Exception as e:
+                        record_error('calibration_reload')
+                        print(f"Failed to reload the calibration: {str(e)}")
+
+            self._stop_watching.clear()
+            self._watcher = threading.Thread(target=watch, name='model-watcher', daemon=True)
+            self._watcher.start()
+
+    def stop_watcher(self):
+        """Stop the background file watcher"""
+        self._stop_watching.set()
+
+    def version_of(self, model):
+        """Return the version of a model instance held by the registry, or None"""
+        for entry in list(self._entries.values()):
+            if entry.model is model:
+                return entry.version
+        return None
+
+    def is_loaded(self, name='default'):
+        """Return True if the model is loaded and warmed up"""
+        return name in self._entries
+
+    def stats(self):
+        """Return load statistics for every loaded model plus current process RSS"""
+        return {
+            'process_rss_mb': _current_rss_bytes() / (1024 * 1024),
+            'models': {name: entry.stats() for name, entry in list(self._entries.items())},
+        }
+
+
+def warm_up(model):
+    """Run dummy forward passes so the first real request does not pay for tracing
+
+    Engines report first-call and steady-state latency per batch size
+    (see InferenceEngine.warm_up); a bare Keras model gets one dummy pass and
+    an empty report.
+    """
+    if hasattr(model, 'warm_up'):
+        return model.warm_up()
+    shape = getattr(model, 'input_shape', None) or (None, 224, 224, 3)
+    if isinstance(shape, list):
+        shape = shape[0]
+    dummy = np.zeros((1,) + tuple(dim or 224 for dim in shape[1:]), dtype=np.float32)
+    model.predict(dummy, verbose=0)
+    return {}
+
+
+_registry = ModelRegistry()
+get_metrics().gauge('plant_models_loaded', 'Models loaded in this process', fn=lambda: len(_registry._entries))
+
+
+def get_registry():
+    """Return the process-wide model registry"""
+    return _registry
@@ -1,9 +1,14 @@
-import tensorflow as tf
 import numpy as np
 from PIL import Image
-import cv2
 import os
 
+from metrics import span
+
+# TensorFlow and OpenCV take seconds to import, so they are imported inside
+# the functions that need them; importing this module stays cheap.
+
+MODEL_INPUT_SIZE = (224, 224)
+
 def get_class_names():
     """Return the list of 38 plant disease class names"""
     return [
@@ -47,12 +52,27 @@ def get_class_names():
         'Tomato___healthy'
     ]
 
-def create_model():
+def file_signature(path):
+    """(mtime_ns, size) of a file, or of the newest file and total size for a directory; None if missing
+
+    Used to version models: whole-second mtimes miss a file replaced twice
+    within a second, and the size catches a copy that kept its timestamp.
+    """
+    if os.path.isdir(path):
+        stats = [os.stat(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names]
+        return (max((stat.st_mtime_ns for stat in stats), default=0), sum(stat.st_size for stat in stats))
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+def create_model(model_path='plant_disease_model.keras'):
     """Create and return the plant disease classification model"""
     try:
         # Check if a saved model exists
-        model_path = 'plant_disease_model.keras'  # Change this to your .keras model filename
         if os.path.exists(model_path):
+            import tensorflow as tf
             model = tf.keras.models.load_model(model_path)
             print(f"Successfully loaded pre-trained model from {model_path}")
             return model
@@ -62,26 +82,97 @@ def create_model():
     except Exception as e:
         raise Exception(f"Failed to create model: {str(e)}")
 
+def classifier_layer(model):
+    """Return the final Dense layer of a Keras classifier, skipping a trailing softmax"""
+    import tensorflow as tf
+
+    for layer in reversed(model.layers):
+        if isinstance(layer, tf.keras.layers.Dense):
+            return layer
+        if not isinstance(layer, (tf.keras.layers.Softmax, tf.keras.layers.Activation)):
+            raise ValueError(f"Expected the model to end in a Dense layer, found {type(layer).__name__}")
+    raise ValueError("Model has no Dense classification layer")
+
+def split_classifier(model):
+    """Split a Keras classifier into its feature extractor and final Dense layer
+
+    Returns (backbone, kernel, bias): backbone maps images to the
+    penultimate features, and softmax(features @ kernel + bias) reproduces
+    the model's output.
+    """
+    import tensorflow as tf
+
+    layer = classifier_layer(model)
+    backbone = tf.keras.Model(model.inputs, layer.input, name='backbone')
+    kernel, bias = [np.asarray(weight, dtype=np.float32) for weight in layer.get_weights()]
+    return backbone, kernel, bias
+
+def with_embedding(model):
+    """Wrap a Keras classifier so one forward pass returns [probabilities, penultimate features]
+
+    The features are the input of the final Dense layer, which the model
+    computes anyway, so asking for them costs no extra inference.
+    """
+    import tensorflow as tf
+
+    return tf.keras.Model(model.inputs, [model.outputs[0], classifier_layer(model).input], name='with_embedding')
+
+def resize_to_input(image, size=MODEL_INPUT_SIZE):
+    """Convert a PIL image or RGB array to a uint8 array of the model input size"""
+    if isinstance(image, Image.Image):
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        image = np.asarray(image)
+    
+    if image.shape[:2] == (size[1], size[0]):
+        return image
+    
+    import cv2
+    
+    # INTER_AREA averages source pixels when shrinking, which avoids aliasing
+    interpolation = cv2.INTER_AREA if image.shape[0] > size[1] else cv2.INTER_LINEAR
+    return cv2.resize(image, size, interpolation=interpolation)
+
+def load_image_reduced(source, size=MODEL_INPUT_SIZE):
+    """Decode an image file straight to model resolution, returning a uint8 RGB array"""
+    try:
+        with span('decode'), Image.open(source) as image:
+            # JPEG draft mode makes libjpeg decode at 1/2, 1/4 or 1/8 scale,
+            # the smallest that is still at least the requested size
+            image.draft('RGB', size)
+            return resize_to_input(image, size)
+    except Exception as e:
+        raise Exception(f"Failed to load image: {str(e)}")
+
+def allocate_batch(batch_size, size=MODEL_INPUT_SIZE):
+    """Allocate a reusable float32 input buffer for preprocess_batch"""
+    return np.empty((batch_size, size[1], size[0], 3), dtype=np.float32)
+
+def preprocess_batch(images, out=None):
+    """Preprocess PIL images or uint8 arrays into one float32 batch scaled to [0, 1]
+
+    Pixels are normalized straight into ``out`` (see allocate_batch) when it
+    is given, so a long-running loop allocates its input buffer only once.
+    Returns a view of the first len(images) rows.
+    """
+    if out is None or out.shape[0] < len(images):
+        out = allocate_batch(len(images))
+    batch = out[:len(images)]
+    
+    with span('preprocess'):
+        if isinstance(images, np.ndarray) and images.shape[1:3] == batch.shape[1:3]:
+            # Already at model resolution (e.g. a tensor store chunk): normalize in one pass
+            np.multiply(images, np.float32(1.0 / 255.0), out=batch)
+        else:
+            for i, image in enumerate(images):
+                np.multiply(resize_to_input(image), np.float32(1.0 / 255.0), out=batch[i])
+    
+    return batch
+
 def preprocess_image(image):
     """Preprocess image for model prediction"""
     try:
-        # Convert PIL image to RGB if needed
-        if image.mode != 'RGB':
-            image = image.convert('RGB')
-        
-        # Resize to model input size
-        image = image.resize((224, 224))
-        
-        # Convert to numpy array
-        img_array = np.array(image)
-        
-        # Normalize pixel values to [0, 1]
-        img_array = img_array.astype(np.float32) / 255.0
-        
-        # Add batch dimension
-        img_array = np.expand_dims(img_array, axis=0)
-        
-        return img_array
+        return preprocess_batch([image])
         
     except Exception as e:
         raise Exception(f"Failed to preprocess image: {str(e)}")
@@ -89,6 +180,8 @@ def preprocess_image(image):
 def apply_augmentation(image):
     """Apply data augmentation similar to the training process"""
     try:
+        import cv2
+        
         # Convert PIL to OpenCV format
         img_array = np.array(image)
         
@@ -112,3 +205,37 @@ def apply_augmentation(image):
     except Exception as e:
         # Return original image if augmentation fails
         return image
+
+# Deterministic counterparts of the training augmentation (flips and rotations),
+# ordered so that the first 4 and all 8 views each form a symmetric set
+TTA_TRANSFORMS = [
+    lambda x: x,                               # identity
+    lambda x: x[:, ::-1],                      # horizontal flip
+    lambda x: x[::-1, :],                      # vertical flip
+    lambda x: x[::-1, ::-1],                   # rotate 180
+    lambda x: np.rot90(x, 1),                  # rotate 90
+    lambda x: np.rot90(x, 3),                  # rotate 270
+    lambda x: np.swapaxes(x, 0, 1),            # transpose
+    lambda x: np.swapaxes(x, 0, 1)[::-1, ::-1] # anti-transpose
+]
+
+def augmentation_views(image_array, num_views=4, out=None):
+    """Build num_views deterministic flipped/rotated views of one preprocessed image as a single batch
+
+    image_array is a (224, 224, 3) array or a batch of one. The views are
+    strided NumPy views copied once into the (num_views, 224, 224, 3) result,
+    so the whole set can go through the model in one predict call.
+    """
+    if not 1 <= num_views <= len(TTA_TRANSFORMS):
+        raise ValueError(f"num_views must be between 1 and {len(TTA_TRANSFORMS)}")
+    
+    image_array = np.asarray(image_array)
+    if image_array.ndim == 4:
+        image_array = image_array[0]
+    
+    if out is None:
+        out = np.empty((num_views,) + image_array.shape, dtype=image_array.dtype)
+    with span('augment'):
+        for i, transform in enumerate(TTA_TRANSFORMS[:num_views]):
+            out[i] = transform(image_array)
+    return out[:num_views]
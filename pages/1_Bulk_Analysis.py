@@ -0,0 +1,136 @@
+import os
+import streamlit as st
+from model_utils import get_class_names
+from model_registry import get_registry
+from batch_processing import (
+    iter_uploaded_files, iter_directory, count_sources, classify_stream,
+    ResultWriter, ThroughputMeter
+)
+from dedup import Deduplicator, DEFAULT_MAX_DISTANCE
+from history import get_history
+from postprocessing import UNKNOWN_LABEL
+
+st.set_page_config(
+    page_title="Bulk Analysis - Plant Disease Classifier",
+    page_icon="🌱",
+    layout="wide"
+)
+
+def load_model():
+    """Load the shared pre-trained model"""
+    try:
+        with st.spinner("Loading AI model... This may take a moment."):
+            return get_registry().get()
+    except Exception as e:
+        st.error(f"Error loading model: {str(e)}")
+        return None
+
+def main():
+    st.title("📦 Bulk Plant Disease Analysis")
+    st.markdown("Classify a whole scouting run at once: upload many photos, a zip archive, or point to a folder on the server.")
+
+    uploaded_files = st.file_uploader(
+        "Choose plant images or zip archives",
+        type=['jpg', 'jpeg', 'png', 'zip'],
+        accept_multiple_files=True,
+        help="You can select many files at once, or upload a .zip of photos"
+    )
+    directory = st.text_input("...or a folder path on the server", help="All JPG/PNG images under this folder are analysed")
+    field_id = st.text_input("Field ID", help="Stored with every diagnosis of this run for the Field History page")
+    batch_size = st.select_slider("Batch size", options=[8, 16, 32, 64, 128], value=32)
+    skip_duplicates = st.checkbox(
+        "Skip near-duplicate shots", value=True,
+        help="Burst shots of the same leaf are grouped by perceptual hash; one photo per group is analysed "
+             "and its result is reused for the rest"
+    )
+    max_distance = DEFAULT_MAX_DISTANCE
+    if skip_duplicates:
+        max_distance = st.select_slider(
+            "Duplicate sensitivity (differing hash bits allowed)", options=[0, 4, 8, 12], value=DEFAULT_MAX_DISTANCE,
+            help="0 only matches practically identical images; higher values also group shots taken from "
+                 "slightly different angles"
+        )
+
+    if directory and not os.path.isdir(directory):
+        st.error("Folder not found on the server.")
+        return
+
+    if not uploaded_files and not directory:
+        st.info("👆 Upload images or enter a folder path to start the analysis")
+        return
+
+    if st.button("🔬 Analyze All Images", type="primary"):
+        run_analysis(uploaded_files, directory, batch_size, Deduplicator(max_distance) if skip_duplicates else None,
+                     field_id)
+
+    # Keep the last run's files across reruns, since clicking a download button reruns the page
+    if 'bulk_results' in st.session_state:
+        results = st.session_state.bulk_results
+        col1, col2 = st.columns(2)
+        with col1:
+            st.download_button("⬇️ Download CSV", results['csv'], file_name="plant_disease_results.csv", mime="text/csv")
+        with col2:
+            st.download_button("⬇️ Download JSONL", results['jsonl'], file_name="plant_disease_results.jsonl", mime="application/jsonl")
+
+def run_analysis(uploaded_files, directory, batch_size, deduplicator=None, field_id=None):
+    """Stream every image through the model in batches, updating the page as results arrive"""
+    model = load_model()
+    if model is None:
+        return
+    history = get_history()
+    model_version = get_registry().version_of(model)
+    class_ids = {name: i for i, name in enumerate(get_class_names())}
+
+    def sources():
+        yield from iter_uploaded_files(uploaded_files or [])
+        if directory:
+            yield from iter_directory(directory)
+
+    total = count_sources(uploaded_files, directory)
+    if total == 0:
+        st.warning("No JPG, JPEG or PNG images found.")
+        return
+
+    progress = st.progress(0.0, text=f"Analyzing 0 of {total} images...")
+    table = st.empty()
+    writer = ResultWriter()
+    meter = ThroughputMeter()
+    recent = []
+
+    for result in classify_stream(model, sources(), get_class_names(), batch_size=batch_size,
+                                  deduplicator=deduplicator):
+        writer.write(result)
+        meter.update()
+        if history is not None and result['top_k']:
+            history.record([[class_ids[name] for name, _ in result['top_k']], [c for _, c in result['top_k']],
+                            result['disease'] != UNKNOWN_LABEL],
+                           model_version=model_version, field_id=field_id, source='bulk')
+
+        # Show the most recent results only, so the page stays light for huge runs
+        recent.append({
+            'File': os.path.basename(result['file']),
+            'Diagnosis': result['disease'] or '—',
+            'Confidence': f"{result['confidence'] * 100:.1f}%" if result['confidence'] is not None else '—',
+            'Duplicate of': os.path.basename(result['duplicate_of']) if result['duplicate_of'] else '',
+            'Error': result['error'] or ''
+        })
+        recent = recent[-200:]
+
+        if meter.count % batch_size == 0 or meter.count == total:
+            progress.progress(
+                min(meter.count / total, 1.0),
+                text=f"Analyzed {meter.count} of {total} images ({meter.rate:.1f} images/sec)"
+            )
+            table.dataframe(recent, use_container_width=True)
+
+    progress.progress(1.0, text=f"Analyzed {meter.count} images ({meter.rate:.1f} images/sec)")
+    table.dataframe(recent, use_container_width=True)
+    st.success(f"✅ Analysis complete: {writer.count - writer.errors} classified, {writer.errors} failed")
+    if deduplicator is not None:
+        stats = deduplicator.stats()
+        st.info(f"🔁 {stats['model_calls_saved']} of {stats['images']} images were near-duplicates in "
+                f"{stats['duplicate_groups']} groups: {stats['model_calls_saved']} model calls saved "
+                f"({stats['saved_fraction'] * 100:.0f}%)")
+    st.session_state.bulk_results = {'csv': writer.csv(), 'jsonl': writer.jsonl()}
+
+main()
@@ -0,0 +1,76 @@
+import time
+
+import streamlit as st
+from model_utils import get_class_names
+from history import get_history, iter_report_archive
+from utils import format_disease_name
+
+st.set_page_config(
+    page_title="Field History - Plant Disease Classifier",
+    page_icon="🌱",
+    layout="wide"
+)
+
+def main():
+    st.title("🗺️ Field History")
+    st.markdown("Track how often a disease is diagnosed per field and week, and export the reports.")
+
+    history = get_history()
+    if history is None:
+        st.info("Diagnosis history is turned off (HISTORY_PATH is empty).")
+        return
+
+    fields = history.fields()
+    if not fields:
+        st.info("No diagnoses recorded yet. Analyze some photos on the main page or in Bulk Analysis.")
+        return
+
+    class_names = get_class_names()
+    # Diagnoses without a field ID are only included under "All fields"
+    labels = {field['field_id']: f"{field['field_id']} ({field['images']} images)"
+              for field in fields if field['field_id']}
+    col1, col2, col3 = st.columns([1, 2, 1])
+    with col1:
+        field_id = st.selectbox("Field", options=[None, *labels], index=0,
+                                format_func=lambda value: "All fields" if value is None else labels[value])
+    with col2:
+        diseases = st.multiselect(
+            "Diseases", options=class_names, format_func=format_disease_name,
+            default=[name for name in class_names if name.endswith('Late_blight')],
+            help="The rate is the share of a week's diagnoses that were any of these diseases"
+        )
+    with col3:
+        weeks = st.slider("Weeks", min_value=4, max_value=104, value=12)
+
+    since = time.time() - weeks * 7 * 24 * 3600
+    if diseases:
+        start = time.perf_counter()
+        rates = history.weekly_rates([class_names.index(name) for name in diseases], field_id, since)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        if rates:
+            chart = {}
+            for row in rates:
+                chart.setdefault(row['week_start'], {})[row['field_id'] or 'No field ID'] = row['rate'] * 100
+            st.line_chart([{'week': week, **values} for week, values in sorted(chart.items())], x='week')
+            st.dataframe([{
+                'Field': row['field_id'] or '—',
+                'Week of': row['week_start'],
+                'Images': row['images'],
+                'Diagnosed': row['diagnosed'],
+                'Matches': row['matches'],
+                'Rate': f"{row['rate'] * 100:.1f}%",
+            } for row in rates], use_container_width=True)
+        else:
+            st.info("No diagnoses in this period.")
+        st.caption(f"Query took {elapsed_ms:.1f} ms")
+
+    st.header("⬇️ Export Reports")
+    st.markdown("One archive with a CSV of every diagnosis in the period and a text report for each.")
+    if st.button("Prepare archive"):
+        with st.spinner("Building the archive..."):
+            # Streamlit serves downloads from memory; GET /history/export streams large exports instead
+            archive = b''.join(iter_report_archive(history, class_names, field_id, since))
+        st.download_button("⬇️ Download reports (.zip)", archive, file_name="diagnosis_reports.zip",
+                           mime="application/zip")
+
+main()
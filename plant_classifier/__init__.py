@@ -0,0 +1,5 @@
+"""Headless entry points for the plant disease classifier"""
+
+from plant_classifier.scoring import score_paths, score_directory
+
+__all__ = ['score_paths', 'score_directory']
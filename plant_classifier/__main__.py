@@ -0,0 +1,5 @@
+import sys
+
+from plant_classifier.cli import main
+
+sys.exit(main())
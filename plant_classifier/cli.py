@@ -0,0 +1,371 @@
+import argparse
+import json
+import os
+import sys
+import time
+
+from plant_classifier.scoring import score_directory, predict_labeled
+from model_utils import get_class_names
+from postprocessing import Calibration, DEFAULT_CALIBRATION_PATH, get_calibration
+from batch_processing import iter_labeled_directory
+from tensor_store import TensorStore, build_store, evaluation_report, predict_store
+from cascade import DEFAULT_CASCADE_PATH, DEFAULT_STUDENT_PATH
+from crops import DEFAULT_HEADS_PATH
+from similarity import DEFAULT_INDEX_PATH
+from inference_engines import ENGINE_KINDS, create_engine
+from model_conversion import (
+    QUANTIZATION_MODES, TFJS_QUANTIZATION_MODES, DEFAULT_TFJS_DIR, convert_to_tflite, export_saved_model,
+    export_tfjs, check_parity, load_sample_images, default_artifact_path
+)
+
+
+def build_parser():
+    """Build the command line parser for `python -m plant_classifier`"""
+    parser = argparse.ArgumentParser(
+        prog='python -m plant_classifier',
+        description='Plant disease classifier without the Streamlit UI'
+    )
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    score = subparsers.add_parser('score', help='Classify every image under a directory')
+    score.add_argument('directory', help='Folder of JPG/PNG images (searched recursively)')
+    score.add_argument('--out', default='results.jsonl',
+                       help='Output file: .jsonl, .csv or .parquet (default: results.jsonl)')
+    score.add_argument('--model', default='plant_disease_model.keras', help='Path to the .keras model')
+    score.add_argument('--batch-size', type=int, default=64, help='Images per forward pass (default: 64)')
+    score.add_argument('--workers', type=int, default=os.cpu_count() or 4,
+                       help='Decoding workers running alongside inference (default: CPU count)')
+    score.add_argument('--executor', choices=['thread', 'process'], default='thread',
+                       help='Decode with a thread pool or a process pool (default: thread)')
+    score.add_argument('--top-k', type=int, default=3, help='Predictions kept per image (default: 3)')
+    score.add_argument('--no-resume', action='store_true',
+                       help='Rescore images already present in the output file')
+    score.set_defaults(func=run_score)
+
+    convert = subparsers.add_parser('convert', help='Produce TFLite and SavedModel artifacts from the .keras model')
+    convert.add_argument('--model', default='plant_disease_model.keras', help='Path to the .keras model')
+    convert.add_argument('--quantization', choices=QUANTIZATION_MODES + ['savedmodel'], action='append',
+                         help='Artifact to produce; repeat for several (default: float16 and int8)')
+    convert.add_argument('--calibration-dir',
+                         help='Representative images for int8 calibration (strongly recommended)')
+    convert.add_argument('--limit', type=int, default=200, help='Calibration/parity images to use (default: 200)')
+    convert.add_argument('--check-parity', action='store_true',
+                         help='Compare every artifact with the float model on the calibration images')
+    convert.set_defaults(func=run_convert)
+
+    tfjs = subparsers.add_parser('export-tfjs', help='Export a quantized TF.js graph model for the web client')
+    tfjs.add_argument('--model', default='plant_disease_model.keras', help='Path to the .keras model')
+    tfjs.add_argument('--out', default=DEFAULT_TFJS_DIR, help=f'Output directory (default: {DEFAULT_TFJS_DIR})')
+    tfjs.add_argument('--quantization', choices=TFJS_QUANTIZATION_MODES, default='uint8',
+                      help='Weight quantization (default: uint8)')
+    tfjs.set_defaults(func=run_export_tfjs)
+
+    parity = subparsers.add_parser('parity', help='Compare an engine with the float Keras model')
+    parity.add_argument('artifact', help='A .tflite file, SavedModel directory or .keras model')
+    parity.add_argument('--engine', choices=ENGINE_KINDS, help='Engine to run the artifact with (default: inferred)')
+    parity.add_argument('--model', default='plant_disease_model.keras', help='Reference .keras model')
+    parity.add_argument('--data-dir', help='Images to compare on (default: random images)')
+    parity.add_argument('--limit', type=int, default=200, help='Images to compare on (default: 200)')
+    parity.add_argument('--min-agreement', type=float, default=0.98,
+                        help='Fail when top-1 agreement is below this (default: 0.98)')
+    parity.set_defaults(func=run_parity)
+
+    calibrate = subparsers.add_parser('calibrate',
+                                      help='Fit temperature scaling and a rejection threshold on labeled images')
+    calibrate.add_argument('data_dir', help='Folder with one subfolder of images per class')
+    calibrate.add_argument('--model', default='plant_disease_model.keras', help='Model to calibrate')
+    calibrate.add_argument('--engine', choices=ENGINE_KINDS, help='Engine to run the model with (default: inferred)')
+    calibrate.add_argument('--out', default=DEFAULT_CALIBRATION_PATH,
+                           help=f'Where to write the calibration (default: {DEFAULT_CALIBRATION_PATH})')
+    calibrate.add_argument('--target-accuracy', type=float, default=0.95,
+                           help='Accuracy required of accepted predictions (default: 0.95)')
+    calibrate.add_argument('--min-threshold', type=float, default=0.0,
+                           help='Never reject less than this top-1 confidence (default: 0)')
+    calibrate.add_argument('--limit-per-class', type=int, help='Images to use per class (default: all)')
+    calibrate.add_argument('--batch-size', type=int, default=64, help='Images per forward pass (default: 64)')
+    calibrate.add_argument('--workers', type=int, default=os.cpu_count() or 4, help='Decoding workers')
+    calibrate.set_defaults(func=run_calibrate)
+
+    store = subparsers.add_parser('build-store',
+                                  help='Decode labeled images once into a memory-mapped tensor store')
+    store.add_argument('data_dir', help='Folder with one subfolder of images per class')
+    store.add_argument('--out', default='validation.tensors', help='Store file (default: validation.tensors)')
+    store.add_argument('--limit-per-class', type=int, help='Images to use per class (default: all)')
+    store.add_argument('--workers', type=int, default=os.cpu_count() or 4, help='Decoding workers')
+    store.set_defaults(func=run_build_store)
+
+    evaluate = subparsers.add_parser('evaluate', help='Report accuracy, per-class confusion and throughput')
+    evaluate.add_argument('source', help='A tensor store from build-store, or a folder of per-class subfolders')
+    evaluate.add_argument('--model', default='plant_disease_model.keras', help='Model to evaluate')
+    evaluate.add_argument('--engine', choices=ENGINE_KINDS, help='Engine to run the model with (default: inferred)')
+    evaluate.add_argument('--batch-size', type=int, default=64, help='Images per forward pass (default: 64)')
+    evaluate.add_argument('--workers', type=int, default=os.cpu_count() or 4,
+                          help='Decoding workers when evaluating a folder')
+    evaluate.add_argument('--out', help='Also write the full report (with the confusion matrix) as JSON')
+    evaluate.set_defaults(func=run_evaluate)
+
+    distill = subparsers.add_parser('distill',
+                                    help='Train a small student from the model and calibrate a cascade around it')
+    distill.add_argument('store', help='Tensor store from build-store (training plus held-out images)')
+    distill.add_argument('--teacher', default='plant_disease_model.keras', help='Full model to distill from')
+    distill.add_argument('--teacher-engine', choices=ENGINE_KINDS, help='Engine to run the teacher with')
+    distill.add_argument('--out', default=DEFAULT_STUDENT_PATH, help=f'Student model (default: {DEFAULT_STUDENT_PATH})')
+    distill.add_argument('--cascade-out', default=DEFAULT_CASCADE_PATH,
+                         help=f'Cascade file for INFERENCE_ENGINE=cascade (default: {DEFAULT_CASCADE_PATH})')
+    distill.add_argument('--epochs', type=int, default=5, help='Training epochs (default: 5)')
+    distill.add_argument('--batch-size', type=int, default=64, help='Images per step (default: 64)')
+    distill.add_argument('--width', type=float, default=0.35, help='MobileNetV2 width multiplier (default: 0.35)')
+    distill.add_argument('--temperature', type=float, default=4.0, help='Distillation temperature (default: 4)')
+    distill.add_argument('--learning-rate', type=float, default=1e-3, help='Adam learning rate (default: 0.001)')
+    distill.add_argument('--holdout', type=float, default=0.2,
+                         help='Share of images held out for calibration and the report (default: 0.2)')
+    distill.add_argument('--target-agreement', type=float, default=0.99,
+                         help='Required agreement with the full model on images the student answers (default: 0.99)')
+    distill.add_argument('--no-pretrained', action='store_true', help='Do not start from ImageNet weights')
+    distill.set_defaults(func=run_distill)
+
+    heads = subparsers.add_parser('fit-heads',
+                                  help='Fit per-crop specialist heads on the backbone features of a tensor store')
+    heads.add_argument('store', help='Tensor store from build-store')
+    heads.add_argument('--model', default='plant_disease_model.keras', help='Model whose backbone the heads share')
+    heads.add_argument('--out', default=DEFAULT_HEADS_PATH, help=f'Heads file (default: {DEFAULT_HEADS_PATH})')
+    heads.add_argument('--epochs', type=int, default=300, help='Full-batch training steps per head (default: 300)')
+    heads.add_argument('--learning-rate', type=float, default=0.01, help='Adam learning rate (default: 0.01)')
+    heads.add_argument('--holdout', type=float, default=0.2,
+                       help='Share of each crop\'s images held out to compare heads (default: 0.2)')
+    heads.set_defaults(func=run_fit_heads)
+
+    index = subparsers.add_parser('build-index',
+                                  help='Add a tensor store\'s images to the similar-cases index and train its lists')
+    index.add_argument('store', nargs='?',
+                       help='Tensor store of confirmed images; omit to only retrain an existing index')
+    index.add_argument('--model', default='plant_disease_model.keras', help='Model whose embeddings are indexed')
+    index.add_argument('--engine', choices=['keras', 'specialist'], help='Engine to run the model with')
+    index.add_argument('--out', default=DEFAULT_INDEX_PATH, help=f'Index directory (default: {DEFAULT_INDEX_PATH})')
+    index.add_argument('--nlist', type=int, help='Inverted lists (default: 4 * sqrt(vectors))')
+    index.add_argument('--batch-size', type=int, default=64, help='Images per forward pass (default: 64)')
+    index.set_defaults(func=run_build_index)
+
+    return parser
+
+
+def run_score(args):
+    if not os.path.isdir(args.directory):
+        print(f"Directory not found: {args.directory}", file=sys.stderr)
+        return 2
+
+    def progress(scored, rate):
+        print(f"\rScored {scored} images ({rate:.1f} images/sec)", end='', file=sys.stderr, flush=True)
+
+    summary = score_directory(
+        args.directory, args.out,
+        model_path=args.model,
+        batch_size=args.batch_size,
+        workers=args.workers,
+        executor=args.executor,
+        top_k=args.top_k,
+        resume=not args.no_resume,
+        progress=progress,
+    )
+    print(file=sys.stderr)
+    print(f"Scored {summary['scored']} images ({summary['errors']} errors), "
+          f"skipped {summary['skipped']} already scored, "
+          f"{summary['images_per_second']:.1f} images/sec -> {args.out}")
+    return 0
+
+
+def print_parity(label, report):
+    print(f"{label}: top-1 agreement {report['top1_agreement'] * 100:.2f}%, "
+          f"top-3 overlap {report['top3_overlap'] * 100:.2f}%, "
+          f"max |dp| {report['max_abs_diff']:.4f} over {report['images']} images")
+
+
+def run_convert(args):
+    modes = args.quantization or ['float16', 'int8']
+    images = None
+    if 'int8' in modes or args.check_parity:
+        if not args.calibration_dir:
+            print("Warning: no --calibration-dir given, calibrating on random images; "
+                  "int8 accuracy will suffer", file=sys.stderr)
+        images = load_sample_images(args.calibration_dir, args.limit)
+
+    reference = create_engine(args.model, 'keras') if args.check_parity else None
+    for mode in modes:
+        if mode == 'savedmodel':
+            out_path = export_saved_model(args.model, os.path.splitext(args.model)[0] + '_savedmodel')
+            engine = 'function'
+        else:
+            out_path = convert_to_tflite(args.model, default_artifact_path(args.model, mode), mode, images)
+            engine = 'tflite'
+        print(f"Wrote {out_path}")
+
+        if reference is not None:
+            print_parity(f"  {mode}", check_parity(reference, create_engine(out_path, engine), images))
+    return 0
+
+
+def run_export_tfjs(args):
+    metadata = export_tfjs(args.model, args.out, args.quantization)
+    print(f"Wrote {args.out} ({metadata['quantization']}, {metadata['bytes'] / 1024 / 1024:.1f} MB, "
+          f"version {metadata['version']})")
+    return 0
+
+
+def run_parity(args):
+    images = load_sample_images(args.data_dir, args.limit)
+    report = check_parity(create_engine(args.model, 'keras'), create_engine(args.artifact, args.engine), images)
+    print_parity(args.artifact, report)
+    return 0 if report['top1_agreement'] >= args.min_agreement else 1
+
+
+def run_calibrate(args):
+    model = create_engine(args.model, args.engine)
+    probabilities, labels, _ = predict_labeled(model, args.data_dir, get_class_names(),
+                                               batch_size=args.batch_size, workers=args.workers,
+                                               limit_per_class=args.limit_per_class)
+    calibration = Calibration.fit(probabilities, labels, args.target_accuracy, args.min_threshold)
+
+    report = calibration.metadata
+    print(f"Temperature {calibration.temperature:.3f} (NLL {report['nll_before']:.4f} -> {report['nll_after']:.4f}), "
+          f"rejection threshold {calibration.threshold:.3f}")
+    print(f"Accuracy {report['accuracy'] * 100:.2f}% on {report['images']} images; "
+          f"accepted {report['coverage'] * 100:.1f}% at {report['accepted_accuracy'] * 100:.2f}% accuracy")
+    if report['coverage'] == 0:
+        # Saving it would make every diagnosis "unknown" as soon as the app reloads the file
+        print(f"Error: a threshold of {calibration.threshold:.3f} rejects every image; not writing {args.out}. "
+              f"Lower --min-threshold.", file=sys.stderr)
+        return 1
+    calibration.save(args.out)
+    print(f"Wrote {args.out}")
+    return 0
+
+
+def run_build_store(args):
+    if not os.path.isdir(args.data_dir):
+        print(f"Directory not found: {args.data_dir}", file=sys.stderr)
+        return 2
+
+    def progress(written, rate):
+        print(f"\rStored {written} images ({rate:.1f} images/sec)", end='', file=sys.stderr, flush=True)
+
+    class_names = get_class_names()
+    labeled = iter_labeled_directory(args.data_dir, class_names, args.limit_per_class)
+    summary = build_store(labeled, args.out, class_names, workers=args.workers, progress=progress)
+    print(file=sys.stderr)
+    print(f"Stored {summary['images']} images ({summary['errors']} skipped), "
+          f"{summary['bytes'] / 1024 / 1024:.0f} MB, {summary['images_per_second']:.1f} images/sec -> {args.out}")
+    return 0
+
+
+def run_evaluate(args):
+    class_names = get_class_names()
+    model = create_engine(args.model, args.engine)
+
+    start = time.perf_counter()
+    if os.path.isdir(args.source):
+        probabilities, labels, _ = predict_labeled(model, args.source, class_names,
+                                                   batch_size=args.batch_size, workers=args.workers)
+    else:
+        store = TensorStore(args.source)
+        store.check_classes(class_names)
+        probabilities, labels = predict_store(model, store, batch_size=args.batch_size)
+    report = evaluation_report(probabilities, labels, class_names, get_calibration(),
+                               seconds=time.perf_counter() - start)
+    if hasattr(model, 'stats'):
+        report['engine_stats'] = model.stats()
+
+    print(f"Accuracy {report['accuracy'] * 100:.2f}% on {report['images']} images "
+          f"({report['images_per_second']:.1f} images/sec); "
+          f"accepted {report['coverage'] * 100:.1f}% at {report['accepted_accuracy'] * 100:.2f}% accuracy")
+    if model.kind == 'cascade':
+        print(f"Cascade escalated {report['engine_stats']['escalation_rate'] * 100:.1f}% of images to the full model")
+    print(f"{'class':<50} {'support':>7} {'precision':>9} {'recall':>7}  most confused with")
+    for row in sorted(report['per_class'], key=lambda row: row['recall']):
+        confused = f"{row['most_confused_with']} ({row['confused_count']})" if row['most_confused_with'] else ''
+        print(f"{row['class']:<50} {row['support']:>7} {row['precision']:>9.3f} {row['recall']:>7.3f}  {confused}")
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Wrote {args.out}")
+    return 0
+
+
+def run_distill(args):
+    from cascade import distill
+
+    def progress(epoch, epochs, loss):
+        print(f"Epoch {epoch}/{epochs}: distillation loss {loss:.4f}", file=sys.stderr)
+
+    store = TensorStore(args.store)
+    report = distill(args.teacher, store, student_path=args.out, cascade_path=args.cascade_out,
+                     teacher_engine=args.teacher_engine, epochs=args.epochs, batch_size=args.batch_size,
+                     width=args.width, temperature=args.temperature, learning_rate=args.learning_rate,
+                     holdout=args.holdout, target_agreement=args.target_agreement,
+                     pretrained=not args.no_pretrained, progress=progress)
+
+    print(f"Trained on {report['train_images']} images; threshold {report['threshold']:.3f} "
+          f"(student temperature {report['student_temperature']:.3f}) from {report['calibration_images']} images")
+    print(f"On {report['test_images']} held-out images: {report['escalation_rate'] * 100:.1f}% escalated, "
+          f"{report['cascade_images_per_second']:.1f} images/sec vs {report['teacher_images_per_second']:.1f} "
+          f"for the full model ({report['speedup']:.2f}x)")
+    print(f"Accuracy {report['cascade_accuracy'] * 100:.2f}% vs {report['teacher_accuracy'] * 100:.2f}% "
+          f"({report['accuracy_delta'] * 100:+.2f} points; student alone {report['student_accuracy'] * 100:.2f}%), "
+          f"{report['cascade_teacher_agreement'] * 100:.2f}% agreement with the full model")
+    if report['escalation_rate'] == 1.0:
+        print(f"Warning: the student never reaches {args.target_agreement:.0%} agreement with the full model; "
+              "every image would escalate. Train longer or on more images.", file=sys.stderr)
+    print(f"Wrote {args.out} and {args.cascade_out}")
+    print(f"Before serving it, fit the calibration on the cascade's output: python -m plant_classifier calibrate "
+          f"<labeled dir> --model {args.cascade_out} --engine cascade")
+    return 0
+
+
+def run_fit_heads(args):
+    from crops import fit_heads
+
+    store = TensorStore(args.store)
+    store.check_classes(get_class_names())
+    report = fit_heads(args.model, store, args.out, epochs=args.epochs, learning_rate=args.learning_rate,
+                       holdout=args.holdout)
+    print(f"{'crop':<28} {'images':>7} {'full model':>10} {'specialist':>10}  kept")
+    for row in report['crops']:
+        if 'specialist_accuracy' not in row:
+            print(f"{row['crop']:<28} {row['images']:>7} {'-':>10} {'-':>10}  no (too few classes or images)")
+            continue
+        print(f"{row['crop']:<28} {row['images']:>7} {row['general_accuracy'] * 100:>9.1f}% "
+              f"{row['specialist_accuracy'] * 100:>9.1f}%  {'yes' if row['fitted'] else 'no'}")
+    print(f"Wrote {args.out}; serve with INFERENCE_ENGINE=specialist CROP_HEADS_PATH={args.out}")
+    return 0
+
+
+def run_build_index(args):
+    from similarity import SimilarityIndex, build_index
+
+    start = time.perf_counter()
+    if args.store is None:
+        index = SimilarityIndex(args.out, train_size=None)
+        index.train(args.nlist)
+    else:
+        store = TensorStore(args.store)
+        store.check_classes(get_class_names())
+
+        def progress(done, total):
+            print(f"\rEmbedded {done}/{total} images", end='', file=sys.stderr, flush=True)
+
+        index = build_index(create_engine(args.model, args.engine), store, args.out, args.batch_size, args.nlist,
+                            progress)
+        print(file=sys.stderr)
+    stats = index.stats()
+    print(f"{stats['vectors']} vectors of {stats['dim']} features in {stats['lists']} lists, "
+          f"{stats['bytes'] / 1024 / 1024:.0f} MB, {time.perf_counter() - start:.1f}s -> {args.out}")
+    return 0
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    try:
+        return args.func(args)
+    except Exception as e:
+        print(f"Error: {str(e)}", file=sys.stderr)
+        return 1
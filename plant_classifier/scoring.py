@@ -0,0 +1,230 @@
+import csv
+import json
+import multiprocessing
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+import numpy as np
+
+from model_utils import (
+    create_model, get_class_names, load_image_reduced, preprocess_batch, allocate_batch
+)
+from batch_processing import iter_directory, iter_labeled_directory, batched
+from postprocessing import UNKNOWN_LABEL, get_calibration, postprocess
+
+OUTPUT_FIELDS = ['path', 'disease', 'confidence', 'top_k', 'error']
+
+
+def load_and_preprocess(path):
+    """Decode one image file at model resolution, returning (path, uint8 array, error)"""
+    try:
+        return path, load_image_reduced(path), None
+    except Exception as e:
+        return path, None, str(e)
+
+
+def prefetch(paths, workers=4, executor='thread', window=None, func=load_and_preprocess):
+    """Decode images on a worker pool while the caller runs inference, preserving input order
+
+    At most ``window`` images are decoded ahead of the consumer, which keeps
+    memory bounded however many paths are scored. ``func`` maps one path to
+    the item yielded (default: load_and_preprocess). Process workers are
+    spawned, not forked: by now the caller has started TensorFlow's threads.
+    """
+    window = window or workers * 8
+    if executor == 'process':
+        pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+    else:
+        pool = ThreadPoolExecutor(max_workers=workers)
+    with pool:
+        in_flight = deque()
+        for path in paths:
+            in_flight.append(pool.submit(func, path))
+            if len(in_flight) >= window:
+                yield in_flight.popleft().result()
+        while in_flight:
+            yield in_flight.popleft().result()
+
+
+def read_scored_paths(out_path):
+    """Return the set of paths already present in an output file or its checkpoint"""
+    scored = set()
+    for path in (out_path, checkpoint_path(out_path)):
+        if not os.path.exists(path):
+            continue
+        if path.endswith('.parquet'):
+            import pyarrow.parquet as pq
+            scored.update(pq.read_table(path, columns=['path']).column('path').to_pylist())
+        elif path.endswith('.csv'):
+            with open(path, newline='') as f:
+                scored.update(row['path'] for row in csv.DictReader(f))
+        else:
+            with open(path) as f:
+                for line in f:
+                    try:
+                        scored.add(json.loads(line)['path'])
+                    except (ValueError, KeyError):
+                        # A crash can leave a truncated last line; that image is simply rescored
+                        continue
+    return scored
+
+
+def checkpoint_path(out_path):
+    """Parquet cannot be appended to, so results are checkpointed to JSONL alongside it"""
+    return out_path + '.partial.jsonl' if out_path.endswith('.parquet') else out_path
+
+
+class ResultSink:
+    """Append results to a CSV or JSONL file, flushing after every batch"""
+
+    def __init__(self, out_path):
+        self.out_path = out_path
+        self.path = checkpoint_path(out_path)
+        is_new = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+        self._file = open(self.path, 'a', newline='')
+        self._csv = None
+        if self.path.endswith('.csv'):
+            self._csv = csv.DictWriter(self._file, fieldnames=OUTPUT_FIELDS)
+            if is_new:
+                self._csv.writeheader()
+
+    def write_batch(self, rows):
+        for row in rows:
+            if self._csv is not None:
+                self._csv.writerow(dict(row, top_k=json.dumps(row['top_k'])))
+            else:
+                self._file.write(json.dumps(row) + '\n')
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
+        if self.out_path.endswith('.parquet'):
+            finalize_parquet(self.out_path)
+
+
+def finalize_parquet(out_path):
+    """Merge the JSONL checkpoint into the Parquet output and remove the checkpoint"""
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise Exception("Writing .parquet requires pyarrow. Install it or use a .csv/.jsonl output.")
+
+    partial = checkpoint_path(out_path)
+    rows = []
+    with open(partial) as f:
+        for line in f:
+            try:
+                rows.append(json.loads(line))
+            except ValueError:
+                continue
+    for row in rows:
+        row['top_k'] = json.dumps(row['top_k'])
+
+    table = pa.Table.from_pylist(rows, schema=pa.schema([
+        ('path', pa.string()), ('disease', pa.string()), ('confidence', pa.float32()),
+        ('top_k', pa.string()), ('error', pa.string()),
+    ]))
+    if os.path.exists(out_path):
+        table = pa.concat_tables([pq.read_table(out_path).cast(table.schema), table])
+
+    tmp_path = out_path + '.tmp'
+    pq.write_table(table, tmp_path)
+    os.replace(tmp_path, out_path)
+    os.remove(partial)
+
+
+def score_batches(model, items, class_names, batch_size=64, top_k=3):
+    """Run preprocessed (path, array, error) items through the model, yielding one list of rows per batch"""
+    class_names = np.asarray(class_names)
+    buffer = allocate_batch(batch_size)
+    for batch in batched(items, batch_size):
+        valid = [item for item in batch if item[2] is None]
+        rows = [{'path': path, 'disease': None, 'confidence': None, 'top_k': [], 'error': error}
+                for path, _, error in batch if error is not None]
+
+        if valid:
+            inputs = preprocess_batch([array for _, array, _ in valid], out=buffer)
+            predictions = np.asarray(model.predict_on_batch(inputs))
+            for (path, _, _), record in zip(valid, postprocess(predictions, top_k, get_calibration())):
+                names = class_names[record['class_id']].tolist()
+                confidences = record['confidence'].tolist()
+                rows.append({
+                    'path': path,
+                    'disease': names[0] if record['accepted'] else UNKNOWN_LABEL,
+                    'confidence': confidences[0],
+                    'top_k': [list(pair) for pair in zip(names, confidences)],
+                    'error': None,
+                })
+        yield rows
+
+
+def predict_labeled(model, directory, class_names, batch_size=64, workers=4, limit_per_class=None):
+    """Return raw (probabilities, labels, paths) for a directory of per-class subfolders
+
+    Used to fit calibration offline; images that fail to decode are skipped.
+    """
+    labeled = list(iter_labeled_directory(directory, class_names, limit_per_class))
+    if not labeled:
+        raise ValueError(f"No labeled images found under {directory}")
+    labels_by_path = dict(labeled)
+
+    buffer = allocate_batch(batch_size)
+    probabilities, labels, paths = [], [], []
+    for batch in batched(prefetch([path for path, _ in labeled], workers), batch_size):
+        valid = [(path, array) for path, array, error in batch if error is None]
+        if not valid:
+            continue
+        inputs = preprocess_batch([array for _, array in valid], out=buffer)
+        probabilities.append(np.asarray(model.predict_on_batch(inputs), dtype=np.float32))
+        labels.extend(labels_by_path[path] for path, _ in valid)
+        paths.extend(path for path, _ in valid)
+    return np.concatenate(probabilities), np.asarray(labels), paths
+
+
+def score_paths(paths, out_path, model=None, model_path='plant_disease_model.keras',
+                batch_size=64, workers=4, executor='thread', top_k=3, resume=True, progress=None):
+    """Score image files into out_path, skipping paths already scored by a previous run
+
+    Returns a summary dictionary with counts and throughput. ``progress`` is
+    an optional callable receiving (scored_so_far, images_per_second).
+    """
+    paths = list(paths)
+    already_scored = read_scored_paths(out_path) if resume else set()
+    todo = [path for path in paths if path not in already_scored]
+
+    if model is None and todo:
+        model = create_model(model_path)
+    class_names = get_class_names()
+
+    sink = ResultSink(out_path)
+    scored = errors = 0
+    start = time.perf_counter()
+    try:
+        items = prefetch(todo, workers=workers, executor=executor)
+        for rows in score_batches(model, items, class_names, batch_size=batch_size, top_k=top_k):
+            sink.write_batch(rows)
+            scored += len(rows)
+            errors += sum(1 for row in rows if row['error'])
+            if progress is not None:
+                progress(scored, scored / (time.perf_counter() - start))
+    finally:
+        sink.close()
+
+    elapsed = time.perf_counter() - start
+    return {
+        'total': len(paths),
+        'skipped': len(paths) - len(todo),
+        'scored': scored,
+        'errors': errors,
+        'seconds': elapsed,
+        'images_per_second': scored / elapsed if elapsed > 0 else 0.0,
+    }
+
+
+def score_directory(directory, out_path, **kwargs):
+    """Score every JPG/PNG image under a directory; see score_paths for options"""
+    return score_paths((path for path, _ in iter_directory(directory)), out_path, **kwargs)
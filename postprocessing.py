@@ -0,0 +1,246 @@
+"""Vectorized postprocessing of model outputs: top-k, calibration and rejection
+
+Every function works on a whole (N, num_classes) batch at once and returns
+a structured array with one compact record per image:
+
+    class_id    int16[k]    best classes, most likely first
+    confidence  float32[k]  their calibrated probabilities
+    accepted    bool        False when the top confidence is below the
+                            rejection threshold ("unknown / not a leaf")
+"""
+import json
+import os
+import threading
+
+import numpy as np
+
+from metrics import record_error
+
+DEFAULT_CALIBRATION_PATH = 'calibration.json'
+UNKNOWN_LABEL = 'Unknown / not a leaf'
+
+
+def prediction_dtype(k):
+    """Record layout for top-k predictions"""
+    return np.dtype([('class_id', np.int16, (k,)), ('confidence', np.float32, (k,)), ('accepted', np.bool_)])
+
+
+def top_k(probabilities, k=3):
+    """Return (indices, values) of the k largest entries in each row, largest first
+
+    argpartition finds the top k in linear time; only those k are sorted.
+    """
+    probabilities = np.atleast_2d(probabilities)
+    k = min(k, probabilities.shape[1])
+    if k < probabilities.shape[1]:
+        candidates = np.argpartition(probabilities, -k, axis=1)[:, -k:]
+    else:
+        candidates = np.broadcast_to(np.arange(k), probabilities.shape)
+    values = np.take_along_axis(probabilities, candidates, axis=1)
+    order = np.argsort(-values, axis=1, kind='stable')
+    return np.take_along_axis(candidates, order, axis=1), np.take_along_axis(values, order, axis=1)
+
+
+def apply_temperature(probabilities, temperature):
+    """Rescale softmax probabilities as if the logits had been divided by temperature"""
+    probabilities = np.asarray(probabilities, dtype=np.float32)
+    if temperature == 1.0:
+        return probabilities
+    logits = np.log(np.clip(probabilities, 1e-12, 1.0)) / np.float32(temperature)
+    logits -= logits.max(axis=-1, keepdims=True)
+    scaled = np.exp(logits)
+    scaled /= scaled.sum(axis=-1, keepdims=True)
+    return scaled
+
+
+def _negative_log_likelihood(probabilities, labels, temperature):
+    scaled = apply_temperature(probabilities, temperature)
+    return float(-np.mean(np.log(np.clip(scaled[np.arange(len(labels)), labels], 1e-12, 1.0))))
+
+
+class Calibration:
+    """Temperature scaling plus a rejection threshold, fitted offline on labeled images
+
+    A temperature above 1 softens over-confident predictions; the threshold
+    applies to the calibrated top-1 confidence.
+    """
+
+    def __init__(self, temperature=1.0, threshold=0.0, metadata=None):
+        self.temperature = float(temperature)
+        self.threshold = float(threshold)
+        self.metadata = metadata or {}
+
+    @property
+    def version(self):
+        """Identify the calibration in cache keys"""
+        return f"T{self.temperature:.4f}-t{self.threshold:.4f}"
+
+    def apply(self, probabilities):
+        return apply_temperature(probabilities, self.temperature)
+
+    @classmethod
+    def fit(cls, probabilities, labels, target_accuracy=0.95, min_threshold=0.0):
+        """Fit the temperature by minimizing NLL, then the lowest threshold meeting target_accuracy
+
+        The threshold is the smallest calibrated top-1 confidence at which the
+        predictions kept are still at least target_accuracy correct, so low
+        confidence results are rejected instead of triggering treatment advice.
+        Raises ValueError when no threshold reaches target_accuracy.
+        """
+        probabilities = np.asarray(probabilities, dtype=np.float32)
+        labels = np.asarray(labels)
+
+        # Golden-section search over log(temperature); NLL is unimodal in T
+        low, high = np.log(0.05), np.log(20.0)
+        ratio = (np.sqrt(5) - 1) / 2
+        a, b = high - ratio * (high - low), low + ratio * (high - low)
+        nll_a = _negative_log_likelihood(probabilities, labels, np.exp(a))
+        nll_b = _negative_log_likelihood(probabilities, labels, np.exp(b))
+        for _ in range(40):
+            if nll_a < nll_b:
+                high, b, nll_b = b, a, nll_a
+                a = high - ratio * (high - low)
+                nll_a = _negative_log_likelihood(probabilities, labels, np.exp(a))
+            else:
+                low, a, nll_a = a, b, nll_b
+                b = low + ratio * (high - low)
+                nll_b = _negative_log_likelihood(probabilities, labels, np.exp(b))
+        temperature = float(np.exp((low + high) / 2))
+
+        scaled = apply_temperature(probabilities, temperature)
+        confidence = scaled.max(axis=1)
+        correct = scaled.argmax(axis=1) == labels
+
+        # Accuracy of the predictions kept at each candidate threshold, from
+        # the most confident down; pick the lowest threshold that still meets the target
+        order = np.argsort(-confidence)
+        kept_accuracy = np.cumsum(correct[order]) / np.arange(1, len(order) + 1)
+        meets = np.nonzero(kept_accuracy >= target_accuracy)[0]
+        if len(meets) == 0:
+            raise ValueError(f"No rejection threshold reaches {target_accuracy:.1%} accuracy (the best is "
+                             f"{kept_accuracy.max():.1%}, {correct.mean():.1%} overall); lower the target accuracy")
+        threshold = max(float(confidence[order][meets[-1]]), min_threshold)
+
+        accepted = confidence >= threshold
+        metadata = {
+            'images': int(len(labels)),
+            'target_accuracy': target_accuracy,
+            'accuracy': float(correct.mean()),
+            'nll_before': _negative_log_likelihood(probabilities, labels, 1.0),
+            'nll_after': _negative_log_likelihood(probabilities, labels, temperature),
+            'coverage': float(accepted.mean()),
+            'accepted_accuracy': float(correct[accepted].mean()) if accepted.any() else 0.0,
+        }
+        return cls(temperature, threshold, metadata)
+
+    def to_dict(self):
+        return {'temperature': self.temperature, 'threshold': self.threshold, 'metadata': self.metadata}
+
+    def save(self, path):
+        # Write then rename, so a running server never reads a half-written file
+        tmp = f"{path}.tmp"
+        with open(tmp, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        try:
+            with open(path) as f:
+                data = json.load(f)
+            return cls(data.get('temperature', 1.0), data.get('threshold', 0.0), data.get('metadata'))
+        except Exception as e:
+            raise Exception(f"Failed to load calibration from {path}: {str(e)}")
+
+
+def postprocess(probabilities, k=3, calibration=None, masks=None):
+    """Calibrate a batch of probabilities and return one prediction record per row
+
+    masks (N, num_classes) of 0/1, for example crop hints, limits each row
+    to some classes. Rejection uses the calibrated probability of the best
+    allowed class before renormalizing over the allowed classes, so a crop
+    with a single class is not accepted at 100% regardless of the image.
+    """
+    probabilities = np.atleast_2d(np.asarray(probabilities, dtype=np.float32))
+    if calibration is not None:
+        probabilities = calibration.apply(probabilities)
+    if masks is not None:
+        # The epsilon keeps a row valid (uniform over the allowed classes) when none of them got any mass
+        masked = (probabilities + 1e-12) * masks
+        gate = masked.max(axis=1)
+        probabilities = masked / masked.sum(axis=1, keepdims=True)
+    indices, values = top_k(probabilities, k)
+
+    records = np.empty(len(probabilities), dtype=prediction_dtype(indices.shape[1]))
+    records['class_id'] = indices
+    records['confidence'] = values
+    records['accepted'] = ((values[:, 0] if masks is None else gate)
+                           >= (calibration.threshold if calibration is not None else 0.0))
+    return records
+
+
+def postprocess_rows(probabilities, ks, calibration=None, masks=None):
+    """Postprocess rows that each ask for their own k, returning one record per row
+
+    Rows sharing a k are handled in a single vectorized call.
+    """
+    probabilities = np.atleast_2d(probabilities)
+    rows_by_k = {}
+    for row, k in enumerate(ks):
+        rows_by_k.setdefault(k, []).append(row)
+
+    records = [None] * len(ks)
+    for k, rows in rows_by_k.items():
+        row_masks = masks[rows] if masks is not None else None
+        for row, record in zip(rows, postprocess(probabilities[rows], k, calibration, row_masks)):
+            records[row] = record
+    return records
+
+
+def record_to_list(record):
+    """Convert a prediction record to JSON-friendly lists (for caches and APIs)"""
+    return [record['class_id'].tolist(), record['confidence'].tolist(), bool(record['accepted'])]
+
+
+def record_from_list(value):
+    """Rebuild a prediction record from record_to_list output"""
+    class_ids, confidences, accepted = value
+    return np.array((class_ids, confidences, accepted), dtype=prediction_dtype(len(class_ids)))
+
+
+_calibration = None
+_calibration_signature = None
+_calibration_lock = threading.Lock()
+
+
+def get_calibration():
+    """Return the calibration in CALIBRATION_PATH (default calibration.json), reloading it when it changes
+
+    Without a file, probabilities pass through unchanged. REJECTION_THRESHOLD
+    overrides the fitted threshold. If a changed file cannot be loaded, the
+    previously loaded calibration stays in use.
+    """
+    global _calibration, _calibration_signature
+
+    path = os.environ.get('CALIBRATION_PATH', DEFAULT_CALIBRATION_PATH)
+    try:
+        stat = os.stat(path)
+        signature = (path, stat.st_mtime_ns, stat.st_size)
+    except OSError:
+        signature = None
+    if _calibration is None or signature != _calibration_signature:
+        with _calibration_lock:
+            try:
+                calibration = Calibration.load(path) if signature is not None else Calibration()
+            except Exception as e:
+                if _calibration is None:
+                    raise
+                record_error('calibration_reload')
+                print(f"{str(e)}; keeping the previous calibration")
+                # Remember the bad file so it is retried only once it changes again
+                _calibration_signature = signature
+                return _calibration
+            if os.environ.get('REJECTION_THRESHOLD'):
+                calibration.threshold = float(os.environ['REJECTION_THRESHOLD'])
+            _calibration, _calibration_signature = calibration, signature
+    return _calibration
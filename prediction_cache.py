@@ -0,0 +1,150 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from metrics import get_metrics
+
+
+class PredictionCache:
+    """Two-tier cache of top-k predictions keyed by image content hash and model version
+
+    The memory tier is an LRU bounded both in entries and in (approximate)
+    bytes. The optional disk tier is a SQLite file that survives restarts;
+    disk hits are promoted back into memory.
+    """
+
+    def __init__(self, max_entries=1024, max_bytes=16 * 1024 * 1024, disk_path=None, max_disk_entries=100000):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_disk_entries = max_disk_entries
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._db = None
+        self._disk_writes = 0
+        if disk_path:
+            self._db = sqlite3.connect(disk_path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS predictions (key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS predictions_created ON predictions (created)")
+            self._db.commit()
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def make_key(content_hash, model_version, top_k):
+        return f"{model_version}:{top_k}:{content_hash}"
+
+    def get(self, key):
+        """Return the cached value for key, or None on a miss"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+
+            if self._db is not None:
+                row = self._db.execute("SELECT value FROM predictions WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    value = json.loads(row[0])
+                    self._insert_memory(key, value, len(row[0]))
+                    self.disk_hits += 1
+                    return value
+
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        """Store a JSON-serializable value in both tiers"""
+        payload = json.dumps(value)
+        with self._lock:
+            self._insert_memory(key, value, len(payload))
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO predictions (key, value, created) VALUES (?, ?, ?)",
+                    (key, payload, time.time())
+                )
+                self._db.commit()
+                self._disk_writes += 1
+                if self._disk_writes % 1000 == 0:
+                    self._trim_disk()
+
+    def _insert_memory(self, key, value, payload_bytes):
+        size = payload_bytes + len(key)
+        if key in self._entries:
+            self._bytes -= self._entries.pop(key)[1]
+        self._entries[key] = (value, size)
+        self._bytes += size
+
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            _, (_, evicted_size) = self._entries.popitem(last=False)
+            self._bytes -= evicted_size
+            self.evictions += 1
+
+    def _trim_disk(self):
+        """Drop the oldest disk entries beyond max_disk_entries"""
+        self._db.execute(
+            "DELETE FROM predictions WHERE key IN "
+            "(SELECT key FROM predictions ORDER BY created DESC LIMIT -1 OFFSET ?)",
+            (self.max_disk_entries,)
+        )
+        self._db.commit()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            if self._db is not None:
+                self._db.execute("DELETE FROM predictions")
+                self._db.commit()
+
+    def stats(self):
+        """Return hit/miss/eviction counters and current size as a plain dictionary"""
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'model_calls_saved': self.hits + self.disk_hits,
+            'hit_rate': (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+            'entries': len(self._entries),
+            'bytes': self._bytes,
+        }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_prediction_cache():
+    """Return the process-wide prediction cache, configured from the environment
+
+    Set PREDICTION_CACHE_PATH to a SQLite file to enable the on-disk tier.
+    """
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = PredictionCache(
+                    max_entries=int(os.environ.get('PREDICTION_CACHE_MAX_ENTRIES', 1024)),
+                    max_bytes=int(float(os.environ.get('PREDICTION_CACHE_MAX_MB', 16)) * 1024 * 1024),
+                    disk_path=os.environ.get('PREDICTION_CACHE_PATH') or None,
+                )
+                metrics = get_metrics()
+                metrics.counter('plant_prediction_cache_hits_total', 'Predictions served from memory',
+                                fn=lambda: _cache.hits)
+                metrics.counter('plant_prediction_cache_disk_hits_total', 'Predictions served from SQLite',
+                                fn=lambda: _cache.disk_hits)
+                metrics.counter('plant_prediction_cache_misses_total', 'Predictions that needed the model',
+                                fn=lambda: _cache.misses)
+    return _cache
@@ -0,0 +1,84 @@
+"""Plain-text diagnosis reports, shared by the Streamlit app and the history export"""
+from postprocessing import UNKNOWN_LABEL
+
+def format_disease_name(disease_name):
+    """Format disease name for better readability"""
+    # Replace underscores with spaces
+    formatted = disease_name.replace('_', ' ')
+    
+    # Replace triple underscores with dash (plant___disease format)
+    formatted = formatted.replace('   ', ' - ')
+    
+    # Capitalize words
+    words = formatted.split()
+    formatted_words = []
+    
+    for word in words:
+        if word.lower() in ['of', 'and', 'the', 'in', 'on']:
+            formatted_words.append(word.lower())
+        else:
+            formatted_words.append(word.capitalize())
+    
+    return ' '.join(formatted_words)
+
+def create_download_report(disease_name, confidence, treatment_info, analysis_date=None, accepted=True):
+    """Create a downloadable report with diagnosis and treatment information
+
+    A rejected prediction (accepted=False) only names the closest match and
+    gives no description or treatment advice.
+    """
+    if not accepted:
+        return f"""
+PLANT DISEASE ANALYSIS REPORT
+============================
+
+Diagnosis: {UNKNOWN_LABEL}
+Closest match: {format_disease_name(disease_name)} ({confidence*100:.1f}%)
+Analysis Date: {analysis_date or 'N/A'}
+
+The model was not confident enough to diagnose this photo, so no treatment
+is recommended. Please retake it closer to a single leaf in good light.
+
+DISCLAIMER:
+This analysis is provided by an AI system for guidance purposes only. 
+For serious infections or if you're uncertain about the diagnosis, 
+please consult with local agricultural experts or extension services.
+
+Generated by Plant Disease Classifier AI
+"""
+
+    report = f"""
+PLANT DISEASE ANALYSIS REPORT
+============================
+
+Diagnosis: {format_disease_name(disease_name)}
+Confidence: {confidence*100:.1f}%
+Analysis Date: {analysis_date or 'N/A'}
+
+DESCRIPTION:
+{treatment_info.get('description', 'No description available')}
+
+SYMPTOMS:
+"""
+    
+    for symptom in treatment_info.get('symptoms', []):
+        report += f"• {symptom}\n"
+    
+    report += "\nRECOMMENDED TREATMENT:\n"
+    for treatment in treatment_info.get('treatment', []):
+        report += f"• {treatment}\n"
+    
+    report += "\nPREVENTION MEASURES:\n"
+    for prevention in treatment_info.get('prevention', []):
+        report += f"• {prevention}\n"
+    
+    report += """
+DISCLAIMER:
+This analysis is provided by an AI system for guidance purposes only. 
+For serious infections or if you're uncertain about the diagnosis, 
+please consult with local agricultural experts or extension services.
+
+Generated by Plant Disease Classifier AI
+"""
+    
+    return report
@@ -0,0 +1,520 @@
+"""Asynchronous HTTP inference service (ASGI) for mobile and IoT clients
+
+Run with any ASGI server, for example:
+
+    uvicorn server:app --host 0.0.0.0 --port 8000
+
+Endpoints:
+    POST /classify          raw image bytes in the body -> top-k diagnosis
+    POST /classify/batch    multipart/form-data or a zip archive of images
+    GET  /health            liveness: the process is up
+    GET  /ready             readiness: the model is loaded and warmed up
+    GET  /metrics           Prometheus metrics
+    GET  /history/rates     weekly share of diagnoses per field for the diseases in ?disease=
+    GET  /history/export    zip of diagnoses.csv and one report per diagnosis, streamed
+    POST /similar           raw image bytes -> the ?k= (default 10, at most 100) most similar confirmed images
+    POST /similar/confirm   raw image bytes plus ?disease=<class name> -> added to the confirmed images
+
+Query parameters for the classify endpoints: top_k (default 3, 1 to the number of classes), lang
+(default en), info=0 to omit disease information and crop (for example
+crop=tomato) to consider only that crop's diseases. field_id, lat and lon
+are stored with the diagnosis in the history (see history.py). Images whose
+calibrated confidence falls below the rejection threshold come back with
+accepted=false, diagnosis "Unknown / not a leaf" and no disease information.
+"""
+import asyncio
+import hashlib
+import io
+import json
+import os
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from email.parser import BytesParser
+from email.policy import HTTP
+from urllib.parse import parse_qs
+
+from model_utils import preprocess_image, get_class_names, resize_to_input
+from model_registry import get_registry
+from inference_scheduler import get_scheduler, QueueFullError
+from prediction_cache import get_prediction_cache
+from disease_info import get_disease_info
+from metrics import get_metrics, record_error, render_prometheus, span
+from postprocessing import UNKNOWN_LABEL, get_calibration, record_to_list
+from crops import resolve_crop
+from history import get_history, history_enabled, iter_report_archive
+from similarity import get_similarity_index
+from worker_pool import get_worker_pool, start_worker_pool, worker_pool_enabled, worker_pool_running
+from image_upload import ImageUpload, ImageValidationError, MAX_FILE_SIZE
+
+MAX_BATCH_IMAGES = int(os.environ.get('SERVER_MAX_BATCH_IMAGES', 64))
+MAX_BATCH_BYTES = MAX_BATCH_IMAGES * MAX_FILE_SIZE
+REQUEST_TIMEOUT = float(os.environ.get('SERVER_REQUEST_TIMEOUT', 30))
+
+# Decoding and resizing release the GIL in PIL/OpenCV, so a thread pool keeps
+# them off the event loop without pickling images to other processes
+_decode_pool = ThreadPoolExecutor(max_workers=int(os.environ.get('SERVER_DECODE_THREADS', os.cpu_count() or 4)),
+                                  thread_name_prefix='decode')
+_class_names = get_class_names()
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+class RequestValidationError(HTTPError):
+    """A query parameter or request field the client got wrong (400)"""
+
+    def __init__(self, message):
+        super().__init__(400, message)
+
+
+async def read_body(receive, limit):
+    """Read a (possibly chunked) request body, rejecting it as soon as it exceeds limit"""
+    body = bytearray()
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            raise HTTPError(499, "Client disconnected")
+        body.extend(message.get('body', b''))
+        if len(body) > limit:
+            raise HTTPError(413, f"Request body larger than {limit // (1024 * 1024)}MB")
+        if not message.get('more_body', False):
+            return bytes(body)
+
+
+async def send_json(send, status, payload):
+    body = json.dumps(payload).encode()
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def send_text(send, status, text, content_type=b'text/plain; charset=utf-8'):
+    body = text.encode()
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', content_type), (b'content-length', str(len(body)).encode())],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+def _header(scope, name):
+    for key, value in scope.get('headers', []):
+        if key.decode('latin-1').lower() == name:
+            return value.decode('latin-1')
+    return ''
+
+
+def _disease_info_json(disease_name, lang):
+    return {key: list(value) if isinstance(value, tuple) else value
+            for key, value in get_disease_info(disease_name, lang).items()}
+
+
+def decode(data, name=None, normalize=True):
+    """Validate and preprocess one image (runs on the decode pool)
+
+    With normalize=False the image is only resized to uint8 model input, for
+    the worker pool, which normalizes in its own processes.
+    """
+    upload = ImageUpload(data, name).validate()
+    return preprocess_image(upload.image) if normalize else resize_to_input(upload.image)
+
+
+def cache_lookup(cache, data, model_version, top_k):
+    """Hash the raw bytes and look them up in the prediction cache (runs on the decode pool)
+
+    Returns (content hash, cache key, cached prediction or None); a hit needs no decoding.
+    """
+    content_hash = hashlib.sha256(data).hexdigest()
+    cache_key = cache.make_key(content_hash, model_version, top_k) if model_version else None
+    return content_hash, cache_key, cache.get(cache_key) if cache_key else None
+
+
+def is_ready():
+    if worker_pool_enabled():
+        return worker_pool_running()
+    return get_registry().is_loaded()
+
+
+def _float_param(params, name):
+    value = params.get(name)
+    try:
+        return float(value) if value not in (None, '') else None
+    except ValueError:
+        raise RequestValidationError(f"{name} must be a number")
+
+
+def _int_param(params, name, default, low, high):
+    value = params.get(name)
+    if value in (None, ''):
+        return default
+    try:
+        value = int(value)
+    except ValueError:
+        raise RequestValidationError(f"{name} must be an integer")
+    if not low <= value <= high:
+        raise RequestValidationError(f"{name} must be between {low} and {high}")
+    return value
+
+
+def _classify_options(params):
+    """(top_k, crop, latitude, longitude) from the query, validated before any image is decoded"""
+    top_k = _int_param(params, 'top_k', 3, 1, len(_class_names))
+    try:
+        crop = resolve_crop(params.get('crop'))
+    except ValueError as e:
+        raise RequestValidationError(str(e))
+    return top_k, crop, _float_param(params, 'lat'), _float_param(params, 'lon')
+
+
+def _history_filters(params):
+    """(field_id, since) from ?field_id= and ?weeks= (default: the last 12 weeks)"""
+    history = get_history()
+    if history is None:
+        raise HTTPError(404, "Diagnosis history is disabled")
+    weeks = _float_param(params, 'weeks')
+    since = time.time() - (weeks if weeks is not None else 12) * 7 * 24 * 3600
+    return history, params.get('field_id') or None, since
+
+
+async def classify_bytes(data, params, name=None):
+    """Classify one image: cache lookup and, on a miss, decode on the thread pool, then batch inference"""
+    loop = asyncio.get_running_loop()
+    top_k, crop, latitude, longitude = _classify_options(params)
+    lang = params.get('lang', 'en')
+
+    if not is_ready():
+        raise HTTPError(503, "Model is still loading")
+    pool = get_worker_pool()
+    if pool is None:
+        model = get_registry().get()
+        model_version = get_registry().version_of(model)
+    else:
+        model_version = pool.version
+
+    cache = get_prediction_cache()
+    calibration = get_calibration()
+    content_hash, cache_key, prediction = await loop.run_in_executor(
+        _decode_pool, cache_lookup, cache, data,
+        f"{model_version}+crop{crop}+{calibration.version}" if model_version else None, top_k)
+
+    if prediction is None:
+        # Only images that passed validation are cached, so a hit skips it along with the decode
+        try:
+            processed_image = await loop.run_in_executor(_decode_pool, decode, data, name, pool is None)
+        except ImageValidationError as e:
+            raise HTTPError(400, str(e))
+        try:
+            if pool is None:
+                future = get_scheduler().submit(model, processed_image, top_k=top_k, timeout=REQUEST_TIMEOUT,
+                                                crop=crop)
+            else:
+                # Waiting for a free shared-memory slot may block, so do it off the event loop
+                future = await loop.run_in_executor(_decode_pool, pool.submit, processed_image, top_k, crop)
+        except QueueFullError as e:
+            raise HTTPError(429, str(e))
+        try:
+            with span('inference'):
+                record = await asyncio.wait_for(asyncio.wrap_future(future), REQUEST_TIMEOUT)
+        except (asyncio.TimeoutError, TimeoutError):
+            future.cancel()
+            raise HTTPError(504, "Inference timed out")
+        prediction = record_to_list(record)
+        if cache_key:
+            # The disk tier commits to SQLite, so keep it off the event loop
+            await loop.run_in_executor(_decode_pool, cache.put, cache_key, prediction)
+
+    class_ids, confidences, accepted = prediction
+    predictions = []
+    for idx, confidence in zip(class_ids, confidences):
+        entry = {'disease': _class_names[idx], 'confidence': confidence}
+        # Rejected images get no treatment advice
+        if accepted and params.get('info', '1') != '0':
+            entry['info'] = _disease_info_json(_class_names[idx], lang)
+        predictions.append(entry)
+
+    history = get_history()
+    if history is not None:
+        history.record(prediction, content_hash, model_version, params.get('field_id'), latitude, longitude,
+                       source='api')
+
+    result = {
+        'diagnosis': _class_names[class_ids[0]] if accepted else UNKNOWN_LABEL,
+        'accepted': accepted,
+        'predictions': predictions,
+        'model_version': model_version,
+    }
+    if name is not None:
+        result['file'] = name
+    return result
+
+
+def split_batch(body, content_type):
+    """Return (name, bytes) pairs from a multipart/form-data or zip request body"""
+    if content_type.startswith('multipart/form-data'):
+        message = BytesParser(policy=HTTP).parsebytes(
+            b'Content-Type: ' + content_type.encode('latin-1') + b'\r\n\r\n' + body
+        )
+        return [(part.get_filename() or part.get_param('name', header='content-disposition'),
+                 part.get_payload(decode=True))
+                for part in message.iter_parts() if part.get_payload(decode=True)]
+
+    if content_type in ('application/zip', 'application/x-zip-compressed'):
+        try:
+            archive = zipfile.ZipFile(io.BytesIO(body))
+        except zipfile.BadZipFile:
+            raise HTTPError(400, "Invalid zip archive")
+        return [(info.filename, archive.read(info)) for info in archive.infolist()
+                if not info.is_dir() and info.file_size <= MAX_FILE_SIZE]
+
+    raise HTTPError(415, "Send multipart/form-data or application/zip")
+
+
+async def handle_classify(scope, receive, params):
+    body = await read_body(receive, MAX_FILE_SIZE)
+    if not body:
+        raise HTTPError(400, "Empty request body")
+    return await classify_bytes(body, params)
+
+
+async def handle_classify_batch(scope, receive, params):
+    # Bad options fail the whole request rather than every image in it
+    _classify_options(params)
+    body = await read_body(receive, MAX_BATCH_BYTES)
+    items = await asyncio.get_running_loop().run_in_executor(
+        _decode_pool, split_batch, body, _header(scope, 'content-type'))
+    if not items:
+        raise HTTPError(400, "No images in request")
+    if len(items) > MAX_BATCH_IMAGES:
+        raise HTTPError(413, f"At most {MAX_BATCH_IMAGES} images per request")
+
+    # All images are submitted at once, so the scheduler batches them together
+    async def classify_one(name, data):
+        try:
+            return await classify_bytes(data, params, name)
+        except HTTPError as e:
+            return {'file': name, 'error': e.message, 'status': e.status}
+        except Exception as e:
+            # One failing image must not discard the results of the others
+            record_error('server')
+            return {'file': name, 'error': f"Error during classification: {str(e)}", 'status': 500}
+
+    results = await asyncio.gather(*(classify_one(name, data) for name, data in items))
+    return {'results': results}
+
+
+async def handle_history_rates(scope, receive, params):
+    history, field_id, since = _history_filters(params)
+    names = [name for name in params.get('disease', '').split(',') if name]
+    unknown = [name for name in names if name not in _class_names]
+    if not names or unknown:
+        raise RequestValidationError(f"Unknown disease {', '.join(unknown)}" if unknown else "Give ?disease=<class name>")
+    class_ids = [_class_names.index(name) for name in names]
+    rates = await asyncio.get_running_loop().run_in_executor(
+        _decode_pool, lambda: history.weekly_rates(class_ids, field_id, since))
+    return {'diseases': names, 'rates': rates}
+
+
+async def send_archive(send, params):
+    """Stream the history export without building the archive in memory"""
+    history, field_id, since = _history_filters(params)
+    chunks = iter_report_archive(history, _class_names, field_id, since)
+    loop = asyncio.get_running_loop()
+    # Reading rows and compressing happen off the event loop. The first chunk
+    # is read before the status line, so a failing query still gets an error response
+    chunk = await loop.run_in_executor(_decode_pool, next, chunks, None)
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': [(b'content-type', b'application/zip'),
+                    (b'content-disposition', b'attachment; filename="diagnosis_reports.zip"')],
+    })
+    try:
+        while chunk is not None:
+            if chunk:
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            chunk = await loop.run_in_executor(_decode_pool, next, chunks, None)
+    except Exception as e:
+        # Too late for an error response; ending without the last chunk shows the client a truncated download
+        record_error('history_export')
+        print(f"History export failed after the response started: {str(e)}")
+        return
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+async def embed_body(receive):
+    """Read and decode an image, returning (index, content hash, uint8 image, record, embedding)
+
+    Embeddings come from the in-process model through the scheduler, also
+    when classification runs on the worker pool.
+    """
+    index = get_similarity_index()
+    if index is None:
+        raise HTTPError(404, "Similar cases are disabled")
+    body = await read_body(receive, MAX_FILE_SIZE)
+    if not body:
+        raise HTTPError(400, "Empty request body")
+    loop = asyncio.get_running_loop()
+    model = await loop.run_in_executor(_decode_pool, get_registry().get)
+    if not getattr(model, 'returns_embeddings', False):
+        raise HTTPError(501, f"The {model.kind} engine does not return embeddings")
+    try:
+        content_hash, image = await loop.run_in_executor(
+            _decode_pool, lambda: (hashlib.sha256(body).hexdigest(), decode(body, None, False)))
+    except ImageValidationError as e:
+        raise HTTPError(400, str(e))
+    try:
+        future = get_scheduler().submit(model, preprocess_image(image), top_k=1, timeout=REQUEST_TIMEOUT,
+                                        embed=True)
+    except QueueFullError as e:
+        raise HTTPError(429, str(e))
+    try:
+        with span('inference'):
+            record, embedding = await asyncio.wait_for(asyncio.wrap_future(future), REQUEST_TIMEOUT)
+    except (asyncio.TimeoutError, TimeoutError):
+        future.cancel()
+        raise HTTPError(504, "Inference timed out")
+    return index, content_hash, image, record, embedding
+
+
+async def handle_similar(scope, receive, params):
+    k = _int_param(params, 'k', 10, 1, 100)
+    index, _, _, record, embedding = await embed_body(receive)
+    matches = await asyncio.get_running_loop().run_in_executor(_decode_pool, index.search, embedding, k)
+    return {
+        'diagnosis': _class_names[record['class_id'][0]] if record['accepted'] else UNKNOWN_LABEL,
+        'matches': [{
+            'disease': _class_names[match['class_id']],
+            'similarity': match['similarity'],
+            'sha256': match['sha256'],
+            'created': match['created'],
+        } for match in matches],
+        'searched': index.count,
+    }
+
+
+async def handle_similar_confirm(scope, receive, params):
+    disease = params.get('disease')
+    if disease not in _class_names:
+        raise RequestValidationError(f"Unknown disease {disease}" if disease else "Give ?disease=<class name>")
+    index, content_hash, image, _, embedding = await embed_body(receive)
+    ids = await asyncio.get_running_loop().run_in_executor(
+        _decode_pool, lambda: index.add([embedding], [_class_names.index(disease)], [content_hash], images=[image]))
+    return {'id': int(ids[0]), 'disease': disease, 'sha256': content_hash, 'confirmed_images': index.count}
+
+
+ROUTES = {
+    ('POST', '/classify'): handle_classify,
+    ('POST', '/classify/batch'): handle_classify_batch,
+    ('GET', '/history/rates'): handle_history_rates,
+    ('POST', '/similar'): handle_similar,
+    ('POST', '/similar/confirm'): handle_similar_confirm,
+}
+KNOWN_PATHS = {'/health', '/ready', '/metrics', '/history/export'} | {route_path for _, route_path in ROUTES}
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            # Load and warm up the model in the background; /ready reports when it is done
+            if worker_pool_enabled():
+                threading.Thread(target=start_worker_pool, name='worker-pool-start', daemon=True).start()
+            else:
+                get_registry().preload()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            _decode_pool.shutdown(wait=False)
+            if worker_pool_running():
+                get_worker_pool().close()
+            if history_enabled():
+                get_history().flush()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    """ASGI entry point"""
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+
+    path = scope['path'].rstrip('/') or '/'
+    statuses = []
+
+    async def send_tracked(message):
+        if message['type'] == 'http.response.start':
+            statuses.append(message['status'])
+        await send(message)
+
+    start = time.perf_counter()
+    try:
+        await dispatch(scope, receive, send_tracked, path)
+    finally:
+        # Label by route rather than raw path to keep the series count bounded
+        route = path if path in KNOWN_PATHS else 'other'
+        status = str(statuses[0]) if statuses else '499'
+        metrics = get_metrics()
+        metrics.counter('plant_http_requests_total', 'HTTP requests by route and status').inc(
+            route=route, status=status)
+        metrics.histogram('plant_http_request_seconds', 'HTTP request latency by route').observe(
+            time.perf_counter() - start, route=route)
+
+
+async def dispatch(scope, receive, send, path):
+    method = scope['method']
+    params = {key: values[-1] for key, values in parse_qs(scope.get('query_string', b'').decode()).items()}
+
+    try:
+        if path == '/health' and method == 'GET':
+            await send_json(send, 200, {'status': 'ok'})
+            return
+        if path == '/metrics' and method == 'GET':
+            await send_text(send, 200, render_prometheus(), b'text/plain; version=0.0.4')
+            return
+        if path == '/ready' and method == 'GET':
+            if worker_pool_enabled():
+                if worker_pool_running():
+                    await send_json(send, 200, {'status': 'ready', 'worker_pool': get_worker_pool().stats()})
+                else:
+                    await send_json(send, 503, {'status': 'loading'})
+            elif get_registry().is_loaded():
+                await send_json(send, 200, {'status': 'ready', 'models': get_registry().stats()['models'],
+                                            'scheduler': get_scheduler().stats()})
+            else:
+                get_registry().preload()
+                await send_json(send, 503, {'status': 'loading'})
+            return
+
+        if path == '/history/export' and method == 'GET':
+            await send_archive(send, params)
+            return
+
+        handler = ROUTES.get((method, path))
+        if handler is None:
+            known_path = any(route_path == path for _, route_path in ROUTES)
+            raise HTTPError(405 if known_path else 404, "Method not allowed" if known_path else "Not found")
+        await send_json(send, 200, await handler(scope, receive, params))
+
+    except HTTPError as e:
+        if e.status != 499:
+            await send_json(send, e.status, {'error': e.message})
+    except Exception as e:
+        record_error('server')
+        await send_json(send, 500, {'error': f"Error during classification: {str(e)}"})
+
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run(app, host=os.environ.get('SERVER_HOST', '0.0.0.0'), port=int(os.environ.get('SERVER_PORT', 8000)))
@@ -0,0 +1,458 @@
+"""Approximate nearest-neighbour search over the embeddings of confirmed images
+
+When a diagnosis is uncertain, the most similar previously confirmed images
+help an agronomist decide. Each confirmed image is kept as its embedding:
+the model's penultimate-layer features, L2-normalized, so the inner product
+is the cosine similarity. An index is a directory:
+
+    index.json     embedding size, list count and the tensor stores referenced
+    vectors.f16    float16 (count, dim), appended to on every insert
+    items.bin      one ITEM_DTYPE record per vector: inverted list, confirmed
+                   class, time added, image SHA-256 and where the image is
+    centroids.npy  float32 (nlist, dim) k-means centroids, once trained
+    images/        224x224 JPEG thumbnails of confirmed uploads
+    index.lock     held by whichever process is writing
+
+Search uses an inverted file (IVF): each vector belongs to the list of its
+nearest centroid, and a query only scores the lists of its nprobe closest
+centroids, read from the memory-mapped vectors. An insert appends to the
+files and to its list, so the index never needs rebuilding. Until
+train_size vectors exist the index searches exhaustively, then trains its
+centroids once on a background thread; `python -m plant_classifier
+build-index` trains with a list count suited to a whole tensor store.
+
+The Streamlit app, the HTTP server and the CLI may open the same index.
+Writes hold a file lock, and each process picks up rows and centroids the
+others wrote before it writes or searches.
+"""
+import fcntl
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+from metrics import get_metrics, record_error
+
+DEFAULT_INDEX_PATH = 'similar_index'
+DEFAULT_NPROBE = 32
+# Vectors at which an untrained index fits its centroids
+TRAIN_SIZE = 20000
+# List of a vector added before the centroids were trained
+UNASSIGNED = -1
+# store is -1 for confirmed uploads, whose thumbnail is under images/
+ITEM_DTYPE = np.dtype([('list', '<i4'), ('class_id', '<i2'), ('store', '<i2'), ('row', '<i4'),
+                       ('created', '<f8'), ('sha256', 'u1', (32,))])
+
+
+def normalize(vectors):
+    """Scale rows to unit length as float32; a single vector becomes a batch of one"""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if vectors.ndim == 1:
+        vectors = vectors[np.newaxis]
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+
+def assign(vectors, centroids, chunk_size=16384):
+    """Index of the closest centroid (by inner product) for each row of vectors"""
+    lists = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), chunk_size):
+        chunk = np.asarray(vectors[start:start + chunk_size], dtype=np.float32)
+        lists[start:start + len(chunk)] = (chunk @ centroids.T).argmax(axis=1)
+    return lists
+
+
+def kmeans(vectors, nlist, iterations=10, seed=0):
+    """Spherical k-means: unit-length centroids maximizing the inner product with their members"""
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), nlist, replace=False)].copy()
+    for _ in range(iterations):
+        lists = assign(vectors, centroids)
+        order = np.argsort(lists, kind='stable')
+        counts = np.bincount(lists, minlength=nlist)
+        filled = np.flatnonzero(counts)
+        # Sum each list's members in one pass over the sorted rows
+        sums = np.add.reduceat(vectors[order], np.concatenate([[0], np.cumsum(counts)[:-1]])[filled], axis=0)
+        centroids[filled] = normalize(sums)
+        # Empty lists restart from random vectors
+        empty = np.flatnonzero(counts == 0)
+        if len(empty):
+            centroids[empty] = vectors[rng.choice(len(vectors), len(empty), replace=False)]
+    return centroids
+
+
+class SimilarityIndex:
+    """IVF index of float16 embeddings on disk with append-only inserts
+
+    Safe to share between threads and processes: inserts and training hold
+    a lock, and searches only hold it while taking a snapshot of the lists.
+    """
+
+    def __init__(self, path, nprobe=DEFAULT_NPROBE, train_size=TRAIN_SIZE):
+        self.path = path
+        self.nprobe = nprobe
+        # None never trains automatically (build_index trains once at the end)
+        self.train_size = train_size
+        self.meta = {'dim': None, 'nlist': 0, 'stores': []}
+        self.count = 0
+        self._vectors = None
+        self._items = None
+        self._centroids = None
+        self._members = []
+        self._stores = {}
+        self._lock = threading.RLock()
+        self._lock_file = None
+        self._centroids_mtime = None
+        self._synced = None
+        self._training = False
+        try:
+            if os.path.exists(self._file('index.json')):
+                with self._locked():
+                    self._sync()
+            self._synced = self._disk_state()
+        except Exception as e:
+            raise Exception(f"Failed to open similarity index {path}: {str(e)}")
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def _size(self, name):
+        path = self._file(name)
+        return os.path.getsize(path) if os.path.exists(path) else 0
+
+    def _mtime(self, name):
+        path = self._file(name)
+        return os.stat(path).st_mtime_ns if os.path.exists(path) else None
+
+    def _disk_state(self):
+        """Changes when another process appends rows, retrains the centroids or registers a store"""
+        return self._size('items.bin'), self._mtime('centroids.npy'), self._mtime('index.json')
+
+    @contextmanager
+    def _locked(self):
+        """Hold the index for writing: the thread lock, plus a file lock shared with other processes"""
+        with self._lock:
+            if self._lock_file is not None:
+                # Re-entered by the thread that already holds the file lock
+                yield
+                return
+            os.makedirs(self.path, exist_ok=True)
+            self._lock_file = open(self._file('index.lock'), 'a')
+            try:
+                fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+                yield
+            finally:
+                # Closing the file releases the lock
+                self._lock_file.close()
+                self._lock_file = None
+
+    @property
+    def dim(self):
+        return self.meta['dim']
+
+    @property
+    def trained(self):
+        return self._centroids is not None
+
+    def _sync(self):
+        """Catch up with the files: rows other processes appended and centroids they trained
+
+        Call with the index locked. Also drops a partial insert left by a
+        crash; that is only safe under the file lock every writer holds.
+        """
+        if not os.path.exists(self._file('index.json')) or self._disk_state() == self._synced:
+            return
+        with open(self._file('index.json')) as f:
+            self.meta = json.load(f)
+        if self.dim is None:
+            return
+        vector_bytes = 2 * self.dim
+        count = min(self._size('vectors.f16') // vector_bytes, self._size('items.bin') // ITEM_DTYPE.itemsize)
+        for name, row_bytes in (('vectors.f16', vector_bytes), ('items.bin', ITEM_DTYPE.itemsize)):
+            if self._size(name) > count * row_bytes:
+                os.truncate(self._file(name), count * row_bytes)
+
+        centroids_mtime = self._mtime('centroids.npy')
+        if count != self.count or centroids_mtime != self._centroids_mtime:
+            self.count = count
+            self._remap()
+            if centroids_mtime is not None:
+                if centroids_mtime != self._centroids_mtime:
+                    self._centroids = np.load(self._file('centroids.npy'))
+                lists = np.array(self._items['list'])
+                unassigned = np.flatnonzero(lists == UNASSIGNED)
+                if len(unassigned):
+                    lists[unassigned] = assign(self._vectors[unassigned], self._centroids)
+                    self._write_lists(lists)
+                self._build_members(lists)
+            self._centroids_mtime = centroids_mtime
+        self._synced = self._disk_state()
+
+    def _write_meta(self):
+        os.makedirs(self.path, exist_ok=True)
+        tmp = self._file('index.json.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(self.meta, f, indent=2)
+        os.replace(tmp, self._file('index.json'))
+
+    def _remap(self):
+        if self.count:
+            self._vectors = np.memmap(self._file('vectors.f16'), np.float16, 'r', shape=(self.count, self.dim))
+            self._items = np.memmap(self._file('items.bin'), ITEM_DTYPE, 'r', shape=(self.count,))
+        else:
+            self._vectors = np.empty((0, self.dim or 0), dtype=np.float16)
+            self._items = np.empty(0, dtype=ITEM_DTYPE)
+
+    def _write_lists(self, lists):
+        items = np.memmap(self._file('items.bin'), ITEM_DTYPE, 'r+', shape=(self.count,))
+        items['list'] = lists
+        items.flush()
+        del items
+
+    def _build_members(self, lists):
+        order = np.argsort(lists, kind='stable')
+        counts = np.bincount(lists, minlength=len(self._centroids))
+        self._members = np.split(order, np.cumsum(counts)[:-1])
+
+    def store_id(self, store_path):
+        """Number under which items refer to a tensor store, registering it if new"""
+        store_path = os.path.abspath(store_path)
+        with self._locked():
+            self._sync()
+            if store_path not in self.meta['stores']:
+                self.meta['stores'].append(store_path)
+                if self.dim is not None:
+                    self._write_meta()
+            return self.meta['stores'].index(store_path)
+
+    def add(self, embeddings, class_ids, sha256s, store=-1, rows=None, images=None, created=None):
+        """Append confirmed images; returns their ids
+
+        sha256s are hex digests of the original files. Images come either
+        from a tensor store (store from store_id, plus their rows) or as
+        uint8 224x224 arrays in images, saved as thumbnails.
+        """
+        vectors = normalize(embeddings)
+        items = np.zeros(len(vectors), dtype=ITEM_DTYPE)
+        items['list'] = UNASSIGNED
+        items['class_id'] = class_ids
+        items['store'] = store
+        items['row'] = rows if rows is not None else -1
+        items['created'] = created if created is not None else time.time()
+        items['sha256'] = [np.frombuffer(bytes.fromhex(sha), dtype=np.uint8) for sha in sha256s]
+
+        with self._locked():
+            self._sync()
+            if self.dim is None:
+                self.meta['dim'] = int(vectors.shape[1])
+                self._write_meta()
+            elif vectors.shape[1] != self.dim:
+                raise ValueError(f"Embeddings have {vectors.shape[1]} features, the index holds {self.dim}; "
+                                 "was it built with another model?")
+            if images is not None:
+                self._save_thumbnails(sha256s, images)
+            if self.trained:
+                items['list'] = assign(vectors, self._centroids)
+
+            # Vectors first: after a crash, _sync keeps only rows present in both files
+            with open(self._file('vectors.f16'), 'ab') as f:
+                f.write(vectors.astype(np.float16).tobytes())
+            with open(self._file('items.bin'), 'ab') as f:
+                f.write(items.tobytes())
+            ids = np.arange(self.count, self.count + len(items))
+            self.count += len(items)
+            self._remap()
+
+            if self.trained:
+                for list_id in np.unique(items['list']):
+                    self._members[list_id] = np.concatenate([self._members[list_id],
+                                                             ids[items['list'] == list_id]])
+            self._synced = self._disk_state()
+
+            # Training takes seconds; the insert that crosses train_size should not wait for it
+            train = (not self.trained and not self._training and self.train_size is not None
+                     and self.count >= self.train_size)
+            self._training = self._training or train
+        if train:
+            threading.Thread(target=self._train_in_background, name='similarity-train', daemon=True).start()
+        return ids
+
+    def _train_in_background(self):
+        try:
+            with self._locked():
+                # Another process sharing the index may have trained it already
+                self._sync()
+                if self.trained:
+                    return
+            self.train()
+        except Exception as e:
+            record_error('similarity_train')
+            print(f"Failed to train the similarity index: {str(e)}")
+        finally:
+            self._training = False
+
+    def _save_thumbnails(self, sha256s, images):
+        from PIL import Image
+
+        os.makedirs(self._file('images'), exist_ok=True)
+        for sha, image in zip(sha256s, images):
+            Image.fromarray(np.asarray(image, dtype=np.uint8)).save(self._file(f'images/{sha}.jpg'), quality=85)
+
+    def train(self, nlist=None, sample_size=None, iterations=10):
+        """Fit the IVF centroids on a sample of the vectors and assign every vector to a list
+
+        nlist defaults to 4 * sqrt(vector count), which keeps lists at a few
+        hundred vectors; converting float16 rows dominates search time, so
+        small lists matter more than few centroids. Inserts never need
+        this again; retraining after the index has grown many times over
+        only rebalances the lists.
+        """
+        with self._locked():
+            self._sync()
+            if self.count == 0:
+                raise ValueError("Cannot train an empty index")
+            count, vectors = self.count, self._vectors
+            nlist = int(min(nlist or np.clip(4 * np.sqrt(count), 16, 8192), count))
+            rng = np.random.default_rng(0)
+            sample = np.sort(rng.choice(count, min(count, sample_size or 16 * nlist), replace=False))
+            sample = np.asarray(vectors[sample], dtype=np.float32)
+
+        # k-means and the assignment run unlocked, so inserts and searches carry on meanwhile
+        start = time.perf_counter()
+        centroids = kmeans(sample, nlist, iterations)
+        lists = assign(vectors, centroids)
+
+        with self._locked():
+            self._sync()
+            if self.count > count:
+                lists = np.concatenate([lists, assign(self._vectors[count:], centroids)])
+            self._write_lists(lists)
+            tmp = self._file('centroids.npy.tmp')
+            with open(tmp, 'wb') as f:
+                np.save(f, centroids)
+            os.replace(tmp, self._file('centroids.npy'))
+            self.meta['nlist'] = nlist
+            self._write_meta()
+            self._centroids = centroids
+            self._build_members(lists)
+            self._synced = self._disk_state()
+            self._centroids_mtime = self._mtime('centroids.npy')
+        print(f"Trained {nlist} lists on {len(sample)} of {count} vectors in "
+              f"{time.perf_counter() - start:.1f}s")
+
+    def search(self, embedding, k=10, nprobe=None, class_ids=None):
+        """The k most similar confirmed images, best first
+
+        Returns dicts with id, class_id, similarity (cosine), created and
+        sha256. class_ids, when given, only keeps images confirmed as one
+        of those classes.
+        """
+        query = normalize(embedding)[0]
+        if self._disk_state() != self._synced:
+            with self._locked():
+                self._sync()
+        with self._lock:
+            count, vectors, items, centroids = self.count, self._vectors, self._items, self._centroids
+            if centroids is not None:
+                probe = np.argpartition(-(centroids @ query), min(nprobe or self.nprobe, len(centroids)) - 1)[:nprobe or self.nprobe]
+                # Sorted ids read the memory map front to back
+                candidates = np.sort(np.concatenate([self._members[list_id] for list_id in probe]))
+        if count == 0:
+            return []
+        if centroids is None:
+            candidates = np.arange(count)
+        if class_ids is not None:
+            candidates = candidates[np.isin(items['class_id'][candidates], class_ids)]
+
+        scores = np.empty(len(candidates), dtype=np.float32)
+        for start in range(0, len(candidates), 65536):
+            chunk = candidates[start:start + 65536]
+            scores[start:start + len(chunk)] = vectors[chunk].astype(np.float32) @ query
+        top = np.argpartition(-scores, k - 1)[:k] if len(scores) > k else np.arange(len(scores))
+        top = top[np.argsort(-scores[top])]
+        return [{
+            'id': int(candidates[i]),
+            'class_id': int(items['class_id'][candidates[i]]),
+            # float16 rounding can take an exact match slightly above 1
+            'similarity': min(float(scores[i]), 1.0),
+            'created': float(items['created'][candidates[i]]),
+            'sha256': items['sha256'][candidates[i]].tobytes().hex(),
+        } for i in top]
+
+    def thumbnail(self, item_id):
+        """The confirmed image as a PIL image, or None if its file is gone"""
+        from PIL import Image
+
+        item = self._items[item_id]
+        try:
+            if item['store'] >= 0:
+                from tensor_store import TensorStore
+
+                path = self.meta['stores'][item['store']]
+                if path not in self._stores:
+                    self._stores[path] = TensorStore(path)
+                return Image.fromarray(np.asarray(self._stores[path].images[item['row']]))
+            return Image.open(self._file(f"images/{item['sha256'].tobytes().hex()}.jpg"))
+        except Exception as e:
+            print(f"Failed to load image {item_id} of the similarity index: {str(e)}")
+            return None
+
+    def stats(self):
+        return {
+            'vectors': self.count,
+            'dim': self.dim,
+            'lists': len(self._members),
+            'trained': self.trained,
+            'training': self._training,
+            'bytes': self.count * (2 * (self.dim or 0) + ITEM_DTYPE.itemsize),
+        }
+
+
+def build_index(model, store, path=DEFAULT_INDEX_PATH, batch_size=64, nlist=None, progress=None):
+    """Embed every image of a labeled tensor store into the index at path, then train it
+
+    model is an engine with predict_with_embeddings. The store's labels are
+    taken as the confirmed classes and its images serve as thumbnails.
+    """
+    from model_utils import allocate_batch, preprocess_batch
+
+    index = SimilarityIndex(path, train_size=None)
+    if os.path.abspath(store.path) in index.meta['stores']:
+        raise ValueError(f"{store.path} is already in the index at {path}")
+    store_id = index.store_id(store.path)
+    buffer = allocate_batch(batch_size)
+    for start in range(0, len(store), batch_size):
+        images = store.images[start:start + batch_size]
+        _, embeddings = model.predict_with_embeddings(preprocess_batch(images, out=buffer))
+        rows = np.arange(start, start + len(images))
+        index.add(embeddings, store.labels[rows], [store.sha256(row) for row in rows], store_id, rows)
+        if progress is not None:
+            progress(start + len(images), len(store))
+    index.train(nlist)
+    return index
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def index_enabled():
+    """True when SIMILAR_INDEX_PATH names an index; similar cases are off by default"""
+    return bool(os.environ.get('SIMILAR_INDEX_PATH'))
+
+
+def get_similarity_index():
+    """Return the process-wide similarity index at SIMILAR_INDEX_PATH, or None when it is unset"""
+    global _index
+    if _index is None and index_enabled():
+        with _index_lock:
+            if _index is None:
+                _index = SimilarityIndex(
+                    os.environ['SIMILAR_INDEX_PATH'],
+                    nprobe=int(os.environ.get('SIMILAR_NPROBE', DEFAULT_NPROBE)),
+                )
+                get_metrics().gauge('plant_similar_vectors', 'Confirmed images in the similarity index',
+                                    fn=lambda: _index.count)
+    return _index
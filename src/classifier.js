@@ -1,8 +1,33 @@
 import * as tf from '@tensorflow/tfjs'
+import { setWasmPaths } from '@tensorflow/tfjs-backend-wasm'
+import wasmPath from '@tensorflow/tfjs-backend-wasm/dist/tfjs-backend-wasm.wasm?url'
+import wasmSimdPath from '@tensorflow/tfjs-backend-wasm/dist/tfjs-backend-wasm-simd.wasm?url'
+import wasmThreadedSimdPath from '@tensorflow/tfjs-backend-wasm/dist/tfjs-backend-wasm-threaded-simd.wasm?url'
+
+// Graph model written by `python -m plant_classifier export-tfjs` to public/model/
+const MODEL_URL = `${import.meta.env.BASE_URL}model/`
+const MODEL_CACHE_PREFIX = 'indexeddb://plant-disease-model-'
+// Python inference server (server.py); same origin by default, proxied by Vite in development
+const SERVER_URL = import.meta.env.VITE_INFERENCE_SERVER_URL || ''
+// Devices slower than this per image send their photos to the server instead
+const LATENCY_BUDGET_MS = Number(import.meta.env.VITE_LATENCY_BUDGET_MS || 1500)
+// Tried in order; cpu only remains when neither WebGL nor WebAssembly is available
+const BACKENDS = ['webgl', 'wasm', 'cpu']
+
+setWasmPaths({
+  'tfjs-backend-wasm.wasm': wasmPath,
+  'tfjs-backend-wasm-simd.wasm': wasmSimdPath,
+  'tfjs-backend-wasm-threaded-simd.wasm': wasmThreadedSimdPath
+})
 
 export class PlantDiseaseClassifier {
   constructor() {
     this.model = null
+    // 'device' runs the model in the browser, 'server' posts images to the inference server
+    this.mode = null
+    this.backend = null
+    this.latency = null
+    this.currentFile = null
     this.classNames = [
       'Apple___Apple_scab',
       'Apple___Black_rot',
@@ -88,31 +113,96 @@ export class PlantDiseaseClassifier {
   }
 
   async loadModel() {
+    console.log('Loading AI model...')
     try {
-      // For demo purposes, we'll create a mock model
-      // In a real implementation, you would load your trained model
-      console.log('Loading AI model...')
-      
-      // Simulate model loading delay
-      await new Promise(resolve => setTimeout(resolve, 1000))
-      
-      // Create a mock model for demonstration
-      this.model = {
-        predict: (tensor) => {
-          // Mock prediction - in reality this would be your trained model
-          const predictions = new Array(this.classNames.length).fill(0).map(() => Math.random())
-          
-          // Normalize to sum to 1
-          const sum = predictions.reduce((a, b) => a + b, 0)
-          return [predictions.map(p => p / sum)]
+      this.backend = await this.selectBackend()
+      this.model = await this.loadCachedModel()
+      this.latency = await this.warmUp()
+      console.log(`Model loaded on ${this.backend}: first call ${this.latency.firstMs.toFixed(0)} ms, ` +
+        `then ${this.latency.steadyMs.toFixed(0)} ms per image`)
+
+      if (this.latency.steadyMs > LATENCY_BUDGET_MS) {
+        console.log(`Slower than ${LATENCY_BUDGET_MS} ms per image; analyzing on the server`)
+        this.model.dispose()
+        this.model = null
+        this.mode = 'server'
+      } else {
+        this.mode = 'device'
+      }
+    } catch (error) {
+      console.warn('On-device model unavailable, analyzing on the server:', error)
+      this.model = null
+      this.mode = 'server'
+    }
+  }
+
+  async selectBackend() {
+    for (const backend of BACKENDS) {
+      try {
+        if (await tf.setBackend(backend)) {
+          await tf.ready()
+          return backend
         }
+      } catch (error) {
+        console.warn(`TF.js backend ${backend} unavailable:`, error)
       }
-      
-      console.log('Model loaded successfully')
+    }
+    throw new Error('No TF.js backend available')
+  }
+
+  async loadCachedModel() {
+    // metadata.json is tiny and never cached by the browser, so a new export is picked up on the next visit
+    let metadata = null
+    try {
+      const response = await fetch(`${MODEL_URL}metadata.json`, { cache: 'no-cache' })
+      if (response.ok) {
+        metadata = await response.json()
+      }
+    } catch (error) {
+      console.warn('Could not fetch model metadata:', error)
+    }
+
+    const cached = Object.keys(await tf.io.listModels()).filter(key => key.startsWith(MODEL_CACHE_PREFIX))
+    if (!metadata) {
+      // Offline: any previously downloaded version will do
+      if (cached.length === 0) {
+        throw new Error('No model available offline')
+      }
+      return tf.loadGraphModel(cached[0])
+    }
+
+    if (metadata.class_names) {
+      this.classNames = metadata.class_names
+    }
+    const cacheKey = MODEL_CACHE_PREFIX + metadata.version
+    if (cached.includes(cacheKey)) {
+      return tf.loadGraphModel(cacheKey)
+    }
+
+    const model = await tf.loadGraphModel(`${MODEL_URL}model.json`)
+    try {
+      await model.save(cacheKey)
+      await Promise.all(cached.map(key => tf.io.removeModel(key)))
     } catch (error) {
-      console.error('Error loading model:', error)
-      this.showError('Failed to load AI model. Please refresh the page and try again.')
+      // Private browsing or a full quota; the model still works, it is just downloaded again next time
+      console.warn('Could not cache the model in IndexedDB:', error)
     }
+    return model
+  }
+
+  async warmUp() {
+    // The first call compiles the WebGL shaders or initializes WebAssembly; the second shows the real cost
+    const dummy = tf.zeros([1, 224, 224, 3])
+    const timings = []
+    for (let i = 0; i < 2; i++) {
+      const start = performance.now()
+      const output = this.model.predict(dummy)
+      await output.data()
+      output.dispose()
+      timings.push(performance.now() - start)
+    }
+    dummy.dispose()
+    return { firstMs: timings[0], steadyMs: timings[1] }
   }
 
   validateImage(file) {
@@ -136,6 +226,7 @@ export class PlantDiseaseClassifier {
       return
     }
 
+    this.currentFile = file
     const reader = new FileReader()
     reader.onload = (e) => {
       this.displayImage(e.target.result, file)
@@ -176,7 +267,7 @@ export class PlantDiseaseClassifier {
   }
 
   async analyzeImage() {
-    if (!this.model) {
+    if (!this.mode) {
       this.showError('Model not loaded. Please wait and try again.')
       return
     }
@@ -184,29 +275,66 @@ export class PlantDiseaseClassifier {
     this.showLoading()
 
     try {
-      const previewImg = document.getElementById('previewImg')
-      
-      // Preprocess image
-      const tensor = await this.preprocessImage(previewImg)
-      
-      // Make prediction
-      const predictions = this.model.predict(tensor)
-      
-      // Get top 3 results
-      const results = this.getTopPredictions(predictions[0])
-      
+      let results
+      if (this.mode === 'device') {
+        try {
+          results = await this.classifyOnDevice(document.getElementById('previewImg'))
+        } catch (error) {
+          // For example a lost WebGL context; the server can still answer
+          console.warn('On-device analysis failed, using the server:', error)
+          results = await this.classifyOnServer(this.currentFile)
+        }
+      } else {
+        results = await this.classifyOnServer(this.currentFile)
+      }
+
       // Display results
       this.displayResults(results)
-      
-      // Clean up tensor
-      tensor.dispose()
-      
+
     } catch (error) {
       console.error('Error during analysis:', error)
       this.showError('Error during analysis. Please try again with a different image.')
     }
   }
 
+  async classifyOnDevice(imgElement) {
+    // Preprocess image
+    const tensor = await this.preprocessImage(imgElement)
+
+    // Make prediction
+    const output = this.model.predict(tensor)
+    const probabilities = await output.data()
+
+    // Clean up tensors
+    tensor.dispose()
+    output.dispose()
+
+    // Get top 3 results
+    const results = this.getTopPredictions(probabilities)
+    results.source = `on this device (${this.backend})`
+    return results
+  }
+
+  async classifyOnServer(file) {
+    const response = await fetch(`${SERVER_URL}/classify?top_k=3&info=0`, {
+      method: 'POST',
+      headers: { 'Content-Type': file.type },
+      body: file
+    })
+    const result = await response.json()
+    if (!response.ok) {
+      throw new Error(result.error || `Server returned ${response.status}`)
+    }
+
+    const results = result.predictions.map(prediction => ({
+      disease: prediction.disease,
+      confidence: prediction.confidence,
+      percentage: prediction.confidence * 100
+    }))
+    results.source = 'on the server'
+    return results
+  }
+
   async preprocessImage(imgElement) {
     return tf.tidy(() => {
       // Convert image to tensor
@@ -257,6 +385,7 @@ export class PlantDiseaseClassifier {
         <div class="confidence-bar">
           <div class="confidence-fill" style="width: ${topResult.percentage}%"></div>
         </div>
+        <div class="inference-source">Analyzed ${results.source}</div>
       </div>
     `
 
@@ -0,0 +1,41 @@
+import os
+import threading
+import time
+
+# Time-to-first-paint budget for a fresh worker, in seconds
+TTFP_BUDGET_SECONDS = float(os.environ.get('TTFP_BUDGET_SECONDS', 2.0))
+
+# Taken when the first script run imports this module, which is as close to
+# "a fresh worker starts serving" as Streamlit lets us get
+PROCESS_START = time.perf_counter()
+
+_marks = {}
+_lock = threading.Lock()
+
+
+def mark_once(name, seconds=None):
+    """Record a startup milestone the first time it happens; later calls are ignored
+
+    seconds defaults to the time elapsed since PROCESS_START.
+    """
+    if name in _marks:
+        return _marks[name]
+    with _lock:
+        if name not in _marks:
+            _marks[name] = seconds if seconds is not None else time.perf_counter() - PROCESS_START
+            if name == 'first_paint' and _marks[name] > TTFP_BUDGET_SECONDS:
+                print(f"Time to first paint {_marks[name]:.2f}s exceeded the "
+                      f"{TTFP_BUDGET_SECONDS:.2f}s budget")
+    return _marks[name]
+
+
+def get_marks():
+    """Return recorded milestones in seconds, plus the first-paint budget"""
+    marks = dict(_marks)
+    marks['ttfp_budget'] = TTFP_BUDGET_SECONDS
+    return marks
+
+
+def within_budget():
+    """True if first paint happened within budget (or has not happened yet)"""
+    return _marks.get('first_paint', 0.0) <= TTFP_BUDGET_SECONDS
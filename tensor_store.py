@@ -0,0 +1,234 @@
+"""Memory-mapped store of preprocessed images for repeated evaluation runs
+
+Decoding and resizing a 50k-image validation set dominates every
+evaluation. A tensor store does that work once: one file holds every image
+as a uint8 224x224x3 tensor, its label (an index into get_class_names())
+and the SHA-256 of the original file. Layout:
+
+    4 KiB   magic + JSON header (class names, count, section offsets)
+    images  uint8  (capacity, 224, 224, 3)
+    labels  int16  (capacity,)
+    hashes  uint8  (capacity, 32)
+
+Each section is page-aligned and read through np.memmap, so a chunk of
+images is a view of the page cache that is normalized straight into the
+model's input buffer.
+"""
+import hashlib
+import io
+import json
+import os
+import time
+
+import numpy as np
+
+from model_utils import MODEL_INPUT_SIZE, load_image_reduced
+
+MAGIC = b'PLTSTORE'
+HEADER_BYTES = 4096
+FORMAT_VERSION = 1
+
+
+def _align(offset, alignment=HEADER_BYTES):
+    return -(-offset // alignment) * alignment
+
+
+def _layout(capacity, size=MODEL_INPUT_SIZE):
+    """Byte offsets of each section for a store holding capacity images"""
+    images = HEADER_BYTES
+    labels = _align(images + capacity * size[1] * size[0] * 3)
+    hashes = _align(labels + capacity * 2)
+    return {'images': images, 'labels': labels, 'hashes': hashes, 'end': _align(hashes + capacity * 32)}
+
+
+def load_and_hash(path):
+    """Read one image file, returning (path, uint8 array, sha256 digest, error)"""
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+        return path, load_image_reduced(io.BytesIO(data)), hashlib.sha256(data).digest(), None
+    except Exception as e:
+        return path, None, None, str(e)
+
+
+def build_store(labeled_paths, out_path, class_names, workers=4, progress=None):
+    """Decode (path, label) pairs once into a tensor store at out_path
+
+    Images that fail to decode are skipped. The file is written next to
+    out_path and renamed into place when complete. Returns a summary
+    dictionary; ``progress`` is an optional callable receiving
+    (written, images_per_second).
+    """
+    from plant_classifier.scoring import prefetch
+
+    labeled_paths = list(labeled_paths)
+    labels_by_path = dict(labeled_paths)
+    capacity = len(labeled_paths)
+    layout = _layout(capacity)
+    height, width = MODEL_INPUT_SIZE[1], MODEL_INPUT_SIZE[0]
+
+    tmp_path = out_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.truncate(layout['end'])
+
+    images = np.memmap(tmp_path, np.uint8, 'r+', layout['images'], (capacity, height, width, 3))
+    labels = np.memmap(tmp_path, np.int16, 'r+', layout['labels'], (capacity,))
+    hashes = np.memmap(tmp_path, np.uint8, 'r+', layout['hashes'], (capacity, 32))
+
+    count = errors = 0
+    start = time.perf_counter()
+    try:
+        for path, array, digest, error in prefetch([path for path, _ in labeled_paths], workers,
+                                                   func=load_and_hash):
+            if error is not None:
+                print(f"Skipping {path}: {error}")
+                errors += 1
+                continue
+            images[count] = array
+            labels[count] = labels_by_path[path]
+            hashes[count] = np.frombuffer(digest, dtype=np.uint8)
+            count += 1
+            if progress is not None and count % 256 == 0:
+                progress(count, count / (time.perf_counter() - start))
+
+        for array in (images, labels, hashes):
+            array.flush()
+        del images, labels, hashes
+
+        header = {
+            'version': FORMAT_VERSION,
+            'count': count,
+            'capacity': capacity,
+            'image_shape': [height, width, 3],
+            'layout': layout,
+            'class_names': list(class_names),
+            'created': time.time(),
+        }
+        payload = MAGIC + json.dumps(header).encode('utf-8')
+        if len(payload) > HEADER_BYTES:
+            raise ValueError("Too many class names for the store header")
+        with open(tmp_path, 'r+b') as f:
+            f.write(payload.ljust(HEADER_BYTES, b' '))
+        os.replace(tmp_path, out_path)
+    except Exception as e:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise Exception(f"Failed to build tensor store: {str(e)}")
+
+    elapsed = time.perf_counter() - start
+    return {
+        'images': count,
+        'errors': errors,
+        'seconds': elapsed,
+        'images_per_second': count / elapsed if elapsed > 0 else 0.0,
+        'bytes': layout['end'],
+    }
+
+
+class TensorStore:
+    """Read-only view of a tensor store file; nothing is loaded until a chunk is touched"""
+
+    def __init__(self, path):
+        try:
+            with open(path, 'rb') as f:
+                raw = f.read(HEADER_BYTES)
+            if not raw.startswith(MAGIC):
+                raise ValueError("not a tensor store")
+            self.header = json.loads(raw[len(MAGIC):].decode('utf-8'))
+        except Exception as e:
+            raise Exception(f"Failed to open tensor store {path}: {str(e)}")
+
+        self.path = path
+        self.class_names = self.header['class_names']
+        count, capacity = self.header['count'], self.header['capacity']
+        layout = self.header['layout']
+        shape = tuple(self.header['image_shape'])
+        # Zero-capacity stores cannot be mapped; give them empty arrays instead
+        if capacity:
+            self.images = np.memmap(path, np.uint8, 'r', layout['images'], (capacity,) + shape)[:count]
+            self.labels = np.memmap(path, np.int16, 'r', layout['labels'], (capacity,))[:count]
+            self.hashes = np.memmap(path, np.uint8, 'r', layout['hashes'], (capacity, 32))[:count]
+        else:
+            self.images = np.empty((0,) + shape, dtype=np.uint8)
+            self.labels = np.empty(0, dtype=np.int16)
+            self.hashes = np.empty((0, 32), dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.labels)
+
+    def sha256(self, index):
+        """Hex digest of the original file for image index"""
+        return self.hashes[index].tobytes().hex()
+
+    def check_classes(self, class_names):
+        """Raise if the store's labels were indexed against different class names"""
+        if list(class_names) != self.class_names:
+            raise ValueError(f"{self.path} was built for a different class list; rebuild it")
+
+    def iter_chunks(self, chunk_size=64):
+        """Yield (images, labels) views of consecutive chunks, without copying"""
+        for start in range(0, len(self), chunk_size):
+            yield self.images[start:start + chunk_size], self.labels[start:start + chunk_size]
+
+
+def confusion_matrix(labels, predictions, num_classes):
+    """Counts of (true class, predicted class) pairs as a (num_classes, num_classes) array"""
+    flat = np.asarray(labels, dtype=np.int64) * num_classes + np.asarray(predictions, dtype=np.int64)
+    return np.bincount(flat, minlength=num_classes * num_classes).reshape(num_classes, num_classes)
+
+
+def evaluation_report(probabilities, labels, class_names, calibration=None, seconds=None):
+    """Accuracy, rejection coverage and per-class precision/recall from model outputs"""
+    from postprocessing import postprocess
+
+    labels = np.asarray(labels)
+    records = postprocess(probabilities, 1, calibration)
+    predictions = records['class_id'][:, 0]
+    accepted = records['accepted']
+    correct = predictions == labels
+
+    matrix = confusion_matrix(labels, predictions, len(class_names))
+    support = matrix.sum(axis=1)
+    predicted = matrix.sum(axis=0)
+    hits = np.diag(matrix)
+
+    per_class = []
+    for i, name in enumerate(class_names):
+        if support[i] == 0 and predicted[i] == 0:
+            continue
+        row = matrix[i].copy()
+        row[i] = 0
+        confused = int(row.argmax())
+        per_class.append({
+            'class': name,
+            'support': int(support[i]),
+            'precision': float(hits[i] / predicted[i]) if predicted[i] else 0.0,
+            'recall': float(hits[i] / support[i]) if support[i] else 0.0,
+            'most_confused_with': class_names[confused] if row[confused] else None,
+            'confused_count': int(row[confused]),
+        })
+
+    return {
+        'images': int(len(labels)),
+        'accuracy': float(correct.mean()) if len(labels) else 0.0,
+        'coverage': float(accepted.mean()) if len(labels) else 0.0,
+        'accepted_accuracy': float(correct[accepted].mean()) if accepted.any() else 0.0,
+        'seconds': seconds,
+        'images_per_second': len(labels) / seconds if seconds else None,
+        'per_class': per_class,
+        'confusion_matrix': matrix.tolist(),
+    }
+
+
+def predict_store(model, store, batch_size=64):
+    """Run every image in the store through the model, returning (probabilities, labels)"""
+    from model_utils import allocate_batch, preprocess_batch
+
+    buffer = allocate_batch(batch_size)
+    probabilities = []
+    for images, _ in store.iter_chunks(batch_size):
+        probabilities.append(np.asarray(model.predict_on_batch(preprocess_batch(images, out=buffer)),
+                                        dtype=np.float32))
+    if not probabilities:
+        raise ValueError(f"{store.path} holds no images")
+    return np.concatenate(probabilities), np.asarray(store.labels)
@@ -0,0 +1,21 @@
+import os
+
+import postprocessing
+from postprocessing import Calibration, get_calibration
+
+
+def test_broken_calibration_file_keeps_the_previous_calibration(tmp_path, monkeypatch):
+    path = tmp_path / 'calibration.json'
+    monkeypatch.setenv('CALIBRATION_PATH', str(path))
+    monkeypatch.delenv('REJECTION_THRESHOLD', raising=False)
+    monkeypatch.setattr(postprocessing, '_calibration', None)
+
+    Calibration(temperature=2.0, threshold=0.4).save(path)
+    assert not os.path.exists(f"{path}.tmp")
+    assert get_calibration().threshold == 0.4
+
+    path.write_text('{"temperature": 3.0, "thresh')
+    assert get_calibration().threshold == 0.4
+
+    Calibration(temperature=1.5, threshold=0.6).save(path)
+    assert get_calibration().threshold == 0.6
@@ -0,0 +1,33 @@
+import numpy as np
+
+from crops import ANY_CROP, CropTable
+from postprocessing import Calibration, postprocess
+
+CLASS_NAMES = ['Orange___Haunglongbing_(Citrus_greening)', 'Tomato___Late_blight', 'Tomato___healthy']
+
+
+def test_single_class_crop_is_still_rejected():
+    table = CropTable(CLASS_NAMES)
+    orange, tomato = table.resolve('orange'), table.resolve('tomato')
+    # Photos that are clearly not oranges, and one that is
+    probabilities = np.array([[0.02, 0.90, 0.08], [0.02, 0.90, 0.08], [0.97, 0.02, 0.01]], dtype=np.float32)
+    crops = [orange, tomato, orange]
+
+    records = postprocess(probabilities, k=1, calibration=Calibration(threshold=0.5), masks=table.crop_masks(crops))
+
+    # Renormalized over the crop, the only orange class always gets 100%
+    assert records['class_id'][:, 0].tolist() == [0, 1, 0]
+    assert np.allclose(records['confidence'][[0, 2], 0], 1.0)
+    assert records['accepted'].tolist() == [False, True, True]
+
+
+def test_without_hints_masks_change_nothing():
+    table = CropTable(CLASS_NAMES)
+    probabilities = np.array([[0.2, 0.5, 0.3]], dtype=np.float32)
+
+    assert table.crop_masks([ANY_CROP]) is None
+    expected = postprocess(probabilities, k=2, calibration=Calibration(threshold=0.4))
+    masked = postprocess(probabilities, k=2, calibration=Calibration(threshold=0.4),
+                         masks=table.masks[[ANY_CROP]])
+    assert masked['class_id'].tolist() == expected['class_id'].tolist()
+    assert masked['accepted'].tolist() == expected['accepted'].tolist()
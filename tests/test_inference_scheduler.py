@@ -0,0 +1,35 @@
+import time
+from concurrent.futures import TimeoutError
+
+import numpy as np
+import pytest
+
+from inference_scheduler import InferenceScheduler
+
+
+class SlowModel:
+    kind = 'fake'
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+    def predict_on_batch(self, batch):
+        time.sleep(self.seconds)
+        return np.tile(np.array([0.1, 0.6, 0.3], dtype=np.float32), (len(batch), 1))
+
+
+def test_timed_out_and_cancelled_request_does_not_stop_the_scheduler():
+    scheduler = InferenceScheduler(max_batch_size=1, max_latency_ms=1)
+    model = SlowModel(0.3)
+    image = np.zeros((224, 224, 3), dtype=np.float32)
+
+    # The first request occupies the model; the second expires in the queue and its caller cancels it
+    first = scheduler.submit(model, image, top_k=1)
+    with pytest.raises(TimeoutError):
+        scheduler.predict(model, image, top_k=1, timeout=0.05)
+    assert first.result(timeout=5)['class_id'][0] == 1
+
+    record = scheduler.predict(model, image, top_k=2, timeout=5)
+    assert record['class_id'].tolist() == [1, 2]
+    assert scheduler._worker.is_alive()
+    assert scheduler.timeouts == 1
@@ -0,0 +1,196 @@
+"""Tiled inference for high-resolution field photos
+
+Instead of squashing a 4000x3000 photo to 224x224, the image is cut into
+overlapping 224x224 tiles at (close to) native resolution. Tiles are
+strided NumPy views of the image, so nothing is copied until a tile is
+actually sent to the model. Background tiles (sky, soil, sensors) are
+skipped using the Excess Green vegetation index, so the cost follows leaf
+area rather than pixel count. Per-tile probabilities are combined into an
+image-level diagnosis and a heatmap of where the evidence came from.
+"""
+import numpy as np
+from PIL import Image
+
+from model_utils import MODEL_INPUT_SIZE, allocate_batch, preprocess_batch
+from postprocessing import get_calibration, postprocess
+from metrics import span
+from crops import ANY_CROP, crop_masks, predict_with_crop
+
+TILE_SIZE = MODEL_INPUT_SIZE[0]
+# Overlap of a quarter tile, so lesions on a tile border are seen whole by a neighbour
+DEFAULT_STRIDE = TILE_SIZE * 3 // 4
+# Longest side the photo is reduced to before tiling; bounds the tile count
+DEFAULT_MAX_SIDE = 2048
+# Excess Green threshold on chromatic coordinates and the share of a tile that must be vegetation
+EXG_THRESHOLD = 0.05
+MIN_VEGETATION = 0.1
+# The vegetation mask is computed on a subsampled image; this is the step in pixels
+MASK_STEP = 8
+
+
+def prepare_image(image, max_side=DEFAULT_MAX_SIDE):
+    """Return an RGB uint8 array whose longest side is at most max_side"""
+    if isinstance(image, Image.Image):
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        if max(image.size) > max_side:
+            scale = max_side / max(image.size)
+            image = image.resize((round(image.size[0] * scale), round(image.size[1] * scale)), Image.BILINEAR,
+                                 reducing_gap=2.0)
+        return np.asarray(image)
+
+    image = np.asarray(image)
+    if max(image.shape[:2]) > max_side:
+        import cv2
+        scale = max_side / max(image.shape[:2])
+        image = cv2.resize(image, (round(image.shape[1] * scale), round(image.shape[0] * scale)),
+                           interpolation=cv2.INTER_AREA)
+    return image
+
+
+def tile_positions(length, tile=TILE_SIZE, stride=DEFAULT_STRIDE):
+    """Start offsets covering [0, length), with the last tile flush against the edge"""
+    if length <= tile:
+        return [0]
+    positions = list(range(0, length - tile + 1, stride))
+    if positions[-1] != length - tile:
+        positions.append(length - tile)
+    return positions
+
+
+def tile_view(image, tile=TILE_SIZE):
+    """Zero-copy view of every tile x tile window: view[y, x] is the tile at (x, y)"""
+    return np.lib.stride_tricks.sliding_window_view(image, (tile, tile, 3))[:, :, 0]
+
+
+def vegetation_mask(image, step=MASK_STEP, threshold=EXG_THRESHOLD):
+    """Excess Green (2g - r - b on chromatic coordinates) above threshold, every step-th pixel"""
+    sample = image[::step, ::step].astype(np.float32)
+    total = sample.sum(axis=2) + 1e-6
+    r, g, b = (sample[..., i] / total for i in range(3))
+    return (2 * g - r - b) > threshold
+
+
+def tile_coverage(mask, ys, xs, tile=TILE_SIZE, step=MASK_STEP):
+    """Fraction of vegetation pixels in every tile, from a summed-area table of the mask"""
+    table = np.zeros((mask.shape[0] + 1, mask.shape[1] + 1), dtype=np.int32)
+    table[1:, 1:] = mask.cumsum(axis=0).cumsum(axis=1)
+
+    y0 = np.asarray(ys)[:, None] // step
+    x0 = np.asarray(xs)[None, :] // step
+    y1 = np.minimum(y0 + tile // step, mask.shape[0])
+    x1 = np.minimum(x0 + tile // step, mask.shape[1])
+    area = np.maximum((y1 - y0) * (x1 - x0), 1)
+    return (table[y1, x1] - table[y0, x1] - table[y1, x0] + table[y0, x0]) / area
+
+
+class TiledResult:
+    """Image-level prediction from tiled inference plus per-tile detail"""
+
+    def __init__(self, record, probabilities, tile_probabilities, boxes, coverage, image_shape, tiles_total):
+        self.record = record
+        self.probabilities = probabilities
+        self.tile_probabilities = tile_probabilities
+        self.boxes = boxes
+        self.coverage = coverage
+        self.image_shape = image_shape
+        self.tiles_total = tiles_total
+
+    @property
+    def tiles_used(self):
+        return len(self.boxes)
+
+    def heatmap(self, class_id=None, step=MASK_STEP):
+        """Per-pixel (every step-th) mean probability of class_id over the tiles covering it
+
+        class_id defaults to the image-level diagnosis; areas covered by no
+        analyzed tile are 0.
+        """
+        if class_id is None:
+            class_id = int(self.record['class_id'][0])
+        height, width = self.image_shape[:2]
+        total = np.zeros((-(-height // step), -(-width // step)), dtype=np.float32)
+        count = np.zeros_like(total)
+        for (x, y), probability in zip(self.boxes, self.tile_probabilities[:, class_id]):
+            total[y // step:(y + TILE_SIZE) // step, x // step:(x + TILE_SIZE) // step] += probability
+            count[y // step:(y + TILE_SIZE) // step, x // step:(x + TILE_SIZE) // step] += 1
+        return np.divide(total, count, out=np.zeros_like(total), where=count > 0)
+
+
+def classify_tiled(model, image, top_k=3, stride=DEFAULT_STRIDE, max_side=DEFAULT_MAX_SIDE,
+                   min_vegetation=MIN_VEGETATION, batch_size=32, aggregate='mean', calibration=None,
+                   crop=ANY_CROP):
+    """Classify a large photo tile by tile and aggregate into one prediction record
+
+    aggregate='mean' averages tile probabilities weighted by vegetation
+    coverage and tile confidence; 'max' takes each class's strongest tile
+    evidence, which favours small lesions on an otherwise healthy plant.
+    When no tile has enough vegetation every tile is used. crop (a crop id
+    from crops.resolve_crop) restricts every tile to that crop's classes.
+    """
+    with span('tiling'):
+        pixels = prepare_image(image, max_side)
+        if min(pixels.shape[:2]) < TILE_SIZE:
+            import cv2
+            scale = TILE_SIZE / min(pixels.shape[:2])
+            pixels = cv2.resize(pixels, (max(TILE_SIZE, round(pixels.shape[1] * scale)),
+                                         max(TILE_SIZE, round(pixels.shape[0] * scale))))
+
+        ys = tile_positions(pixels.shape[0], stride=stride)
+        xs = tile_positions(pixels.shape[1], stride=stride)
+        coverage = tile_coverage(vegetation_mask(pixels), ys, xs)
+        keep_y, keep_x = np.nonzero(coverage >= min_vegetation)
+        if len(keep_y) == 0:
+            # No clear vegetation (close-up of a brown lesion, odd lighting): use every tile
+            keep_y, keep_x = np.nonzero(np.ones_like(coverage, dtype=bool))
+
+        windows = tile_view(pixels)
+        boxes = [(xs[j], ys[i]) for i, j in zip(keep_y, keep_x)]
+        weights = coverage[keep_y, keep_x]
+
+    buffer = allocate_batch(batch_size)
+    tile_probabilities = []
+    for start in range(0, len(boxes), batch_size):
+        # Only the tiles that are kept are copied, straight into the model's input buffer
+        tiles = [windows[y, x] for x, y in boxes[start:start + batch_size]]
+        batch = preprocess_batch(tiles, out=buffer)
+        with span('predict'):
+            tile_probabilities.append(predict_with_crop(model, batch, crop))
+    tile_probabilities = np.concatenate(tile_probabilities)
+
+    masks = crop_masks(crop)
+    if aggregate == 'max':
+        probabilities = tile_probabilities.max(axis=0)
+        probabilities /= probabilities.sum()
+    else:
+        # A tile's confidence is its best class within the crop hint
+        confidence = (tile_probabilities * masks if masks is not None else tile_probabilities).max(axis=1)
+        weights = np.maximum(weights, 1e-3) * confidence
+        probabilities = weights @ tile_probabilities / weights.sum()
+
+    calibration = calibration if calibration is not None else get_calibration()
+    record = postprocess(probabilities, top_k, calibration, masks)[0]
+    return TiledResult(record, probabilities, tile_probabilities, boxes, coverage[keep_y, keep_x],
+                       pixels.shape, coverage.size)
+
+
+def heatmap_overlay(image, heatmap, alpha=0.5, max_side=800):
+    """Blend a [0, 1] heatmap over the photo (red = strong evidence) for display"""
+    if not isinstance(image, Image.Image):
+        image = Image.fromarray(np.asarray(image))
+    image = image.convert('RGB')
+    if max(image.size) > max_side:
+        scale = max_side / max(image.size)
+        image = image.resize((round(image.size[0] * scale), round(image.size[1] * scale)), Image.BILINEAR,
+                                 reducing_gap=2.0)
+
+    peak = heatmap.max()
+    scaled = (heatmap / peak if peak > 0 else heatmap) * 255
+    heat = Image.fromarray(scaled.astype(np.uint8)).resize(image.size, Image.BILINEAR)
+    heat = np.asarray(heat, dtype=np.float32)[..., None] / 255
+
+    # Yellow for weak evidence through red for strong; untouched where there is none
+    color = np.concatenate([np.full_like(heat, 255), 255 * (1 - heat), np.zeros_like(heat)], axis=2)
+    pixels = np.asarray(image, dtype=np.float32)
+    blend = alpha * heat
+    return Image.fromarray((pixels * (1 - blend) + color * blend).astype(np.uint8))
@@ -0,0 +1,11 @@
+import { defineConfig } from 'vite'
+
+// Devices too slow for on-device inference post their images to the Python
+// inference server (server.py); in development Vite proxies those requests
+export default defineConfig({
+  server: {
+    proxy: {
+      '/classify': process.env.INFERENCE_SERVER_URL || 'http://localhost:8000'
+    }
+  }
+})
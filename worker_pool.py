@@ -0,0 +1,410 @@
+"""Multi-process inference worker pool with shared-memory weights and image buffers
+
+Each worker is a separate process pinned to its own subset of CPU cores,
+so inference and normalization scale past the GIL. Workers run the
+TFLite engine on one model file that every process memory-maps. With the
+builtin kernels (the default) they read the weights straight from that
+mapping, so the weights sit in the page cache once instead of being
+loaded N times. INFERENCE_XNNPACK=1 turns on the XNNPACK delegate, which
+is faster per image but repacks the weights into private memory in every
+worker.
+Images travel through shared-memory slots: the caller writes pixels into
+a slot and only the slot number crosses the process boundary, and the
+worker writes class probabilities back into a shared output array.
+"""
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from model_utils import MODEL_INPUT_SIZE, file_signature, get_class_names, resize_to_input
+from inference_scheduler import QueueFullError
+from metrics import get_metrics, record_error
+from postprocessing import get_calibration, postprocess_rows
+from crops import ANY_CROP, crop_masks
+
+SLOT_SHAPE = (MODEL_INPUT_SIZE[1], MODEL_INPUT_SIZE[0], 3)
+
+
+def split_cores(num_workers, cores=None):
+    """Split the CPUs this process may use into one contiguous subset per worker"""
+    cores = sorted(cores if cores is not None else os.sched_getaffinity(0))
+    if num_workers >= len(cores):
+        return [[cores[i % len(cores)]] for i in range(num_workers)]
+    per_worker = len(cores) // num_workers
+    return [cores[i * per_worker:(i + 1) * per_worker] for i in range(num_workers)]
+
+
+def shared_model_path(model_path):
+    """Return a TFLite file for workers to memory-map, converting a Keras model once if needed
+
+    The float32 conversion runs in a child process, so the parent never
+    imports TensorFlow and forks stay cheap.
+    """
+    if model_path.endswith('.tflite'):
+        return model_path
+
+    from model_conversion import default_artifact_path
+
+    tflite_path = default_artifact_path(model_path, 'none')
+    if os.path.exists(tflite_path) and os.path.getmtime(tflite_path) >= os.path.getmtime(model_path):
+        return tflite_path
+
+    print(f"Converting {model_path} to {tflite_path} for the worker pool")
+    context = multiprocessing.get_context('spawn')
+    process = context.Process(target=_convert, args=(model_path, tflite_path), name='worker-pool-convert')
+    process.start()
+    process.join()
+    if process.exitcode != 0 or not os.path.exists(tflite_path):
+        raise Exception(f"Failed to convert {model_path} for the worker pool")
+    return tflite_path
+
+
+def _convert(model_path, tflite_path):
+    from model_conversion import convert_to_tflite
+    convert_to_tflite(model_path, tflite_path, 'none')
+
+
+def _worker_main(worker_id, model_path, cores, use_xnnpack, input_name, output_name,
+                 num_slots, num_classes, max_batch_size, tasks, results):
+    """Worker process: pin to cores, load the model, then serve batches of slots"""
+    # Thread pools size themselves from these, so set them before any import
+    threads = str(len(cores))
+    os.environ['OMP_NUM_THREADS'] = threads
+    os.environ['TF_NUM_INTRAOP_THREADS'] = threads
+    os.environ['TF_NUM_INTEROP_THREADS'] = '1'
+    try:
+        os.sched_setaffinity(0, cores)
+    except (AttributeError, OSError) as e:
+        print(f"Worker {worker_id}: could not pin to cores {cores}: {str(e)}")
+
+    from model_utils import allocate_batch, load_image_reduced, preprocess_batch
+    from inference_engines import TFLiteEngine
+
+    # Spawned workers share the parent's resource tracker, so attaching does
+    # not hand ownership of the blocks to this process
+    input_block = shared_memory.SharedMemory(name=input_name)
+    output_block = shared_memory.SharedMemory(name=output_name)
+    inputs = np.ndarray((num_slots,) + SLOT_SHAPE, dtype=np.uint8, buffer=input_block.buf)
+    outputs = np.ndarray((num_slots, num_classes), dtype=np.float32, buffer=output_block.buf)
+
+    try:
+        engine = TFLiteEngine(model_path, num_threads=len(cores), use_xnnpack=use_xnnpack)
+        engine.predict_on_batch(np.zeros((1,) + SLOT_SHAPE, dtype=np.float32))
+    except Exception as e:
+        results.put(('failed', worker_id, str(e)))
+        return
+    results.put(('ready', worker_id, os.getpid(), cores))
+
+    batch_buffer = allocate_batch(max_batch_size)
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        batch = [task]
+        while len(batch) < max_batch_size:
+            try:
+                task = tasks.get_nowait()
+            except queue.Empty:
+                break
+            if task is None:
+                tasks.put(None)
+                break
+            batch.append(task)
+
+        # Tasks with a path are decoded here, off the parent's GIL
+        done, slots = [], []
+        for slot, path in batch:
+            if path is None:
+                slots.append(slot)
+                continue
+            try:
+                inputs[slot] = resize_to_input(load_image_reduced(path))
+                slots.append(slot)
+            except Exception as e:
+                done.append((slot, str(e)))
+
+        if slots:
+            try:
+                outputs[slots] = engine.predict_on_batch(
+                    preprocess_batch([inputs[slot] for slot in slots], out=batch_buffer))
+                done.extend((slot, None) for slot in slots)
+            except Exception as e:
+                done.extend((slot, f"Error during prediction: {str(e)}") for slot in slots)
+        results.put(('done', worker_id, done))
+
+    input_block.close()
+    output_block.close()
+
+
+class WorkerPool:
+    """Serve inference from N pinned worker processes sharing one memory-mapped model
+
+    ``submit`` and ``submit_path`` return Futures of prediction records like
+    InferenceScheduler, so callers can switch between in-process and
+    multi-process serving without other changes.
+    ``num_slots`` bounds the number of images in flight; when every slot
+    is taken, submit waits up to ``slot_timeout`` seconds and then raises
+    QueueFullError. ``use_xnnpack`` trades the shared weights for
+    XNNPACK's faster kernels (see the module docstring).
+    """
+
+    def __init__(self, model_path, num_workers=None, cores_per_worker=None, max_batch_size=16,
+                 num_slots=None, use_xnnpack=False, slot_timeout=5.0):
+        available = sorted(os.sched_getaffinity(0))
+        if num_workers is None:
+            num_workers = max(1, len(available) // (cores_per_worker or 4))
+        self.num_workers = num_workers
+        self.core_sets = split_cores(num_workers, available)
+        if cores_per_worker:
+            self.core_sets = [cores[:cores_per_worker] for cores in self.core_sets]
+        self.max_batch_size = max_batch_size
+        self.num_slots = num_slots or num_workers * max_batch_size * 2
+        self.use_xnnpack = use_xnnpack
+        self.slot_timeout = slot_timeout
+        self.model_path = shared_model_path(model_path)
+        mtime_ns, size = file_signature(self.model_path)
+        self.version = f"{os.path.basename(self.model_path)}@{mtime_ns}.{size}/pool"
+        self.num_classes = len(get_class_names())
+
+        self._input_block = None
+        self._output_block = None
+        self._processes = []
+        self._pending = {}
+        self._free_slots = queue.Queue()
+        self._lock = threading.Lock()
+        self._ready = {}
+        self._failed = None
+        self._collector = None
+        self._closed = False
+        self.images_run = 0
+        self.batches_run = 0
+        self.worker_batches = [0] * num_workers
+
+    def start(self, timeout=120.0):
+        """Start the workers and wait until every one has loaded the model"""
+        slot_bytes = int(np.prod(SLOT_SHAPE))
+        self._input_block = shared_memory.SharedMemory(create=True, size=self.num_slots * slot_bytes)
+        self._output_block = shared_memory.SharedMemory(create=True, size=self.num_slots * self.num_classes * 4)
+        self._inputs = np.ndarray((self.num_slots,) + SLOT_SHAPE, dtype=np.uint8, buffer=self._input_block.buf)
+        self._outputs = np.ndarray((self.num_slots, self.num_classes), dtype=np.float32,
+                                   buffer=self._output_block.buf)
+        for slot in range(self.num_slots):
+            self._free_slots.put(slot)
+
+        # spawn, not fork: forking a process with live TensorFlow or
+        # Streamlit threads can deadlock the child
+        context = multiprocessing.get_context('spawn')
+        self._tasks = context.Queue()
+        self._results = context.Queue()
+        for worker_id, cores in enumerate(self.core_sets):
+            process = context.Process(
+                target=_worker_main,
+                args=(worker_id, self.model_path, cores, self.use_xnnpack, self._input_block.name,
+                      self._output_block.name, self.num_slots, self.num_classes, self.max_batch_size,
+                      self._tasks, self._results),
+                name=f'inference-worker-{worker_id}', daemon=True)
+            process.start()
+            self._processes.append(process)
+
+        self._collector = threading.Thread(target=self._collect, name='worker-pool-collector', daemon=True)
+        self._collector.start()
+
+        deadline = time.monotonic() + timeout
+        while len(self._ready) < self.num_workers and self._failed is None:
+            if time.monotonic() > deadline:
+                self.close()
+                raise TimeoutError(f"Worker pool did not start within {timeout:.0f}s")
+            time.sleep(0.05)
+        if self._failed is not None:
+            self.close()
+            raise Exception(f"Failed to start worker pool: {self._failed}")
+        print(f"Worker pool ready: {self.num_workers} workers on cores {self.core_sets} serving {self.model_path}")
+        return self
+
+    def _acquire_slot(self):
+        if self._failed is not None:
+            raise Exception(f"Worker pool is not running: {self._failed}")
+        try:
+            return self._free_slots.get(timeout=self.slot_timeout)
+        except queue.Empty:
+            raise QueueFullError("All inference workers are busy. Please try again in a moment.")
+
+    def _enqueue(self, slot, path, top_k, crop):
+        future = Future()
+        future.set_running_or_notify_cancel()
+        with self._lock:
+            self._pending[slot] = (future, top_k, crop)
+        self._tasks.put((slot, path))
+        return future
+
+    def submit(self, image, top_k=3, crop=ANY_CROP):
+        """Copy one image (PIL image or RGB array) into shared memory and queue it"""
+        slot = self._acquire_slot()
+        try:
+            self._inputs[slot] = resize_to_input(image)
+        except Exception:
+            self._free_slots.put(slot)
+            raise
+        return self._enqueue(slot, None, top_k, crop)
+
+    def submit_path(self, path, top_k=3, crop=ANY_CROP):
+        """Queue an image file; a worker decodes it straight into shared memory"""
+        return self._enqueue(self._acquire_slot(), os.path.abspath(path), top_k, crop)
+
+    def predict(self, image, top_k=3, timeout=30.0, crop=ANY_CROP):
+        """Submit an image and block until its top-k predictions are ready"""
+        return self.submit(image, top_k, crop).result(timeout=timeout)
+
+    def _collect(self):
+        """Resolve futures as workers report finished slots, and notice dead workers"""
+        while not self._closed:
+            try:
+                message = self._results.get(timeout=1.0)
+            except queue.Empty:
+                dead = [p.name for p in self._processes if not p.is_alive()]
+                if dead and not self._closed:
+                    self._fail(f"worker(s) exited unexpectedly: {', '.join(dead)}")
+                continue
+            except (EOFError, OSError):
+                break
+
+            kind, worker_id = message[0], message[1]
+            if kind == 'ready':
+                self._ready[worker_id] = {'pid': message[2], 'cores': message[3]}
+            elif kind == 'failed':
+                self._fail(f"worker {worker_id}: {message[2]}")
+            elif kind == 'done':
+                self.batches_run += 1
+                self.worker_batches[worker_id] += 1
+                requests = []
+                with self._lock:
+                    for slot, error in message[2]:
+                        # Missing when _fail already failed the request, e.g. after another worker died
+                        pending = self._pending.pop(slot, None)
+                        if pending is not None:
+                            requests.append((slot, error) + pending)
+                succeeded = [request for request in requests if request[1] is None]
+                if succeeded:
+                    # Calibrate, restrict to crop hints and take top-k for the whole batch at once
+                    records = postprocess_rows(self._outputs[[slot for slot, _, _, _, _ in succeeded]],
+                                               [top_k for _, _, _, top_k, _ in succeeded], get_calibration(),
+                                               crop_masks([crop for _, _, _, _, crop in succeeded]))
+                    for (_, _, future, _, _), record in zip(succeeded, records):
+                        future.set_result(record)
+                    self.images_run += len(succeeded)
+                for slot, error, future, _, _ in requests:
+                    if error is not None:
+                        future.set_exception(Exception(error))
+                    self._free_slots.put(slot)
+
+    def _fail(self, reason):
+        record_error('worker_pool')
+        self._failed = reason
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        for future, _, _ in pending.values():
+            future.set_exception(Exception(f"Worker pool failed: {reason}"))
+
+    def stats(self):
+        """Return per-worker placement and throughput counters as a plain dictionary"""
+        return {
+            'workers': self.num_workers,
+            'model_path': self.model_path,
+            'core_sets': self.core_sets,
+            'workers_ready': len(self._ready),
+            'pids': [self._ready.get(i, {}).get('pid') for i in range(self.num_workers)],
+            'batches_run': self.batches_run,
+            'images_run': self.images_run,
+            'avg_batch_size': self.images_run / self.batches_run if self.batches_run else 0.0,
+            'worker_batches': list(self.worker_batches),
+            'in_flight': len(self._pending),
+            'failed': self._failed,
+        }
+
+    def close(self):
+        """Stop the workers and release the shared memory"""
+        if self._closed:
+            return
+        self._closed = True
+        for _ in self._processes:
+            self._tasks.put(None)
+        for process in self._processes:
+            process.join(timeout=10)
+            if process.is_alive():
+                process.terminate()
+        if self._collector is not None:
+            self._collector.join(timeout=2)
+        self._inputs = self._outputs = None
+        for block in (self._input_block, self._output_block):
+            if block is not None:
+                block.close()
+                block.unlink()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def worker_pool_enabled():
+    """True when INFERENCE_WORKERS asks for multi-process serving"""
+    return int(os.environ.get('INFERENCE_WORKERS', 0)) > 0
+
+
+def worker_pool_running():
+    """True once the process-wide pool has started (without starting it)"""
+    return _pool is not None and _pool._failed is None
+
+
+def start_worker_pool(attempts=None, backoff=2.0, max_backoff=60.0):
+    """Start the process-wide pool, retrying with exponential backoff, and exit the process if it never starts
+
+    Used at server startup: a pool that failed once would otherwise leave
+    /ready at 503 forever. INFERENCE_POOL_START_ATTEMPTS (default 5) bounds
+    the tries; exiting lets the process supervisor restart the server.
+    """
+    attempts = attempts or int(os.environ.get('INFERENCE_POOL_START_ATTEMPTS', 5))
+    delay = backoff
+    for attempt in range(1, attempts + 1):
+        try:
+            return get_worker_pool()
+        except Exception as e:
+            record_error('worker_pool_start')
+            print(f"Worker pool start failed (attempt {attempt}/{attempts}): {str(e)}")
+            if attempt < attempts:
+                time.sleep(delay)
+                delay = min(delay * 2, max_backoff)
+    print("Worker pool could not be started; exiting")
+    os._exit(1)
+
+
+def get_worker_pool():
+    """Return the process-wide worker pool, or None when INFERENCE_WORKERS is unset or 0"""
+    global _pool
+    if not worker_pool_enabled():
+        return None
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                cores = os.environ.get('INFERENCE_CORES_PER_WORKER')
+                _pool = WorkerPool(
+                    os.environ.get('MODEL_PATH', 'plant_disease_model.keras'),
+                    num_workers=int(os.environ['INFERENCE_WORKERS']),
+                    cores_per_worker=int(cores) if cores else None,
+                    max_batch_size=int(os.environ.get('INFERENCE_MAX_BATCH_SIZE', 16)),
+                    use_xnnpack=os.environ.get('INFERENCE_XNNPACK', '0') == '1',
+                ).start()
+                get_metrics().gauge('plant_worker_pool_in_flight', 'Images queued or running in the worker pool',
+                                    fn=lambda: len(_pool._pending))
+    return _pool